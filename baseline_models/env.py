@@ -1,5 +1,4 @@
 import sys
-import json
 import random
 from os.path import join, dirname, abspath
 from collections import defaultdict
@@ -12,6 +11,7 @@ sys.path.insert(0, SITE_PATH)
 from web_agent_site.envs import WebAgentTextEnv
 from web_agent_site.utils import *
 from web_agent_site.engine.goal import get_reward
+from web_agent_site.engine.query_store import get_search_texts, load_extra_search
 
 
 class WebEnv:
@@ -23,7 +23,7 @@ class WebEnv:
                                    num_products=args.num, human_goals=args.human_goals,
                                    get_image=args.get_image,
                                    num_prev_obs=args.num_prev_obs, num_prev_actions=args.num_prev_actions,
-                                   session_prefix=id)
+                                   session_prefix=id, query_store=args.query_store or None)
         if args.num is None:
             if split == 'test':
                 self.goal_idxs = range(500)
@@ -57,25 +57,13 @@ class WebEnv:
         self.reduce_click = 1
 
         if args.extra_search_path != "":
-            self.extra_search = json.load(open(args.extra_search_path))
-            self.extra_search = {
-                k.strip("."): v for k, v in self.extra_search.items()}
+            self.extra_search = load_extra_search(args.extra_search_path)
         else:
             self.extra_search = None
 
     def get_search_texts(self, atts, query, inst):
         # TODO: make it more complicated, or replace it with free-form generation
-        if self.extra_search is not None:
-            if ", and price lower than" in inst:
-                idx = inst.find(", and price lower than")
-                inst_ = inst[:idx]
-            else:
-                inst_ = inst
-            texts = self.extra_search.get(inst_, []) + [inst.lower()]
-        else:
-            texts = [query] + \
-                [f'{att} {query}' for att in atts] + [inst.lower()]
-        return texts
+        return get_search_texts(atts, query, inst, self.extra_search)
 
     def get_valid_actions(self):
         valid_info = self.env.get_available_actions()
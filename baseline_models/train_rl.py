@@ -209,6 +209,7 @@ def parse_args():
     parser.add_argument('--num_prev_obs', default=0, type=int, help='number of previous observations')
     parser.add_argument('--num_prev_actions', default=0, type=int, help='number of previous actions')
     parser.add_argument('--extra_search_path', default="./data/goal_query_predict.json", type=str, help='path for extra search queries')
+    parser.add_argument('--query_store', default="", type=str, help='path of precomputed results of the search queries')
     
 
     # experimental 
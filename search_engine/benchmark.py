@@ -0,0 +1,259 @@
+"""
+Benchmark the search backends on the queries agents issue for the goals:
+
+    cd search_engine
+    python benchmark.py --backends lucene bm25 --num_products 100 1000 100000 full
+
+For each backend and catalog size, the search texts of the goals (see
+`get_search_texts`) are replayed against a fresh search engine in its own
+process, and the report gives the latency percentiles of single searches, the
+throughput at each number of threads, the peak memory of the process and its
+children (e.g. shard workers), the size of the index on disk, and the
+recall@10 and recall@50 of each goal's asin over the searches of that goal.
+Caches of the search engine are cleared before each phase, so no phase is
+served from the results of the one before.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+
+import numpy as np
+import psutil
+from rich import print
+from rich.table import Table
+sys.path.insert(0, '../')
+
+from web_agent_site.utils import DEFAULT_FILE_PATH
+from web_agent_site.engine.engine import (
+    SEARCH_BACKENDS,
+    SEARCH_INDEX_DIR,
+    SEARCH_RETURN_N,
+    init_search_engine,
+    load_products,
+)
+from web_agent_site.engine.goal import get_goals
+from web_agent_site.engine.query_store import get_search_texts, load_extra_search
+from web_agent_site.engine.search_backends import SearchBackend
+
+NUM_QUERIES = 1000
+RSS_SAMPLE_INTERVAL = 0.1
+RECALL_DEPTHS = (10, SEARCH_RETURN_N)
+INDEX_PATHS = {
+    'lucene': [SEARCH_INDEX_DIR],
+    'bm25': [f'{SEARCH_INDEX_DIR}_bm25.npz'],
+    'dense': [f'{SEARCH_INDEX_DIR}_dense'],
+    'hybrid': [SEARCH_INDEX_DIR, f'{SEARCH_INDEX_DIR}_dense'],
+    'sharded': [f'{SEARCH_INDEX_DIR}_shards'],
+}
+
+
+def get_goal_search_texts(goals, extra_search=None, num_queries=NUM_QUERIES, seed=0):
+    """Sample up to `num_queries` distinct (search text, goal asins) pairs of `goals`"""
+    goal_asins = dict()
+    for goal in goals:
+        texts = get_search_texts(goal['attributes'], goal['query'], goal['instruction_text'], extra_search)
+        for text in texts:
+            goal_asins.setdefault(text.lower(), set()).add(goal['asin'])
+    texts = sorted(goal_asins)
+    random.Random(seed).shuffle(texts)
+    return [(text, goal_asins[text]) for text in texts[:num_queries]]
+
+
+class PeakRssMonitor:
+    """
+    Peak resident memory of this process and all of its descendants, sampled
+    every `interval` seconds on a background thread. Pages shared by several
+    processes are counted once per process.
+    """
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        """Current resident memory of the process tree in MB"""
+        rss = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                rss += process.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        self.peak = max(self.peak, rss)
+        return rss / 2 ** 20
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and return the peak resident memory in MB"""
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        return self.peak / 2 ** 20
+
+
+def get_index_size_mb(backend):
+    """Size on disk of the index files of `backend`, or None if it has none"""
+    size = 0
+    paths = [path for path in INDEX_PATHS.get(backend, []) if os.path.exists(path)]
+    if not paths:
+        return None
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        for root, _, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size / 2 ** 20
+
+
+def measure_throughput(search_engine, queries, threads):
+    """Queries per second of `search_engine` over `queries` with `threads` threads"""
+    search_engine.clear_cache()
+    start = time.perf_counter()
+    SearchBackend.batch_search(search_engine, queries, k=SEARCH_RETURN_N, threads=threads)
+    return len(queries) / (time.perf_counter() - start)
+
+
+def run_benchmark(backend, num_products, num_queries, thread_counts, extra_search_path=''):
+    """Benchmark `backend` over the first `num_products` products, in this process"""
+    rss_monitor = PeakRssMonitor().start()
+    all_products, _, product_prices, _ = load_products(DEFAULT_FILE_PATH, num_products=num_products)
+    goals = get_goals(all_products, product_prices)
+    extra_search = load_extra_search(extra_search_path) if extra_search_path else None
+    texts = get_goal_search_texts(goals, extra_search, num_queries)
+    catalog_rss = rss_monitor.sample()
+
+    start = time.perf_counter()
+    search_engine = init_search_engine(
+        num_products=num_products,
+        backend=backend,
+        all_products=all_products,
+    )
+    startup = time.perf_counter() - start
+
+    # Warm-up queries are product queries, which are also search texts of goals
+    search_engine.clear_cache()
+    latencies = []
+    recalls = {depth: [] for depth in RECALL_DEPTHS}
+    for text, goal_asins in texts:
+        start = time.perf_counter()
+        hits = search_engine.search(text, k=SEARCH_RETURN_N)
+        latencies.append(time.perf_counter() - start)
+        asins = [hit.asin for hit in hits]
+        for depth in RECALL_DEPTHS:
+            recalls[depth].append(len(goal_asins.intersection(asins[:depth])) / len(goal_asins))
+
+    queries = [text for text, _ in texts]
+    qps = {threads: measure_throughput(search_engine, queries, threads) for threads in thread_counts}
+    peak_rss = rss_monitor.stop()
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99]).tolist()
+    return dict(
+        backend=backend,
+        num_products=num_products,
+        num_goals=len(goals),
+        num_queries=len(queries),
+        # Includes the warm-up of the search engine
+        startup_s=startup,
+        p50_ms=p50,
+        p95_ms=p95,
+        p99_ms=p99,
+        qps=qps,
+        peak_rss_mb=peak_rss,
+        catalog_rss_mb=catalog_rss,
+        **{f'recall@{depth}': float(np.mean(recalls[depth])) for depth in RECALL_DEPTHS},
+    )
+
+
+def run_benchmark_process(conn, *args):
+    conn.send(run_benchmark(*args))
+    conn.close()
+
+
+def run_in_new_process(*args):
+    """
+    Run `run_benchmark` in a fresh process, so runs do not share memory or a
+    JVM. Not a pool worker: the sharded backend starts processes of its own.
+    """
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=run_benchmark_process, args=(child_conn, *args))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        raise RuntimeError(f'Benchmark process failed with exit code {process.exitcode}.')
+    return result
+
+
+def print_report(results):
+    table = Table(title='Search benchmark')
+    for column in ['backend', 'products', 'queries', 'p50 ms', 'p95 ms', 'p99 ms', 'QPS (threads)',
+                   'peak RSS MB', 'index MB', 'recall@10', 'recall@50']:
+        table.add_column(column)
+    for r in results:
+        index_size = r['index_mb']
+        table.add_row(
+            r['backend'],
+            str(r['num_products'] or 'full'),
+            str(r['num_queries']),
+            f"{r['p50_ms']:.2f}",
+            f"{r['p95_ms']:.2f}",
+            f"{r['p99_ms']:.2f}",
+            ' '.join(f'{qps:.0f} ({threads})' for threads, qps in r['qps'].items()),
+            f"{r['peak_rss_mb']:.0f}",
+            '-' if index_size is None else f'{index_size:.0f}',
+            f"{r['recall@10']:.3f}",
+            f"{r['recall@50']:.3f}",
+        )
+    print(table)
+
+
+def parse_num_products(value):
+    return None if value == 'full' else int(value)
+
+
+if __name__ == '__main__':
+    max_threads = os.cpu_count()
+    parser = argparse.ArgumentParser(description='Benchmark the latency, throughput, memory and recall of search backends')
+    parser.add_argument('--backends', nargs='+', default=['lucene'],
+                        choices=[b for b in SEARCH_BACKENDS if b != 'remote'])
+    parser.add_argument('--num_products', nargs='+', type=parse_num_products, default=[100, 1000, 100000, None],
+                        help="Catalog sizes, 'full' for the whole catalog")
+    parser.add_argument('--num_queries', type=int, default=NUM_QUERIES,
+                        help='Maximum number of distinct search texts replayed per run')
+    parser.add_argument('--threads', nargs='+', type=int,
+                        default=[2 ** i for i in range(max_threads.bit_length()) if 2 ** i <= max_threads],
+                        help='Thread counts to measure throughput at')
+    parser.add_argument('--extra_search_path', default='', help='Also replay the predicted queries of each instruction')
+    parser.add_argument('--output', default=None, help='Append the results as JSON lines to this file')
+    args = parser.parse_args()
+
+    results = []
+    for num_products in args.num_products:
+        for backend in args.backends:
+            print(f'Benchmarking {backend} over {num_products or "all"} products.')
+            result = run_in_new_process(
+                backend, num_products, args.num_queries, args.threads, args.extra_search_path,
+            )
+            result['index_mb'] = get_index_size_mb(backend)
+            results.append(result)
+            if args.output is not None:
+                with open(args.output, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+    print_report(results)
@@ -0,0 +1,131 @@
+"""
+Build the search indexes from the products file in a single streaming pass:
+
+    cd search_engine
+    python build_index.py [--profile lean|full] [--threads N] [--bm25] [--shards N]
+
+Products are normalized and written to `resources/` as documents one at a
+time by a single process, in files of `DOCUMENTS_PER_FILE` documents that
+pyserini then indexes in parallel, so a raw products file is never held in
+memory. The input can also be a compiled catalog (see
+`web_agent_site.engine.catalog`), whose products are already normalized but
+are loaded at once. A single Lucene index of
+the full catalog is built in `indexes/`; smaller catalogs are searched in it
+with a filter on their asins (see `init_search_engine`). With `--shards N`,
+the catalog is also split by asin hash into N shard indexes in
+`indexes_shards/` for the 'sharded' search backend (see `sharded_search`).
+"""
+import os
+import sys
+import glob
+import json
+import shutil
+import argparse
+import subprocess
+from tqdm import tqdm
+sys.path.insert(0, '../')
+
+from web_agent_site.utils import DEFAULT_FILE_PATH
+from web_agent_site.engine.engine import SEARCH_INDEX_DIR, iter_products
+from web_agent_site.engine.sharded_search import get_shard
+from web_agent_site.engine.search_backends import (
+    BM25Backend,
+    build_search_document,
+    iter_documents,
+)
+
+DOCUMENTS_DIR = 'resources'
+# Outside of DOCUMENTS_DIR, whose subdirectories pyserini would also index
+SHARD_DOCUMENTS_DIR = 'resources_shards'
+DOCUMENTS_PER_FILE = 50000
+STORE_FLAGS = {
+    'lean': [],
+    'full': ['--storePositions', '--storeDocvectors', '--storeRaw'],
+}
+
+
+def write_documents(filepath, output_dir, lean=True, num_shards=None):
+    """
+    Write the documents of the products in `filepath` to numbered files in
+    `output_dir`, in catalog order. Returns the number of documents.
+
+    Arguments:
+    num_shards (`int`) -- If given, documents are split by asin hash into the
+        shard directories `output_dir/00`, `output_dir/01`, ... instead
+    """
+    output_dirs = [output_dir]
+    if num_shards is not None:
+        output_dirs = [os.path.join(output_dir, f'{i:02d}') for i in range(num_shards)]
+    for d in output_dirs:
+        os.makedirs(d, exist_ok=True)
+        for path in glob.glob(os.path.join(d, 'documents*.jsonl')):
+            os.remove(path)
+
+    files = [None] * len(output_dirs)
+    counts = [0] * len(output_dirs)
+    try:
+        for _, p in tqdm(iter_products(filepath)):
+            i = 0 if num_shards is None else get_shard(p['asin'], num_shards)
+            if counts[i] % DOCUMENTS_PER_FILE == 0:
+                if files[i] is not None:
+                    files[i].close()
+                part = counts[i] // DOCUMENTS_PER_FILE
+                files[i] = open(os.path.join(output_dirs[i], f'documents-{part:05d}.jsonl'), 'w')
+            files[i].write(json.dumps(build_search_document(p, lean=lean)) + '\n')
+            counts[i] += 1
+    finally:
+        for f in files:
+            if f is not None:
+                f.close()
+    num_docs = sum(counts)
+    print(f'Wrote {num_docs} documents to {output_dir}.')
+    return num_docs
+
+
+def run_lucene_indexer(input_dir, index_dir, threads, profile='lean'):
+    subprocess.run([
+        sys.executable, '-m', 'pyserini.index.lucene',
+        '--collection', 'JsonCollection',
+        '--input', input_dir,
+        '--index', index_dir,
+        '--generator', 'DefaultLuceneDocumentGenerator',
+        '--threads', str(threads),
+        *STORE_FLAGS[profile],
+    ], check=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the search indexes of the products file')
+    parser.add_argument('--input', default=DEFAULT_FILE_PATH, help='Products file or compiled catalog to index')
+    parser.add_argument('--profile', choices=list(STORE_FLAGS), default='lean',
+                        help='lean indexes hold only what search needs; full indexes also store '
+                             'positions, document vectors and raw documents with the product embedded')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='Number of indexing threads')
+    parser.add_argument('--bm25', action='store_true',
+                        help='Also save the index of the in-process BM25 backend')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Also build this many shard indexes for the sharded backend')
+    args = parser.parse_args()
+
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+    write_documents(args.input, DOCUMENTS_DIR, lean=args.profile == 'lean')
+    run_lucene_indexer(DOCUMENTS_DIR, SEARCH_INDEX_DIR, args.threads, args.profile)
+
+    if args.bm25:
+        backend = BM25Backend.from_documents(tqdm(iter_documents(DOCUMENTS_DIR)))
+        backend.save(f'{SEARCH_INDEX_DIR}_bm25.npz')
+        print(f'Saved BM25 index to {SEARCH_INDEX_DIR}_bm25.npz.')
+
+    if args.shards:
+        write_documents(args.input, SHARD_DOCUMENTS_DIR, lean=args.profile == 'lean', num_shards=args.shards)
+        # Every shard directory is searched, so drop those of a previous build
+        shutil.rmtree(f'{SEARCH_INDEX_DIR}_shards', ignore_errors=True)
+        # Shards are indexed one after another, each with all threads
+        for i in range(args.shards):
+            run_lucene_indexer(
+                os.path.join(SHARD_DOCUMENTS_DIR, f'{i:02d}'),
+                os.path.join(f'{SEARCH_INDEX_DIR}_shards', f'{i:02d}'),
+                args.threads,
+                args.profile,
+            )
@@ -7,9 +7,12 @@ searcher = LuceneSearcher('indexes')
 hits = searcher.search('rubber sole shoes', k=20)
 
 for hit in hits:
+    # The docid of a hit is the product asin
+    print(hit.docid, hit.score)
     doc = searcher.doc(hit.docid)
-    print(doc)
-    obj = json.loads(doc.raw())['product']['Title']
-    print(obj)
+    # Raw documents are only stored in indexes built with the full profile
+    if doc.raw() is not None:
+        obj = json.loads(doc.raw())['product']['Title']
+        print(obj)
 
 print(len(hits))
@@ -62,10 +62,7 @@ python -m spacy download en_core_web_lg
 
 # Build search engine index
 cd search_engine
-mkdir -p resources resources_100 resources_1k resources_100k
-python convert_product_file_format.py # convert items.json => required doc format
-mkdir -p indexes
-./run_indexing.sh
+python build_index.py # stream items.json => documents => indexes
 cd ..
 
 # Create logging folder + samples of log data
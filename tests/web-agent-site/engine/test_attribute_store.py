@@ -0,0 +1,43 @@
+import json
+import os
+import pickle
+import pytest
+from web_agent_site.engine.attribute_store import *
+
+def test_attribute_store(tmp_path):
+    path = tmp_path / 'items_ins.json'
+    values = {
+        'B002': {'attributes': ['soft'], 'instruction': 'soft shoes'},
+        'B001': {'attributes': []},
+        'B00ABCDE10': [{'instruction': 'ü'}],
+    }
+    path.write_text(json.dumps(values))
+    store = open_attribute_store(str(path))
+    index_path, data_path = sidecar_paths(str(path))
+    assert os.path.exists(index_path) and os.path.exists(data_path)
+
+    assert dict(store) == values
+    assert len(store) == 3
+    assert 'B001' in store and 'B003' not in store and 'B00ABCDE100' not in store
+    assert store['B002']['attributes'] == ['soft']
+    # Each lookup returns a value of its own
+    store['B002']['attributes'].append('blue')
+    assert store['B002']['attributes'] == ['soft']
+    assert store.get('B003') is None
+    with pytest.raises(KeyError):
+        store['B003']
+    assert dict(pickle.loads(pickle.dumps(store))) == values
+
+    # Sidecars are rebuilt once the source file changes
+    values['B003'] = {'attributes': ['blue']}
+    path.write_text(json.dumps(values))
+    os.utime(path, ns=(0, 0))
+    assert open_attribute_store(str(path))['B003'] == {'attributes': ['blue']}
+
+def test_rebuild_keeps_open_stores_readable(tmp_path):
+    path = tmp_path / 'attrs.json'
+    path.write_text(json.dumps({'B001': {'attributes': ['red']}, 'B002': {'attributes': ['blue']}}))
+    store = open_attribute_store(str(path))
+    build_attribute_store(str(path))
+    assert store['B002'] == {'attributes': ['blue']}
+    assert not [p for p in os.listdir(tmp_path) if p.endswith('.tmp')]
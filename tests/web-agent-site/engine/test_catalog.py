@@ -0,0 +1,121 @@
+import json
+import pickle
+import pytest
+from web_agent_site.engine.catalog import *
+
+def make_product(asin, attributes):
+    return {
+        'asin': asin,
+        'Title': f'Title {asin}',
+        'Attributes': attributes,
+        'pricing': [10.0],
+    }
+
+def test_save_load_catalog(tmp_path):
+    path = tmp_path / 'items.catalog'
+    all_products = [
+        make_product('A1', ['soft']),
+        make_product('A2', ['soft', 'blue']),
+        make_product('A3', ['blue']),
+    ]
+    product_prices = {'A1': 10.0, 'A2': 20.0, 'A3': 30.0}
+    attribute_to_asins = {'soft': {'A1', 'A2'}, 'blue': {'A2', 'A3'}}
+    save_catalog(path, all_products, product_prices, attribute_to_asins, [0, 2, 3])
+    assert is_compiled_catalog(path)
+
+    products, item_dict, prices, attr_to_asins = load_catalog(path)
+    assert products == all_products
+    assert item_dict == {p['asin']: p for p in all_products}
+    assert item_dict['A2'] is products[1]
+    assert prices == product_prices
+    assert attr_to_asins == attribute_to_asins
+    assert attr_to_asins['missing'] == set()
+
+    # Subsets match slicing the raw items file before normalization
+    products, item_dict, prices, attr_to_asins = load_catalog(path, num_products=3)
+    assert [p['asin'] for p in products] == ['A1', 'A2']
+    assert prices == {'A1': 10.0, 'A2': 20.0}
+    assert attr_to_asins == {'soft': {'A1', 'A2'}, 'blue': {'A2'}}
+
+def test_load_catalog_errors(tmp_path):
+    raw_path = tmp_path / 'items.json'
+    raw_path.write_text(json.dumps([]))
+    assert not is_compiled_catalog(raw_path)
+    with pytest.raises(ValueError):
+        load_catalog(raw_path)
+
+    path = tmp_path / 'items.catalog'
+    save_catalog(path, [], {}, {}, [], human_goals=False)
+    with pytest.raises(ValueError):
+        load_catalog(path, human_goals=True)
+
+def test_iter_json_array(tmp_path):
+    path = tmp_path / 'items.json'
+    products = [
+        {'asin': f'A{i}', 'name': 'x' * i, 'pricing': '$1.00', 'nested': [{'a': i}]}
+        for i in range(20)
+    ]
+    path.write_text(json.dumps(products, indent=2))
+    # Chunks smaller than a single product must still decode correctly
+    for chunk_size in (1, 7, 64, 1 << 20):
+        assert list(iter_json_array(path, chunk_size=chunk_size)) == products
+
+    # Consumers that stop early only read as far as they need
+    it = iter_json_array(path, chunk_size=16)
+    assert [next(it) for _ in range(3)] == products[:3]
+
+    path.write_text(' [ ] ')
+    assert list(iter_json_array(path, chunk_size=1)) == []
+
+    path.write_text('[{"asin": "A1"}, {"asin": ')
+    with pytest.raises(ValueError):
+        list(iter_json_array(path, chunk_size=4))
+    path.write_text('{"asin": "A1"}')
+    with pytest.raises(ValueError):
+        list(iter_json_array(path))
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_lazy_catalog(tmp_path, compress):
+    path = tmp_path / 'items.catalog'
+    all_products = [
+        {
+            **make_product(f'A{i}', ['soft']),
+            'Description': f'Description {i}',
+            'BulletPoints': [f'Bullet {i}'],
+            'option_to_image': {'red': None},
+        }
+        for i in range(3)
+    ]
+    prices = {p['asin']: 10.0 for p in all_products}
+    save_catalog(
+        path, all_products, prices, {}, [0, 1, 2], lazy=True, compress=compress
+    )
+
+    products, item_dict, _, _ = load_catalog(path)
+    assert all(isinstance(p, LazyProduct) for p in products)
+    assert products == all_products
+    product = item_dict['A1']
+    assert 'Description' not in product.fields
+    assert product['Description'] == 'Description 1'
+    assert product.get('Reviews') is None
+    assert 'Reviews' not in product
+    assert sorted(product) == sorted(all_products[1])
+
+    # Accesses of one product decode its record once
+    decoded = []
+    blob_decode = product.blob.decode
+    product.blob.cache.clear()
+    product.blob.decode = lambda *args: decoded.append(args) or blob_decode(*args)
+    assert dict(product) == all_products[1]
+    assert 'Reviews' not in product and len(product) == len(all_products[1])
+    assert len(decoded) == 1
+    del product.blob.decode
+
+    # Writes to lazy fields move the record fully into memory
+    product['goal_instruction'] = 'Instruction'
+    assert product.blob is not None
+    product['Description'] = 'Changed'
+    assert product.blob is None
+    assert product['Description'] == 'Changed'
+    assert product['BulletPoints'] == ['Bullet 1']
+    assert pickle.loads(pickle.dumps(product)) == dict(product)
@@ -0,0 +1,83 @@
+import pytest
+from web_agent_site.engine.catalog_update import *
+from web_agent_site.engine.engine import build_attribute_to_asins, normalize_products
+
+def make_raw_product(asin, name='Product'):
+    return {
+        'asin': asin,
+        'name': name,
+        'full_description': 'description',
+        'small_description': ['bullet'],
+        'pricing': '$10.00',
+        'customization_options': {'Color': [{'value': 'Red', 'image': None}]},
+        'images': ['image.jpg'],
+        'query': 'query',
+        'category': 'beauty',
+        'product_category': 'Beauty › Skin Care',
+    }
+
+ATTRIBUTES = {
+    'A1': {'attributes': ['soft']},
+    'A2': {'attributes': ['soft', 'blue']},
+    'A3': {'attributes': ['blue']},
+}
+
+@pytest.fixture
+def catalog():
+    products = [make_raw_product(asin) for asin in ('A1', 'A2', 'A3')]
+    all_products, _ = normalize_products(products, ATTRIBUTES, dict())
+    product_item_dict = {p['asin']: p for p in all_products}
+    product_prices = {p['asin']: 10.0 for p in all_products}
+    attribute_to_asins = build_attribute_to_asins(all_products)
+    return all_products, product_item_dict, product_prices, attribute_to_asins
+
+def test_apply_catalog_delta(catalog):
+    all_products, product_item_dict, product_prices, attribute_to_asins = catalog
+    a2 = product_item_dict['A2']
+    delta = {
+        'upsert': [make_raw_product('A2', 'Renamed'), make_raw_product('A4')],
+        'remove': ['A3', 'A9'],
+        'prices': {'A1': 5},
+        'attributes': {'A4': {'attributes': ['green']}},
+    }
+    changed, removed = apply_catalog_delta(
+        delta,
+        all_products,
+        product_item_dict,
+        product_prices,
+        attribute_to_asins,
+        attributes=ATTRIBUTES,
+        human_attributes=dict(),
+    )
+    assert changed == ['A2', 'A4', 'A1']
+    assert removed == ['A3']
+    assert [p['asin'] for p in all_products] == ['A1', 'A2', 'A4']
+    # Replaced products are updated in place
+    assert all_products[1] is product_item_dict['A2'] is a2
+    assert product_item_dict == {p['asin']: p for p in all_products}
+    assert product_item_dict['A2']['Title'] == 'Renamed'
+    assert set(product_prices) == {'A1', 'A2', 'A4'}
+    assert product_prices['A1'] == 5.0
+    assert product_item_dict['A1']['Price'] == '$5.0'
+    assert attribute_to_asins == {'soft': {'A1', 'A2'}, 'blue': {'A2'}, 'green': {'A4'}}
+
+def test_apply_catalog_delta_upsert_wins_over_remove(catalog):
+    all_products, product_item_dict, product_prices, attribute_to_asins = catalog
+    changed, removed = apply_catalog_delta(
+        {'upsert': [make_raw_product('A3', 'Kept')], 'remove': ['A3']},
+        all_products,
+        product_item_dict,
+        product_prices,
+        attribute_to_asins,
+        attributes=ATTRIBUTES,
+        human_attributes=dict(),
+    )
+    assert changed == ['A3'] and removed == []
+    assert product_item_dict['A3']['Title'] == 'Kept'
+
+def test_validate_catalog_delta():
+    validate_catalog_delta({'upsert': [], 'remove': []})
+    with pytest.raises(ValueError):
+        validate_catalog_delta([])
+    with pytest.raises(ValueError):
+        validate_catalog_delta({'delete': ['A1']})
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from web_agent_site.engine.dense_search import *
+from web_agent_site.engine.search_backends import analyze
+
+VOCAB = ['red', 'shoe', 'dress', 'blue', 'running', 'short']
+DOCUMENTS = [
+    {'id': 'A1', 'contents': 'red running shoe'},
+    {'id': 'A2', 'contents': 'red dress'},
+    {'id': 'A3', 'contents': 'blue running short'},
+]
+
+class BagOfWordsEncoder:
+    model_name = 'bag-of-words'
+
+    def encode(self, texts):
+        vectors = np.zeros((len(texts), len(VOCAB)), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for term in analyze(text):
+                if term in VOCAB:
+                    vectors[i, VOCAB.index(term)] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+
+class RankedBackend(SearchBackend):
+    def __init__(self, asins):
+        self.asins = asins
+
+    def search(self, query, k):
+        return [Hit(asin, 1.0) for asin in self.asins[:k]]
+
+def test_hybrid_backend():
+    hybrid = HybridBackend(RankedBackend(['A1', 'A2', 'A3']), RankedBackend(['A3', 'A4', 'A1']))
+    assert [hit.asin for hit in hybrid.search('query', k=10)] == ['A1', 'A3', 'A2', 'A4']
+    assert [hit.asin for hit in hybrid.search('query', k=2)] == ['A1', 'A3']
+    assert hybrid.count('query') == 4
+    lexical_only = HybridBackend(
+        RankedBackend(['A1', 'A2']), RankedBackend(['A2', 'A1']), dense_weight=0.
+    )
+    assert [hit.asin for hit in lexical_only.search('query', k=2)] == ['A1', 'A2']
+
+@pytest.mark.parametrize('index_type', ['flat', 'hnsw'])
+def test_dense_backend(tmp_path, index_type):
+    pytest.importorskip('faiss')
+    backend = DenseBackend.from_documents(DOCUMENTS, BagOfWordsEncoder(), index_type)
+    assert [hit.asin for hit in backend.search('red shoe', k=2)] == ['A1', 'A2']
+    assert backend.count('red shoe') == 3
+
+    filtered = DenseBackend.from_documents(
+        DOCUMENTS, BagOfWordsEncoder(), index_type, asins=['A2', 'A3']
+    )
+    assert [hit.asin for hit in filtered.search('red shoe', k=3)] == ['A2', 'A3']
+
+    backend.update([{
+        'asin': 'A4', 'Title': 'Blue dress', 'Description': '', 'BulletPoints': [''], 'options': {},
+    }], ['A1'])
+    assert [hit.asin for hit in backend.search('blue dress', k=2)] == ['A4', 'A2']
+    assert 'A1' not in [hit.asin for hit in backend.search('red shoe', k=10)]
+
+    backend.save(tmp_path / 'dense')
+    loaded = DenseBackend.load(tmp_path / 'dense', encoder=BagOfWordsEncoder())
+    assert loaded.search('blue dress', k=10) == backend.search('blue dress', k=10)
+
+class VectorEncoder:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def encode(self, texts):
+        return self.vectors[[int(text) for text in texts]]
+
+@pytest.mark.parametrize('subset_index_size', [SUBSET_INDEX_SIZE, 0])
+@pytest.mark.parametrize('index_type', ['flat', 'hnsw', 'ivf'])
+def test_dense_backend_subset(monkeypatch, index_type, subset_index_size):
+    pytest.importorskip('faiss')
+    monkeypatch.setattr('web_agent_site.engine.dense_search.SUBSET_INDEX_SIZE', subset_index_size)
+    vectors = np.random.default_rng(0).normal(size=(1000, 16)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    doc_asins = [f'A{i}' for i in range(len(vectors))]
+    asins = doc_asins[::50]
+    backend = DenseBackend(
+        build_faiss_index(vectors, index_type, nlist=8), doc_asins, VectorEncoder(vectors),
+        asins=asins, nprobe=8,
+    )
+    hits = backend.search('1', k=10)
+    # The subset is searched in full, however far its documents are from the query
+    expected = np.argsort(-(vectors[::50] @ vectors[1]))[:10]
+    assert [hit.asin for hit in hits] == [asins[i] for i in expected]
+    assert backend.count('1') == 20
+    assert len(backend.search('1', k=50)) == 20
+    backend.set_filter(None)
+    assert backend.count('1') == DENSE_COUNT_DEPTH
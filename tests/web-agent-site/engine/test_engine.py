@@ -0,0 +1,173 @@
+from web_agent_site.engine.engine import *
+from web_agent_site.engine.search_backends import Hit
+
+def make_product(asin, category, query, attributes):
+    return {
+        'asin': asin,
+        'category': category,
+        'query': query,
+        'Attributes': attributes,
+    }
+
+ALL_PRODUCTS = [
+    make_product('A1', 'beauty', 'face cream', ['soft']),
+    make_product('A2', 'garden', 'hose', ['green', 'soft']),
+    make_product('A3', 'beauty', 'hand cream', ['soft']),
+]
+
+def test_keyword_index_search():
+    product_item_dict = {p['asin']: p for p in ALL_PRODUCTS}
+    attribute_to_asins = build_attribute_to_asins(ALL_PRODUCTS)
+    keyword_index = build_keyword_index(ALL_PRODUCTS)
+    for keywords in (
+        ['<c>', 'beauty'],
+        ['<q>', 'hand', 'cream'],
+        ['<a>', 'soft'],
+        ['<a>', 'blue'],
+    ):
+        expected = get_top_n_product_from_keywords(
+            keywords, None, ALL_PRODUCTS, product_item_dict, attribute_to_asins
+        )
+        result = get_top_n_product_from_keywords(
+            keywords, None, ALL_PRODUCTS, product_item_dict, attribute_to_asins,
+            keyword_index,
+        )
+        assert result == expected
+    assert list(keyword_index['<a>']['soft']) == ['A1', 'A2', 'A3']
+
+def test_update_keyword_index():
+    keyword_index = build_keyword_index(ALL_PRODUCTS)
+    update_keyword_index(
+        keyword_index,
+        old_product=ALL_PRODUCTS[0],
+        new_product=make_product('A1', 'beauty', 'lotion', ['soft']),
+    )
+    update_keyword_index(keyword_index, old_product=ALL_PRODUCTS[1])
+    assert list(keyword_index['<a>']['soft']) == ['A1', 'A3']
+    assert 'green' not in keyword_index['<a>']
+    assert 'face cream' not in keyword_index['<q>']
+    assert list(keyword_index['<q>']['lotion']) == ['A1']
+
+class BatchSearchEngine:
+    def __init__(self):
+        self.batches = []
+
+    def batch_search(self, queries, k, threads=1):
+        self.batches.append((queries, k))
+        return [[Hit(asin, 1.0) for asin in ('A3', 'A1', 'A9')][:k] for _ in queries]
+
+    def count(self, query):
+        raise AssertionError('Results up to the search depth are not counted')
+
+def test_batch_get_search_results():
+    product_item_dict = {p['asin']: p for p in ALL_PRODUCTS}
+    keyword_index = build_keyword_index(ALL_PRODUCTS)
+    search_engine = BatchSearchEngine()
+    results = batch_get_search_results(
+        [['red', 'shoes'], ['<c>', 'garden'], ['Red', 'Shoes'], ['cream']],
+        search_engine,
+        ALL_PRODUCTS,
+        product_item_dict,
+        keyword_index=keyword_index,
+        threads=4,
+    )
+    assert [[p['asin'] for p in r.get_page(1, product_item_dict)] for r in results] == [
+        ['A3', 'A1'], ['A2'], ['A3', 'A1'], ['A3', 'A1'],
+    ]
+    assert [r.total for r in results] == [3, 1, 3, 3]
+    assert search_engine.batches == [(['red shoes', 'cream'], PRODUCT_WINDOW)]
+
+class RankedSearchEngine:
+    def __init__(self, num_hits):
+        self.asins = [f'A{i}' for i in range(num_hits)]
+        self.depths = []
+
+    def search(self, query, k):
+        self.depths.append(k)
+        return [Hit(asin, 1.0) for asin in self.asins[:k]]
+
+    def count(self, query):
+        self.depths.append('count')
+        return len(self.asins)
+
+def test_search_results():
+    search_engine = RankedSearchEngine(35)
+    product_item_dict = {asin: {'asin': asin} for asin in search_engine.asins}
+    results = get_search_results(['shoes'], search_engine, None, product_item_dict)
+    assert results.total == 35
+    assert search_engine.depths == [PRODUCT_WINDOW, 'count']
+    assert [p['asin'] for p in results.get_page(1, product_item_dict)] == search_engine.asins[:10]
+    assert [p['asin'] for p in results.get_page(4, product_item_dict)] == search_engine.asins[30:]
+    assert results.get_page(5, product_item_dict) == []
+    assert search_engine.depths == [PRODUCT_WINDOW, 'count', 35]
+
+    # The total and the results stop at the search depth
+    search_engine = RankedSearchEngine(100)
+    results = get_search_results(['shoes'], search_engine, None, product_item_dict, page=7)
+    assert results.total == SEARCH_RETURN_N
+    assert search_engine.depths == [SEARCH_RETURN_N]
+    assert len(results.get_page(6, product_item_dict)) == 0
+
+    search_engine = RankedSearchEngine(100)
+    results = get_top_n_product_from_keywords(['shoes'], search_engine, None, product_item_dict)
+    assert [p['asin'] for p in results] == search_engine.asins[:35]
+    assert search_engine.depths == [SEARCH_RETURN_N]
+
+def test_lazy_search_results():
+    search_engine = RankedSearchEngine(35)
+    product_item_dict = {asin: {'asin': asin} for asin in search_engine.asins}
+    results = get_search_results(['shoes'], search_engine, None, product_item_dict, search_depth=None)
+    assert results.total == 35
+    assert search_engine.depths == [PRODUCT_WINDOW, 'count']
+    assert [p['asin'] for p in results.get_page(4, product_item_dict)] == search_engine.asins[30:]
+    assert search_engine.depths == [PRODUCT_WINDOW, 'count', 35]
+
+    results = get_search_results(
+        ['shoes'], RankedSearchEngine(100), None, product_item_dict, page=7, search_depth=None
+    )
+    assert results.total == 100
+    assert len(results.asins) == 70
+
+def make_raw_product(asin, name):
+    return {
+        'asin': asin,
+        'name': name,
+        'full_description': '',
+        'small_description': ['feature'],
+        'pricing': '$10.00',
+        'customization_options': {},
+        'images': ['image.jpg'],
+        'query': 'Query ',
+        'brand': 'brand',
+    }
+
+def test_iter_products(tmp_path):
+    filepath = tmp_path / 'items.json'
+    filepath.write_text(json.dumps([
+        make_raw_product('A1', 'first'),
+        make_raw_product('nan', 'invalid'),
+        make_raw_product('A1', 'duplicate'),
+        make_raw_product('A2', 'second'),
+    ]))
+    products = list(iter_products(str(filepath)))
+    assert [(i, p['asin'], p['Title']) for i, p in products] == [
+        (0, 'A1', 'first'), (3, 'A2', 'second'),
+    ]
+    assert products[0][1]['Attributes'] == ['DUMMY_ATTR']
+    assert 'brand' not in products[0][1]
+
+def test_iter_products_compiled(tmp_path):
+    from web_agent_site.engine.catalog import save_catalog
+    raw_products = clean_product_keys([
+        make_raw_product('A1', 'first'), make_raw_product('A1', 'duplicate'), make_raw_product('A2', 'second'),
+    ])
+    all_products, positions = normalize_products(raw_products, dict(), dict())
+    for lazy in (False, True):
+        filepath = str(tmp_path / f'items-{lazy}.catalog')
+        save_catalog(
+            filepath, all_products, generate_product_prices(all_products),
+            build_attribute_to_asins(all_products), positions, lazy=lazy,
+        )
+        products = list(iter_products(filepath))
+        assert [(i, p['asin'], p['Title']) for i, p in products] == [(0, 'A1', 'first'), (2, 'A2', 'second')]
+        assert build_search_document(products[1][1]) == build_search_document(all_products[1])
@@ -0,0 +1,40 @@
+import pickle
+import pytest
+from web_agent_site.engine.price_table import *
+
+PRODUCTS = [
+    {'asin': 'B003', 'pricing': [10.0]},
+    {'asin': 'B001', 'pricing': [5.0, 15.0]},
+    {'asin': 'B002', 'pricing': []},
+]
+
+def test_sample_prices():
+    prices = sample_prices(PRODUCTS, seed=1)
+    assert prices[0] == 10.0
+    assert 5.0 <= prices[1] <= 15.0
+    assert prices[2] == 100.0
+    assert list(sample_prices(PRODUCTS, seed=1)) == list(prices)
+    assert list(sample_prices(PRODUCTS[:2], seed=1)) == list(prices[:2])
+    assert sample_prices(PRODUCTS, seed=2)[1] != prices[1]
+    assert len(sample_prices([])) == 0
+
+def test_price_table():
+    table = PriceTable.from_products(PRODUCTS, seed=1)
+    assert len(table) == 3
+    assert sorted(table) == ['B001', 'B002', 'B003']
+    assert table['B003'] == 10.0
+    assert table.get('B004') is None
+    assert table.get('B0030000000') is None
+    assert table.get(None) is None
+
+    table['B001'] = 7.5
+    table['B004'] = 20.0
+    del table['B002']
+    assert dict(table) == {'B001': 7.5, 'B003': 10.0, 'B004': 20.0}
+    with pytest.raises(KeyError):
+        del table['B002']
+    table['B002'] = 1.0
+    assert table['B002'] == 1.0
+
+    assert pickle.loads(pickle.dumps(table)) == table
+    assert dict(table.subset(['B004', 'B001'])) == {'B001': 7.5, 'B004': 20.0}
@@ -0,0 +1,86 @@
+import os
+import pytest
+from web_agent_site.engine.engine import batch_get_search_results, get_search_results
+from web_agent_site.engine.search_backends import BM25Backend
+from web_agent_site.engine.query_store import *
+
+DOCUMENTS = [
+    {'id': f'A{i}', 'contents': f'red shoe size {i}' if i % 2 else f'blue hat size {i}'}
+    for i in range(8)
+]
+
+GOALS = [
+    {
+        'attributes': ['red', 'leather'],
+        'query': 'shoe',
+        'instruction_text': 'I want a red shoe, and price lower than 40.00 dollars',
+    },
+    {
+        'attributes': [],
+        'query': 'Blue  Hat',
+        'instruction_text': 'i need a blue hat',
+    },
+]
+
+class NoSearchEngine:
+    def search(self, query, k):
+        raise AssertionError(f'{query} was searched')
+
+    def batch_search(self, queries, k, threads=1):
+        raise AssertionError(f'{queries} were searched')
+
+def test_get_search_texts():
+    goal = GOALS[0]
+    args = (goal['attributes'], goal['query'], goal['instruction_text'])
+    assert get_search_texts(*args) == [
+        'shoe', 'red shoe', 'leather shoe', 'i want a red shoe, and price lower than 40.00 dollars',
+    ]
+    extra_search = {'I want a red shoe': ['red shoes']}
+    assert get_search_texts(*args, extra_search=extra_search) == [
+        'red shoes', 'i want a red shoe, and price lower than 40.00 dollars',
+    ]
+
+def test_get_goal_queries():
+    queries = get_goal_queries(GOALS, {'i need a blue hat': ['hat']})
+    assert queries == [
+        'shoe', 'red shoe', 'leather shoe', 'i want a red shoe, and price lower than 40.00 dollars',
+        'blue hat', 'i need a blue hat', 'hat',
+    ]
+
+def test_query_store(tmp_path):
+    path = str(tmp_path / 'queries.db')
+    search_engine = BM25Backend.from_documents(DOCUMENTS)
+    build_query_store(
+        path, ['red shoe', 'hat', 'size'], search_engine, 'bm25', num_products=8, search_depth=3, batch_size=2
+    )
+
+    store = QueryResultStore(path)
+    store.check(8, 3, 'bm25')
+    with pytest.raises(ValueError):
+        store.check(None, 3, 'bm25')
+    with pytest.raises(ValueError):
+        store.check(8, 3, 'lucene')
+    assert len(store) == 3
+    assert store.get('red shoe') == ([hit.asin for hit in search_engine.search('red shoe', k=3)], 3)
+    assert store.get('hat') == ([hit.asin for hit in search_engine.search('hat', k=3)], 3)
+    assert store.get('scarf') is None
+
+    results = get_search_results(['Red', 'shoe'], NoSearchEngine(), [], {}, query_store=store)
+    assert results.asins == store.get('red shoe')[0]
+    results = batch_get_search_results([['hat'], ['size']], NoSearchEngine(), [], {}, query_store=store)
+    assert [r.asins for r in results] == [store.get('hat')[0], store.get('size')[0]]
+    results = get_search_results(['scarf'], search_engine, [], {}, query_store=store)
+    assert results.asins == []
+
+def test_rebuild_query_store(tmp_path):
+    path = str(tmp_path / 'queries.db')
+    search_engine = BM25Backend.from_documents(DOCUMENTS)
+    build_query_store(path, ['red shoe', 'hat'], search_engine, 'bm25', num_products=8)
+    old_store = QueryResultStore(path)
+    store = build_query_store(path, ['hat'], search_engine, 'bm25', num_products=8, search_depth=3)
+    assert len(store) == 1
+    assert store.get('red shoe') is None
+    store.check(8, 3, 'bm25')
+    # Stores opened before the rebuild keep reading the old file
+    assert len(old_store) == 2
+    assert sorted(os.listdir(tmp_path)) == ['queries.db']
@@ -0,0 +1,47 @@
+import threading
+from flask import Flask
+from web_agent_site.engine.renderer import *
+
+def make_app():
+    app = Flask(__name__)
+
+    @app.route('/<session_id>')
+    def index(session_id):
+        pass
+
+    @app.route('/search_results/<session_id>/<keywords>/<page>')
+    def search_results(session_id, keywords, page):
+        pass
+
+    return app
+
+def test_url_for():
+    renderer = TemplateRenderer(make_app().url_map)
+    assert renderer.url_for('index', session_id='abc') == '/abc'
+    assert renderer.url_for('static', filename='style.css') == '/static/style.css'
+    assert renderer.url_for('search_results', session_id='abc', keywords='shoe', page=2) == \
+        '/search_results/abc/shoe/2'
+
+def test_render_without_flask_context():
+    renderer = TemplateRenderer(make_app().url_map)
+    html = renderer.render('search_page.html', session_id='abc', instruction_text='<b>red</b> shoes')
+    assert 'action="/abc"' in html
+    assert '&lt;b&gt;red&lt;/b&gt; shoes' in html
+
+    pages = []
+    threads = [
+        threading.Thread(target=lambda: pages.append(
+            renderer.render('search_page.html', session_id='abc', instruction_text='<b>red</b> shoes')
+        ))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pages == [html] * 4
+
+def test_get_renderer():
+    app = make_app()
+    assert get_renderer(app) is get_renderer(app)
+    assert get_renderer(app) is not get_renderer(make_app())
@@ -0,0 +1,141 @@
+import os
+import pytest
+import threading
+import time
+from web_agent_site.engine.search_backends import *
+
+DOCUMENTS = [
+    {'id': 'A1', 'contents': 'red running shoes for men'},
+    {'id': 'A2', 'contents': "women's red dress"},
+    {'id': 'A3', 'contents': 'blue running shorts'},
+    {'id': 'A4', 'contents': 'red red red socks'},
+]
+
+@pytest.mark.parametrize(
+    'token, expected',
+    [
+        ('boots', 'boot'),
+        ('shoes', 'shoes'),
+        ('berries', 'berry'),
+        ('dress', 'dress'),
+        ('status', 'status'),
+        ('toes', 'toes'),
+        ('is', 'is'),
+    ]
+)
+def test_stem(token, expected):
+    assert stem(token) == expected
+
+def test_analyze():
+    assert analyze("The Women's Boots, for 2 kids") == ['women', 'boot', '2', 'kid']
+
+def test_bm25_backend():
+    backend = BM25Backend.from_documents(DOCUMENTS)
+    hits = backend.search('red shoes', k=10)
+    assert [hit.asin for hit in hits] == ['A1', 'A4', 'A2']
+    assert hits[0].score > hits[1].score > hits[2].score
+    assert [hit.asin for hit in backend.search('red shoes', k=1)] == ['A1']
+    assert backend.search('the', k=10) == []
+    assert backend.search('hat', k=10) == []
+
+def test_bm25_backend_ties():
+    backend = BM25Backend.from_documents([
+        {'id': f'A{i}', 'contents': 'same words'} for i in range(5)
+    ])
+    assert [hit.asin for hit in backend.search('words', k=3)] == ['A0', 'A1', 'A2']
+
+def test_bm25_backend_update(tmp_path):
+    backend = BM25Backend.from_documents(DOCUMENTS)
+    products = [
+        {
+            'asin': 'A5',
+            'Title': 'Striped hat',
+            'Description': '',
+            'BulletPoints': [''],
+            'options': {'color': ['red']},
+        },
+    ]
+    backend.update(products, ['A1'])
+    assert [hit.asin for hit in backend.search('red', k=10)] == ['A4', 'A2', 'A5']
+    assert [hit.asin for hit in backend.search('hat', k=10)] == ['A5']
+    assert backend.search('shoes', k=10) == []
+
+    path = tmp_path / 'index.npz'
+    backend.save(path)
+    loaded = BM25Backend.load(path)
+    for query in ('red', 'hat', 'running shorts'):
+        assert loaded.search(query, k=10) == backend.search(query, k=10)
+
+def test_bm25_backend_batch_search():
+    backend = BM25Backend.from_documents(DOCUMENTS)
+    queries = ['red shoes', 'running', 'hat']
+    for threads in (1, 3):
+        assert backend.batch_search(queries, k=10, threads=threads) == [
+            backend.search(query, k=10) for query in queries
+        ]
+
+def test_bm25_backend_filter():
+    backend = BM25Backend.from_documents(DOCUMENTS)
+    filtered = BM25Backend.from_documents(DOCUMENTS, asins=['A2', 'A3', 'A4'])
+    hits = backend.search('red shoes', k=10)
+    assert filtered.search('red shoes', k=10) == [hit for hit in hits if hit.asin != 'A1']
+    assert filtered.search('shoes', k=10) == []
+
+    filtered.update(
+        [{'asin': 'A1', 'Title': 'red shoes', 'Description': '', 'BulletPoints': [''], 'options': {}}],
+        ['A4'],
+    )
+    assert [hit.asin for hit in filtered.search('red', k=10)] == ['A1', 'A2']
+
+class ExclusiveSearcher(SearchBackend):
+    def __init__(self, asins):
+        self.asins = asins
+        self.busy = threading.Lock()
+        self.updates = 0
+
+    def search(self, query, k):
+        assert self.busy.acquire(blocking=False), 'searcher shared by threads'
+        try:
+            time.sleep(0.001)
+            return [Hit(asin, 1.0) for asin in sorted(self.asins)[:k]]
+        finally:
+            self.busy.release()
+
+    def update(self, products, removed_asins):
+        self.asins = (self.asins - set(removed_asins)) | {p['asin'] for p in products}
+
+def test_searcher_pool():
+    searchers = []
+    def factory(asins):
+        searchers.append(ExclusiveSearcher(asins))
+        return searchers[-1]
+
+    pool = SearcherPool(factory, {'A1', 'A2'})
+    pool.warm_up(['q'] * 20, k=10, threads=4)
+    assert 1 < len(searchers) <= 4
+    results = pool.batch_search(['q'] * 100, k=10, threads=8)
+    assert results == [[Hit('A1', 1.0), Hit('A2', 1.0)]] * 100
+
+    pool.update([{'asin': 'A3'}], ['A1'])
+    num_searchers = len(searchers)
+    assert [hit.asin for hit in pool.search('q', k=10)] == ['A2', 'A3']
+    pool.reopen()
+    assert [hit.asin for hit in pool.search('q', k=10)] == ['A2', 'A3']
+    assert len(searchers) == num_searchers + 1
+
+def test_process_index_dir(tmp_path):
+    index_dir = tmp_path / 'indexes'
+    index_dir.mkdir()
+    (index_dir / 'segments_1').write_text('segments')
+    (index_dir / 'write.lock').write_text('')
+    assert get_process_index_dir(str(index_dir)) == str(index_dir)
+    process_dir = get_process_index_dir(str(index_dir), copy=True)
+    assert process_dir != str(index_dir)
+    assert sorted(os.listdir(process_dir)) == ['segments_1']
+    assert get_process_index_dir(str(index_dir)) == process_dir
+    # Deleting files of the copy, as index updates do, leaves the index as is
+    os.remove(os.path.join(process_dir, 'segments_1'))
+    assert (index_dir / 'segments_1').read_text() == 'segments'
+    remove_process_index_dir(os.getpid(), process_dir)
+    assert not os.path.exists(process_dir)
+    del process_index_dirs[str(index_dir)]
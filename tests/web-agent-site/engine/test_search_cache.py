@@ -0,0 +1,41 @@
+from web_agent_site.engine.engine import get_top_n_product_from_keywords
+from web_agent_site.engine.search_backends import Hit
+from web_agent_site.engine.search_cache import *
+
+class CountingSearchEngine:
+    def __init__(self):
+        self.queries = []
+
+    def search(self, query, k):
+        self.queries.append(query)
+        return [Hit('A2', 2.0), Hit('A1', 1.0), Hit('A9', 0.5)]
+
+def test_normalize_keywords():
+    assert normalize_keywords(['Red', ' shoes ', '']) == normalize_keywords(['red', 'shoes'])
+    assert normalize_keywords(['<c>', 'beauty ', 'extra']) == ('<c>', 'beauty')
+    assert normalize_keywords(['<a>', 'soft', 'touch']) == ('<a>', 'soft touch')
+    assert normalize_keywords(['<r>']) is None
+
+def test_search_result_cache():
+    cache = SearchResultCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.put('a', ('A1',))
+    cache.put('b', ('A2',))
+    assert cache.get('a') == ('A1',)
+    cache.put('c', ('A3',))
+    assert cache.get('b') is None
+    assert cache.cache_info() == CacheInfo(hits=1, misses=2, maxsize=2, currsize=2)
+    cache.clear()
+    assert cache.get('a') is None
+
+def test_cached_search():
+    product_item_dict = {asin: {'asin': asin} for asin in ('A1', 'A2')}
+    search_engine = CountingSearchEngine()
+    cache = SearchResultCache()
+    for keywords in (['red', 'shoes'], ['Red', 'Shoes'], ['red', 'shoes']):
+        products = get_top_n_product_from_keywords(
+            keywords, search_engine, None, product_item_dict, search_cache=cache
+        )
+        assert [p['asin'] for p in products] == ['A2', 'A1']
+    assert search_engine.queries == ['red shoes']
+    assert cache.cache_info().hits == 2
@@ -0,0 +1,89 @@
+import os
+import stat
+import threading
+
+import pytest
+from web_agent_site.engine.search_backends import BM25Backend
+from web_agent_site.engine.search_service import *
+
+DOCUMENTS = [
+    {'id': 'A1', 'contents': 'red running shoes for men'},
+    {'id': 'A2', 'contents': "women's red dress"},
+    {'id': 'A3', 'contents': 'blue running shorts'},
+]
+
+@pytest.mark.parametrize(
+    'address, expected',
+    [
+        ('localhost:8765', ('localhost', 8765)),
+        ('/tmp/search.sock', '/tmp/search.sock'),
+    ]
+)
+def test_parse_address(address, expected):
+    assert parse_address(address) == expected
+
+def test_get_authkey(tmp_path, monkeypatch):
+    monkeypatch.delenv(SEARCH_SERVICE_AUTHKEY_ENV, raising=False)
+    key_path = str(tmp_path / 'keys' / 'search_service.key')
+    authkey = get_authkey(key_path)
+    assert len(authkey) == 64
+    assert stat.S_IMODE(os.stat(key_path).st_mode) == 0o600
+    assert get_authkey(key_path) == authkey
+    assert get_authkey(str(tmp_path / 'other.key')) != authkey
+
+    monkeypatch.setenv(SEARCH_SERVICE_AUTHKEY_ENV, 'secret')
+    assert get_authkey(key_path) == b'secret'
+    monkeypatch.delenv(SEARCH_SERVICE_AUTHKEY_ENV)
+    os.chmod(key_path, 0o644)
+    with pytest.raises(PermissionError):
+        get_authkey(key_path)
+
+def start_service(backend, address, **kwargs):
+    threading.Thread(target=serve, args=(backend, address, b'key'), kwargs=kwargs, daemon=True).start()
+    remote = RemoteSearchBackend(address, b'key')
+    for _ in range(50):
+        try:
+            remote.count('red')
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            threading.Event().wait(0.05)
+    return remote
+
+def test_remote_search_backend(tmp_path):
+    backend = BM25Backend.from_documents(DOCUMENTS)
+    address = str(tmp_path / 'search.sock')
+    remote = start_service(backend, address, allow_updates=True)
+    assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+
+    assert remote.search('red shoes', k=10) == backend.search('red shoes', k=10)
+    assert remote.batch_search(['red', 'running'], k=10, threads=2) == [
+        backend.search('red', k=10), backend.search('running', k=10),
+    ]
+    assert remote.count('running') == 2
+    remote.update([], ['A1'])
+    assert remote.count('running') == 1
+    with pytest.raises(RuntimeError):
+        remote.search('red', k='ten')
+    assert remote.search('red', k=1) == backend.search('red', k=1)
+
+def test_remote_updates_need_opt_in(tmp_path):
+    backend = BM25Backend.from_documents(DOCUMENTS)
+    remote = start_service(backend, str(tmp_path / 'search.sock'))
+    with pytest.raises(RuntimeError, match='--allow_updates'):
+        remote.update([], ['A1'])
+    assert remote.count('running') == 2
+
+def test_stale_socket_is_replaced(tmp_path):
+    address = str(tmp_path / 'search.sock')
+    # A socket file nobody listens on, as left by a killed service
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(address)
+    sock.close()
+    remote = start_service(BM25Backend.from_documents(DOCUMENTS), address)
+    assert remote.count('red') == 2
+
+def test_wrong_authkey_is_rejected(tmp_path):
+    address = str(tmp_path / 'search.sock')
+    start_service(BM25Backend.from_documents(DOCUMENTS), address)
+    with pytest.raises(AuthenticationError):
+        RemoteSearchBackend(address, b'other').count('red')
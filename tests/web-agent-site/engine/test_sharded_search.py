@@ -0,0 +1,70 @@
+import glob
+import pytest
+from web_agent_site.engine.search_backends import BM25Backend, Hit
+from web_agent_site.engine.sharded_search import *
+
+DOCUMENTS = [
+    {'id': f'A{i}', 'contents': f'red shoe size {i}' if i % 2 else f'blue hat size {i}'}
+    for i in range(20)
+]
+
+def build_shards(num_shards):
+    shard_documents = [[] for _ in range(num_shards)]
+    for doc in DOCUMENTS:
+        shard_documents[get_shard(doc['id'], num_shards)].append(doc)
+    return [BM25Backend.from_documents(docs) for docs in shard_documents]
+
+def test_get_shard():
+    shards = [get_shard(doc['id'], 4) for doc in DOCUMENTS]
+    assert shards == [get_shard(doc['id'], 4) for doc in DOCUMENTS]
+    assert set(shards) == {0, 1, 2, 3}
+
+def test_merge_hits():
+    shard_hits = [
+        [Hit('A1', 3.0), Hit('A2', 1.0)],
+        [Hit('B1', 2.0), Hit('B2', 1.0)],
+    ]
+    assert [hit.asin for hit in merge_hits(shard_hits, 3)] == ['A1', 'B1', 'A2']
+    assert merge_hits([[], []], 3) == []
+
+def test_sharded_backend():
+    backend = ShardedBackend(build_shards(3))
+    hits = backend.search('red shoe', k=20)
+    assert {hit.asin for hit in hits} == {f'A{i}' for i in range(1, 20, 2)}
+    assert [hit.score for hit in hits] == sorted((hit.score for hit in hits), reverse=True)
+    assert len(backend.search('red shoe', k=4)) == 4
+    assert backend.count('hat') == 10
+    assert backend.batch_search(['size 3', 'hat'], k=20) == [
+        backend.search('size 3', k=20), backend.search('hat', k=20),
+    ]
+
+def test_sharded_backend_update():
+    shards = build_shards(3)
+    backend = ShardedBackend(shards)
+    products = [{
+        'asin': 'B1',
+        'Title': 'Striped scarf',
+        'Description': '',
+        'BulletPoints': [''],
+        'options': {},
+    }]
+    backend.update(products, ['A1'])
+    assert [hit.asin for hit in backend.search('scarf', k=10)] == ['B1']
+    assert [hit.asin for hit in shards[get_shard('B1', 3)].search('scarf', k=10)] == ['B1']
+    assert 'A1' not in [hit.asin for hit in backend.search('red shoe', k=20)]
+
+def test_close_removes_sockets(tmp_path):
+    socket_dir = tmp_path / 'sockets'
+    socket_dir.mkdir()
+    ShardedBackend(build_shards(2), socket_dir=str(socket_dir)).close()
+    assert not socket_dir.exists()
+
+def test_dead_shard_worker(tmp_path):
+    # Not an index, so the worker exits while loading it
+    (tmp_path / 'shards' / '00').mkdir(parents=True)
+    socket_dirs = set(glob.glob(os.path.join(tempfile.gettempdir(), 'webshop-shards-*')))
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match='exited'):
+        start_shard_workers(str(tmp_path / 'shards'))
+    assert time.monotonic() - start < SHARD_WORKER_TIMEOUT
+    assert set(glob.glob(os.path.join(tempfile.gettempdir(), 'webshop-shards-*'))) == socket_dirs
@@ -0,0 +1,83 @@
+import os
+import pytest
+import random
+from web_agent_site.engine.shared_catalog import *
+
+@pytest.fixture
+def shared_catalog():
+    all_products = [
+        {'asin': f'B{i:03d}', 'Title': f'Title {i}', 'category': 'beauty', 'query': 'cream', 'Attributes': ('soft',)}
+        for i in (5, 1, 3, 2)
+    ]
+    product_prices = {p['asin']: float(i) for i, p in enumerate(all_products)}
+    attribute_to_asins = {'soft': {p['asin'] for p in all_products}}
+    goals = [{'asin': asin, 'weight': w} for asin, w in (('B001', 1.), ('B003', .5), ('B002', 2.))]
+    shm = publish_catalog(
+        f'webshop_test_{os.getpid()}',
+        all_products,
+        product_prices,
+        attribute_to_asins,
+        goals,
+    )
+    catalog = SharedCatalog(shm, cache_size=2)
+    yield catalog, all_products, product_prices, attribute_to_asins, goals
+    catalog.close()
+    shm.unlink()
+
+def test_shared_catalog(shared_catalog):
+    catalog, all_products, product_prices, attribute_to_asins, goals = shared_catalog
+    assert list(catalog.all_products) == all_products
+    assert catalog.all_products[-1] == all_products[-1]
+    assert catalog.all_products[1:3] == all_products[1:3]
+    with pytest.raises(IndexError):
+        catalog.all_products[4]
+    assert list(catalog.goals) == goals
+    assert catalog.attribute_to_asins == attribute_to_asins
+
+    assert dict(catalog.product_item_dict) == {p['asin']: p for p in all_products}
+    assert catalog.product_item_dict['B003'] == all_products[2]
+    assert 'B004' not in catalog.product_item_dict
+    assert 'B0030000000000' not in catalog.product_item_dict
+    with pytest.raises(KeyError):
+        catalog.product_item_dict['B004']
+
+    assert dict(catalog.product_prices) == product_prices
+    assert catalog.product_prices.get('B002') == 3.0
+    assert catalog.product_prices.get('B004') is None
+    assert len(catalog.cache) == 2
+
+def test_shared_catalog_index(shared_catalog):
+    catalog, all_products, *_ = shared_catalog
+    assert catalog.get_asins() == [p['asin'] for p in all_products]
+    assert list(catalog.keyword_index['<a>']['soft']) == [p['asin'] for p in all_products]
+    assert catalog.keyword_index['<q>'].get('lotion', ()) == ()
+    assert list(catalog.keyword_index['<c>']) == ['beauty']
+    assert catalog.attribute_to_asins['soft'] == {p['asin'] for p in all_products}
+    assert catalog.attribute_to_asins['hard'] == frozenset()
+    assert 'hard' not in catalog.attribute_to_asins
+    assert len(catalog.cache) == 0
+
+def test_shared_goals(shared_catalog):
+    catalog, *_, goals = shared_catalog
+    # Shuffling the shared goals reorders them as it would a list of the goals
+    random.seed(0)
+    random.shuffle(goals)
+    random.seed(0)
+    random.shuffle(catalog.goals)
+    assert list(catalog.goals) == goals
+    assert get_goal_weights(catalog.goals) == get_goal_weights(goals)
+    assert catalog.goals[::2] == goals[::2]
+
+def test_shared_products_are_read_only():
+    product = freeze({'asin': 'B001', 'options': {'size': ['s', 'm']}})
+    assert product == {'asin': 'B001', 'options': {'size': ('s', 'm')}}
+    for change in (
+        lambda: product.__setitem__('asin', 'B002'),
+        lambda: product.pop('asin'),
+        lambda: product.update(asin='B002'),
+        lambda: product['options'].setdefault('color', []),
+    ):
+        with pytest.raises(TypeError):
+            change()
+    assert pickle.loads(pickle.dumps(product)) == product
+    assert type(pickle.loads(pickle.dumps(product))) is dict
@@ -0,0 +1,62 @@
+import pytest
+from web_agent_site.engine.snapshot import *
+
+def test_snapshot_key(tmp_path):
+    path = tmp_path / 'items.json'
+    path.write_text('[]')
+    key = get_snapshot_key([str(path)], num_products=10, filter_goals=None)
+    assert key == get_snapshot_key([str(path)], num_products=10, filter_goals=None)
+    assert key != get_snapshot_key([str(path)], num_products=100, filter_goals=None)
+
+    # Filters are keyed on their code, not their identity
+    filter_1 = lambda i, goal: i % 2 == 0
+    filter_2 = lambda i, goal: i % 2 == 0
+    filter_3 = lambda i, goal: i % 3 == 0
+    key_1 = get_snapshot_key([str(path)], filter_goals=filter_1)
+    assert key_1 == get_snapshot_key([str(path)], filter_goals=filter_2)
+    assert key_1 != get_snapshot_key([str(path)], filter_goals=filter_3)
+
+    # Values a filter closes over are part of its key
+    def make_filter(split):
+        return lambda i, goal: i in split
+    key_1 = get_snapshot_key([str(path)], filter_goals=make_filter({1}))
+    assert key_1 == get_snapshot_key([str(path)], filter_goals=make_filter({1}))
+    assert key_1 != get_snapshot_key([str(path)], filter_goals=make_filter({2}))
+    filter_4 = lambda i, goal, n=2: i % n == 0
+    filter_5 = lambda i, goal, n=3: i % n == 0
+    assert get_snapshot_key([str(path)], filter_goals=filter_4) != \
+        get_snapshot_key([str(path)], filter_goals=filter_5)
+    # Values without a stable repr disable snapshots
+    assert get_snapshot_key([str(path)], filter_goals=make_filter(object())) is None
+
+    # Changing a source file invalidates the key
+    path.write_text('[{}]')
+    assert key != get_snapshot_key([str(path)], num_products=10, filter_goals=None)
+
+def test_save_load_snapshot(tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    assert load_snapshot(snapshot_dir, 'abc') is None
+    snapshot = {'goals': [{'asin': 'A1', 'weight': 1}], 'cum_weights': [0, 1]}
+    save_snapshot(snapshot_dir, 'abc', snapshot)
+    assert load_snapshot(snapshot_dir, 'abc') == snapshot
+    assert os.listdir(snapshot_dir) == ['abc.pkl']
+
+def test_snapshot_lazy_products(tmp_path):
+    from web_agent_site.engine.catalog import LazyProduct, ProductBlob, write_product_blob
+    path = str(tmp_path / 'items.catalog.blob')
+    records = write_product_blob(path, [{'asin': 'A1', 'Description': 'long text'}])
+    blob = ProductBlob(path)
+    products = [LazyProduct(fields, blob, offset, length) for fields, offset, length in records]
+    snapshot_dir = str(tmp_path / 'snapshots')
+    save_snapshot(snapshot_dir, 'abc', {'all_products': products, 'product_item_dict': {'A1': products[0]}})
+    snapshot = load_snapshot(snapshot_dir, 'abc')
+    product = snapshot['all_products'][0]
+    # Lazy fields are still read from the blob
+    assert isinstance(product, LazyProduct) and product.fields == {'asin': 'A1'}
+    assert product['Description'] == 'long text'
+    assert snapshot['product_item_dict']['A1'] is product
+
+    # The blob is part of the key of a lazy catalog
+    key = get_snapshot_key([str(tmp_path / 'items.catalog'), path])
+    write_product_blob(path, [{'asin': 'A1', 'Description': 'changed'}])
+    assert key != get_snapshot_key([str(tmp_path / 'items.catalog'), path])
@@ -1,31 +1,27 @@
-import os
+import sys
 
-from flask import render_template_string, Flask
+from flask import Flask
 from predict_help import Page
+sys.path.insert(0, '../')
+
+from web_agent_site.engine.renderer import get_renderer
 
 app=Flask(__name__)
 app.debug=True
 
 SESSION_ID = "ABC"
-TEMPLATE_DIR = "../web_agent_site/templates/"
 KEYWORDS = ["placeholder (not needed)"] # To Do: Does this matter?
 QUERY = ""
 product_map = {}
 
-def read_html_template(path):
-    with open(path) as f:
-        template = f.read()
-    return template
-
 @app.route('/', methods=['GET', 'POST'])
 def index(session_id, **kwargs):
     print("Hello world")
 
 @app.route('/', methods=['GET', 'POST'])
 def search_results(data):
-    path = os.path.join(TEMPLATE_DIR, 'results_page.html')
-    html = render_template_string(
-        read_html_template(path=path),
+    html = get_renderer(app).render(
+        'results_page.html',
         session_id=SESSION_ID,
         products=data,
         keywords=KEYWORDS,
@@ -37,9 +33,8 @@ def search_results(data):
 
 @app.route('/', methods=['GET', 'POST'])
 def item_page(session_id, asin, keywords, page, options):
-    path = os.path.join(TEMPLATE_DIR, 'item_page.html')
-    html = render_template_string(
-        read_html_template(path=path),
+    html = get_renderer(app).render(
+        'item_page.html',
         session_id=session_id,
         product_info=product_map[asin],
         keywords=keywords,
@@ -52,9 +47,8 @@ def item_page(session_id, asin, keywords, page, options):
 
 @app.route('/', methods=['GET', 'POST'])
 def item_sub_page(session_id, asin, keywords, page, sub_page, options):
-    path = os.path.join(TEMPLATE_DIR, sub_page.value.lower() + "_page.html")
-    html = render_template_string(
-        read_html_template(path),
+    html = get_renderer(app).render(
+        sub_page.value.lower() + "_page.html",
         session_id=session_id, 
         product_info=product_map[asin],
         keywords=keywords,
@@ -67,9 +61,8 @@ def item_sub_page(session_id, asin, keywords, page, sub_page, options):
 
 @app.route('/', methods=['GET', 'POST'])
 def done(asin, options, session_id, **kwargs):
-    path = os.path.join(TEMPLATE_DIR, 'done_page.html')
-    html = render_template_string(
-        read_html_template(path),
+    html = get_renderer(app).render(
+        'done_page.html',
         session_id=session_id,
         reward=1,
         asin=asin,
@@ -90,13 +83,12 @@ def dict_to_fake_html(data, page_type, asin=None, sub_page_type=None, options=No
     global QUERY, product_map
     QUERY = query
     product_map = prod_map
-    with app.app_context(), app.test_request_context():
-        if page_type == Page.RESULTS:
-            return search_results(data)
-        if page_type == Page.ITEM_PAGE:
-            return item_page(SESSION_ID, asin, KEYWORDS, 1, options)
-        if page_type == Page.SUB_PAGE:
-            if sub_page_type is not None:
-                return item_sub_page(SESSION_ID, asin, KEYWORDS, 1, sub_page_type, options)
-            else:
-                raise Exception("Sub page of type", sub_page_type, "unrecognized")
\ No newline at end of file
+    if page_type == Page.RESULTS:
+        return search_results(data)
+    if page_type == Page.ITEM_PAGE:
+        return item_page(SESSION_ID, asin, KEYWORDS, 1, options)
+    if page_type == Page.SUB_PAGE:
+        if sub_page_type is not None:
+            return item_sub_page(SESSION_ID, asin, KEYWORDS, 1, sub_page_type, options)
+        else:
+            raise Exception("Sub page of type", sub_page_type, "unrecognized")
\ No newline at end of file
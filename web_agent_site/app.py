@@ -1,9 +1,12 @@
-import argparse, json, logging, random
+import argparse, functools, json, logging, random, threading
+from contextlib import contextmanager
 from pathlib import Path
 from ast import literal_eval
 
 from flask import (
     Flask,
+    abort,
+    jsonify,
     request,
     redirect,
     url_for
@@ -11,16 +14,26 @@ from flask import (
 
 from rich import print
 
+from web_agent_site.engine.catalog_update import (
+    apply_catalog_delta,
+    validate_catalog_delta,
+)
 from web_agent_site.engine.engine import (
     load_products,
+    build_keyword_index,
     init_search_engine,
     convert_web_app_string_to_var,
-    get_top_n_product_from_keywords,
-    get_product_per_page,
+    get_search_results,
     map_action_to_html,
-    END_BUTTON
+    END_BUTTON,
+    SEARCH_BACKENDS,
+    SEARCH_RETURN_N,
 )
 from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.renderer import get_renderer
+from web_agent_site.engine.search_cache import SearchResultCache
+from web_agent_site.engine.search_service import RemoteSearchBackend, parse_address
+from web_agent_site.engine.shared_catalog import attach_catalog, get_goal_weights
 from web_agent_site.utils import (
     generate_mturk_code,
     setup_logger,
@@ -29,42 +42,123 @@ from web_agent_site.utils import (
 )
 
 app = Flask(__name__)
+# Compiles each template once; pages render with the URLs of the routes below
+renderer = get_renderer(app)
 
 search_engine = None
 all_products = None
 product_item_dict = None
 product_prices = None
 attribute_to_asins = None
+keyword_index = None
+search_cache = SearchResultCache()
 goals = None
 weights = None
 
 user_sessions = dict()
 user_log_dir = None
 SHOW_ATTRS_TAB = False
+SHARED_CATALOG = None
+SEARCH_BACKEND = 'lucene'
+SEARCH_DEPTH = SEARCH_RETURN_N
 
-@app.route('/')
-def home():
-    return redirect(url_for('index', session_id="abc"))
 
-@app.route('/<session_id>', methods=['GET', 'POST'])
-def index(session_id):
-    global user_log_dir
+class ReadWriteLock:
+    """Lock held by any number of readers at once, or by a single writer"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        # Waiting writers hold off new readers, so updates are not starved
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writing and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            self.condition.wait_for(lambda: not self.writing and self.readers == 0)
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+# Requests are served on threads: they read the catalog under the read lock,
+# while it is loaded and updated under the write lock
+catalog_lock = ReadWriteLock()
+
+def init_catalog():
+    """Load the catalog, goals and search engine on the first request"""
     global all_products, product_item_dict, \
            product_prices, attribute_to_asins, \
-           search_engine, \
-           goals, weights, user_sessions
+           keyword_index, search_engine, \
+           goals, weights
 
-    if search_engine is None:
+    if SHARED_CATALOG is not None:
+        catalog = attach_catalog(SHARED_CATALOG)
+        all_products = catalog.all_products
+        product_item_dict = catalog.product_item_dict
+        product_prices = catalog.product_prices
+        attribute_to_asins = catalog.attribute_to_asins
+        keyword_index = catalog.keyword_index
+        goals = catalog.goals
+        asins = catalog.get_asins()
+    else:
         all_products, product_item_dict, product_prices, attribute_to_asins = \
             load_products(
                 filepath=DEFAULT_FILE_PATH,
                 num_products=DEBUG_PROD_SIZE
             )
-        search_engine = init_search_engine(num_products=DEBUG_PROD_SIZE)
+        keyword_index = build_keyword_index(all_products)
         goals = get_goals(all_products, product_prices)
-        random.seed(233)
-        random.shuffle(goals)
-        weights = [goal['weight'] for goal in goals]
+        asins = None
+    random.seed(233)
+    random.shuffle(goals)
+    weights = get_goal_weights(goals)
+    # Set last: other threads treat a search engine as a loaded catalog
+    search_engine = init_search_engine(
+        num_products=DEBUG_PROD_SIZE,
+        backend=SEARCH_BACKEND,
+        all_products=all_products,
+        asins=asins,
+    )
+
+def reads_catalog(route):
+    """Load the catalog on the first request, then serve `route` under the read lock"""
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if search_engine is None:
+            with catalog_lock.write():
+                if search_engine is None:
+                    init_catalog()
+        with catalog_lock.read():
+            return route(*args, **kwargs)
+    return wrapper
+
+@app.route('/')
+def home():
+    return redirect(url_for('index', session_id="abc"))
+
+@app.route('/<session_id>', methods=['GET', 'POST'])
+@reads_catalog
+def index(session_id):
+    global user_log_dir
 
     if session_id not in user_sessions and 'fixed' in session_id:
         goal_idx = int(session_id.split('_')[-1])
@@ -100,6 +194,7 @@ def index(session_id):
         )))
     return map_action_to_html(
         'start',
+        renderer=renderer,
         session_id=session_id,
         instruction_text=instruction_text,
     )
@@ -109,25 +204,31 @@ def index(session_id):
     '/search_results/<session_id>/<keywords>/<page>',
     methods=['GET', 'POST']
 )
+@reads_catalog
 def search_results(session_id, keywords, page):
     instruction_text = user_sessions[session_id]['goal']['instruction_text']
     page = convert_web_app_string_to_var('page', page)
     keywords = convert_web_app_string_to_var('keywords', keywords)
-    top_n_products = get_top_n_product_from_keywords(
+    results = get_search_results(
         keywords,
         search_engine,
         all_products,
         product_item_dict,
         attribute_to_asins,
+        keyword_index,
+        search_cache,
+        page=page,
+        search_depth=SEARCH_DEPTH,
     )
-    products = get_product_per_page(top_n_products, page)
+    products = results.get_page(page, product_item_dict)
     html = map_action_to_html(
         'search',
+        renderer=renderer,
         session_id=session_id,
         products=products,
         keywords=keywords,
         page=page,
-        total=len(top_n_products),
+        total=results.total,
         instruction_text=instruction_text,
     )
     logger = logging.getLogger(session_id)
@@ -149,15 +250,18 @@ def search_results(session_id, keywords, page):
     '/item_page/<session_id>/<asin>/<keywords>/<page>/<options>',
     methods=['GET', 'POST']
 )
+@reads_catalog
 def item_page(session_id, asin, keywords, page, options):
     options = literal_eval(options)
     product_info = product_item_dict[asin]
 
+    # Products are shared by requests (and read-only in a shared catalog), so
+    # the instruction is passed to the template instead of set on the product
     goal_instruction = user_sessions[session_id]['goal']['instruction_text']
-    product_info['goal_instruction'] = goal_instruction
 
     html = map_action_to_html(
         'click',
+        renderer=renderer,
         session_id=session_id,
         product_info=product_info,
         keywords=keywords,
@@ -187,15 +291,18 @@ def item_page(session_id, asin, keywords, page, options):
     '/item_sub_page/<session_id>/<asin>/<keywords>/<page>/<sub_page>/<options>',
     methods=['GET', 'POST']
 )
+@reads_catalog
 def item_sub_page(session_id, asin, keywords, page, sub_page, options):
     options = literal_eval(options)
     product_info = product_item_dict[asin]
 
+    # Products are shared by requests (and read-only in a shared catalog), so
+    # the instruction is passed to the template instead of set on the product
     goal_instruction = user_sessions[session_id]['goal']['instruction_text']
-    product_info['goal_instruction'] = goal_instruction
 
     html = map_action_to_html(
         f'click[{sub_page}]',
+        renderer=renderer,
         session_id=session_id,
         product_info=product_info,
         keywords=keywords,
@@ -221,6 +328,7 @@ def item_sub_page(session_id, asin, keywords, page, sub_page, options):
 
 
 @app.route('/done/<session_id>/<asin>/<options>', methods=['GET', 'POST'])
+@reads_catalog
 def done(session_id, asin, options):
     options = literal_eval(options)
     goal = user_sessions[session_id]['goal']
@@ -256,6 +364,7 @@ def done(session_id, asin, options):
     
     return map_action_to_html(
         f'click[{END_BUTTON}]',
+        renderer=renderer,
         session_id=session_id,
         reward=reward,
         asin=asin,
@@ -271,15 +380,64 @@ def done(session_id, asin, options):
     )
 
 
+@app.route('/catalog/update', methods=['POST'])
+def update_catalog():
+    """Apply the catalog delta in the request body (see `catalog_update`) in place"""
+    global goals, weights
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+    if SHARED_CATALOG is not None:
+        abort(409, 'A shared catalog is read-only and cannot be updated in place.')
+    if search_engine is None:
+        abort(409, 'The catalog has not been loaded yet.')
+    delta = request.get_json(force=True)
+    try:
+        validate_catalog_delta(delta)
+    except ValueError as e:
+        abort(400, str(e))
+
+    with catalog_lock.write():
+        changed, removed = apply_catalog_delta(
+            delta,
+            all_products,
+            product_item_dict,
+            product_prices,
+            attribute_to_asins,
+            keyword_index=keyword_index,
+        )
+        stale = set(changed) | set(removed)
+        goals = [goal for goal in goals if goal['asin'] not in stale]
+        goals += get_goals(
+            [product_item_dict[asin] for asin in changed],
+            product_prices,
+        )
+        weights = [goal['weight'] for goal in goals]
+        search_engine.update(
+            [product_item_dict[asin] for asin in changed],
+            removed,
+        )
+        search_cache.clear()
+    return jsonify(changed=changed, removed=removed)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="WebShop flask app backend configuration")
     parser.add_argument("--log", action='store_true', help="Log actions on WebShop in trajectory file")
     parser.add_argument("--attrs", action='store_true', help="Show attributes tab in item page")
+    parser.add_argument("--shared_catalog", default=None, help="Attach to the catalog published under this shared memory name")
+    parser.add_argument("--search_backend", default='lucene', choices=SEARCH_BACKENDS, help="Search backend for free-text searches")
+    parser.add_argument("--search_service", default=None, help="Address (Unix socket path or host:port) of the search service used by the remote backend")
+    parser.add_argument("--search_depth", type=int, default=SEARCH_RETURN_N, help="Maximum number of results of a free-text search, 0 for no limit")
 
     args = parser.parse_args()
     if args.log:
         user_log_dir = Path('user_session_logs/mturk')
         user_log_dir.mkdir(parents=True, exist_ok=True)
     SHOW_ATTRS_TAB = args.attrs
+    SHARED_CATALOG = args.shared_catalog
+    SEARCH_BACKEND = args.search_backend
+    if SEARCH_BACKEND == 'remote' and args.search_service is not None:
+        SEARCH_BACKEND = RemoteSearchBackend(parse_address(args.search_service))
+    SEARCH_DEPTH = args.search_depth or None
 
-    app.run(host='0.0.0.0', port=3000)
+    app.run(host='0.0.0.0', port=3000, threaded=True)
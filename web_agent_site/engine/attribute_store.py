@@ -0,0 +1,123 @@
+"""
+Indexed, lazily read stores for the per-asin attribute and instruction files.
+
+`DEFAULT_ATTR_PATH` and `HUMAN_ATTR_PATH` map asins to JSON values that are
+only ever looked up one asin at a time. Instead of parsing them in full on
+every start, `open_attribute_store` builds a sidecar next to the source file
+once: a data file with each value serialized back to back, and a sorted asin
+index of offsets into it. Lookups decode a single value from the memory-mapped
+data file.
+"""
+import json
+import mmap
+import os
+import tempfile
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import numpy as np
+from rich import print
+
+
+def sidecar_paths(filepath):
+    return f'{filepath}.index.npz', f'{filepath}.values'
+
+
+def source_signature(filepath):
+    stat = os.stat(filepath)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+@contextmanager
+def atomic_write(path):
+    """Open a temporary file that replaces `path` once it is fully written"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def build_attribute_store(filepath):
+    """Build the sidecar index and data files for the JSON object at `filepath`"""
+    index_path, data_path = sidecar_paths(filepath)
+    with open(filepath) as f:
+        values = json.load(f)
+    keys = sorted(values)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    # Sidecars are written to temporary files and moved into place, since
+    # other processes may be reading the previous ones through a memory map
+    with atomic_write(data_path) as f:
+        for i, key in enumerate(keys):
+            data = json.dumps(values[key]).encode()
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    keys = np.array([key.encode() for key in keys], dtype=bytes)
+    # Replaced last so that an interrupted build is detected as stale
+    with atomic_write(index_path) as f:
+        np.savez(f, keys=keys, offsets=offsets, signature=source_signature(filepath))
+    print(f'Built attribute store for {filepath} ({len(keys)} entries).')
+
+
+def open_attribute_store(filepath):
+    """
+    Open the indexed store for `filepath`, building its sidecar first if it is
+    missing or older than the source file
+    """
+    index_path, _ = sidecar_paths(filepath)
+    signature = source_signature(filepath)
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            if np.array_equal(index['signature'], signature):
+                return IndexedJsonStore(filepath)
+    build_attribute_store(filepath)
+    return IndexedJsonStore(filepath)
+
+
+class IndexedJsonStore(Mapping):
+    """Read-only mapping from asin to the JSON value stored for it"""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        index_path, data_path = sidecar_paths(filepath)
+        with np.load(index_path) as index:
+            self.index_keys = index['keys']
+            self.offsets = index['offsets']
+        with open(data_path, 'rb') as f:
+            # mmap rejects empty files, which only occur for empty stores
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if len(self.index_keys) else b''
+
+    def position(self, key):
+        try:
+            key_bytes = key.encode()
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        if len(key_bytes) > self.index_keys.itemsize:
+            return None
+        pos = int(np.searchsorted(self.index_keys, key_bytes))
+        if pos < len(self.index_keys) and self.index_keys[pos] == key_bytes:
+            return pos
+        return None
+
+    def __getitem__(self, key):
+        # Decoded on every lookup, so callers own the value and may change it
+        pos = self.position(key)
+        if pos is None:
+            raise KeyError(key)
+        return json.loads(self.data[self.offsets[pos]:self.offsets[pos + 1]])
+
+    def __contains__(self, key):
+        return self.position(key) is not None
+
+    def __iter__(self):
+        return (key.decode() for key in self.index_keys)
+
+    def __len__(self):
+        return len(self.index_keys)
+
+    def __reduce__(self):
+        # Reopen from the sidecar rather than pickling the memory map
+        return IndexedJsonStore, (self.filepath,)
@@ -0,0 +1,393 @@
+"""
+Product catalog storage: compiled catalogs and streaming product readers.
+
+`load_products` spends most of its time parsing the raw items file and
+normalizing every product. `compile_catalog` runs that work once, offline, and
+writes the normalized outputs to a binary file that `load_catalog` can open
+in a single read. `load_products` recognizes compiled catalogs by their magic
+header, so a compiled file can be passed anywhere a raw items file is used:
+
+    python -m web_agent_site.engine.catalog \
+        --input data/items_shuffle.json --output data/items_shuffle.catalog
+"""
+import argparse
+import gc
+import json
+import mmap
+import pickle
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+from collections.abc import MutableMapping
+
+from rich import print
+
+from web_agent_site.engine.price_table import PriceTable
+
+CATALOG_MAGIC = b'WEBSHOP-CATALOG\x01'
+CATALOG_PROTOCOL = pickle.HIGHEST_PROTOCOL
+READ_CHUNK_SIZE = 1 << 20
+# Lazy records decoded most recently, e.g. of the products on the pages being rendered
+BLOB_CACHE_SIZE = 64
+
+# Large fields that are only needed when a product page is rendered. Lazy
+# catalogs keep these in a memory-mapped blob instead of resident memory.
+LAZY_FIELDS = (
+    'Description',
+    'BulletPoints',
+    'Reviews',
+    'option_to_image',
+    'MainImage',
+    'full_description',
+    'small_description',
+    'images',
+    'customization_options',
+)
+
+
+def iter_json_array(filepath, chunk_size=READ_CHUNK_SIZE):
+    """
+    Lazily yield the elements of the JSON array stored in `filepath`, reading
+    the file in chunks so that memory is bounded by the largest element
+    """
+    decoder = json.JSONDecoder()
+    with open(filepath) as f:
+        buf = f.read(chunk_size).lstrip()
+        while not buf:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buf = chunk.lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f'{filepath} does not contain a JSON array.')
+        pos = 1
+        eof = False
+        while True:
+            # Skip whitespace and the separator preceding the next element
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf, pos = f.read(chunk_size), 0
+                eof = not buf
+            if pos >= len(buf):
+                raise ValueError(f'{filepath} ended before the JSON array was closed.')
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield element
+            pos = end
+
+
+def is_compiled_catalog(filepath):
+    """Check whether `filepath` holds a catalog written by `save_catalog`"""
+    with open(filepath, 'rb') as f:
+        return f.read(len(CATALOG_MAGIC)) == CATALOG_MAGIC
+
+
+def save_catalog(
+        filepath,
+        all_products,
+        product_prices,
+        attribute_to_asins,
+        positions,
+        human_goals=True,
+        lazy=False,
+        compress=False,
+    ):
+    """
+    Write normalized catalog outputs to `filepath`
+
+    Arguments:
+    positions (`list`) -- Index of each product in the raw items file, used
+        to serve `num_products` subsets identical to slicing the raw file
+    human_goals (`bool`) -- Whether products were normalized for human goals
+    lazy (`bool`) -- Store `LAZY_FIELDS` in a `<filepath>.blob` sidecar that is
+        memory-mapped on load, and load products as `LazyProduct` records
+    compress (`bool`) -- Compress each product's entry in the blob with zlib
+    """
+    catalog = {
+        'human_goals': bool(human_goals),
+        'all_products': all_products,
+        'product_prices': product_prices,
+        'attribute_to_asins': dict(attribute_to_asins),
+        'positions': positions,
+        'blob': None,
+    }
+    if lazy:
+        catalog['all_products'] = write_product_blob(
+            blob_path(filepath), all_products, compress
+        )
+        catalog['blob'] = {'compress': compress}
+    with open(filepath, 'wb') as f:
+        f.write(CATALOG_MAGIC)
+        pickle.dump(catalog, f, protocol=CATALOG_PROTOCOL)
+
+
+def read_catalog(filepath):
+    with open(filepath, 'rb') as f:
+        if f.read(len(CATALOG_MAGIC)) != CATALOG_MAGIC:
+            raise ValueError(f'{filepath} is not a compiled catalog.')
+        # Unpickling allocates millions of containers; collector passes over
+        # them are pure overhead since the catalog holds no reference cycles
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            catalog = pickle.load(f)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    return catalog
+
+
+def load_catalog(filepath, num_products=None, human_goals=True):
+    """
+    Load a compiled catalog, returning the same outputs as `load_products`
+    """
+    catalog = read_catalog(filepath)
+    if catalog['human_goals'] != bool(human_goals):
+        raise ValueError(
+            f'{filepath} was compiled with human_goals={catalog["human_goals"]}, '
+            f'recompile it to load with human_goals={bool(human_goals)}.'
+        )
+    all_products = get_catalog_products(filepath, catalog)
+    product_prices = catalog['product_prices']
+    if not isinstance(product_prices, PriceTable):
+        # Catalogs compiled before price tables store a plain dict
+        product_prices = PriceTable(
+            [asin.encode() for asin in product_prices], list(product_prices.values())
+        )
+    attribute_to_asins = catalog['attribute_to_asins']
+    if num_products is not None:
+        all_products = [
+            p for p, i in zip(all_products, catalog['positions'])
+            if i < num_products
+        ]
+        product_prices = product_prices.subset([p['asin'] for p in all_products])
+        attribute_to_asins = defaultdict(set)
+        for p in all_products:
+            for a in p['Attributes']:
+                attribute_to_asins[a].add(p['asin'])
+    else:
+        attribute_to_asins = defaultdict(set, attribute_to_asins)
+    product_item_dict = {p['asin']: p for p in all_products}
+    print(f'Catalog loaded ({len(all_products)} products).')
+    return all_products, product_item_dict, product_prices, attribute_to_asins
+
+
+def get_catalog_products(filepath, catalog):
+    """Products of the catalog read from `filepath`, as `LazyProduct`s if it is lazy"""
+    if catalog['blob'] is None:
+        return catalog['all_products']
+    blob = ProductBlob(blob_path(filepath), **catalog['blob'])
+    return [
+        LazyProduct(fields, blob, offset, length)
+        for fields, offset, length in catalog['all_products']
+    ]
+
+
+def iter_catalog(filepath):
+    """
+    Yield the products of the compiled catalog at `filepath` along with their
+    positions in the raw items file it was compiled from
+    """
+    catalog = read_catalog(filepath)
+    yield from zip(catalog['positions'], get_catalog_products(filepath, catalog))
+
+
+def blob_path(filepath):
+    return f'{filepath}.blob'
+
+
+def write_product_blob(filepath, all_products, compress=False):
+    """
+    Write the `LAZY_FIELDS` of each product to the blob at `filepath`. Returns
+    `(fields, offset, length)` records holding the remaining fields in memory
+    and the location of the product's entry in the blob.
+    """
+    records = []
+    offset = 0
+    with open(filepath, 'wb') as f:
+        for p in all_products:
+            fields = {k: v for k, v in p.items() if k not in LAZY_FIELDS}
+            lazy_fields = {k: p[k] for k in LAZY_FIELDS if k in p}
+            data = pickle.dumps(lazy_fields, protocol=CATALOG_PROTOCOL)
+            if compress:
+                data = zlib.compress(data)
+            f.write(data)
+            records.append((fields, offset, len(data)))
+            offset += len(data)
+    return records
+
+
+class ProductBlob:
+    """
+    Read-only, memory-mapped store of the lazy fields of each product. The
+    records decoded last are cached, so the many field accesses of rendering
+    one product decode its record once. Cached records are shared: they must
+    not be modified.
+    """
+    def __init__(self, filepath, compress=False, cache_size=BLOB_CACHE_SIZE):
+        self.filepath = filepath
+        self.compress = compress
+        with open(filepath, 'rb') as f:
+            # mmap rejects empty files, which only occur for empty catalogs
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if f.seek(0, 2) else b''
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        # Reopen the blob rather than pickling the memory map
+        return ProductBlob, (self.filepath, self.compress, self.cache_size)
+
+    def decode(self, offset, length):
+        """Decode a record into a new dict, bypassing the cache"""
+        data = self.data[offset:offset + length]
+        if self.compress:
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    def read(self, offset, length):
+        with self.lock:
+            record = self.cache.get(offset)
+            if record is not None:
+                self.cache.move_to_end(offset)
+                return record
+        record = self.decode(offset, length)
+        with self.lock:
+            self.cache[offset] = record
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return record
+
+
+class LazyProduct(MutableMapping):
+    """
+    Product record that keeps small fields in memory and reads `LAZY_FIELDS`
+    from a `ProductBlob` on access. Supports the same key access as the
+    product dicts returned by `load_products`; `materialize` before modifying
+    the value of a lazy field in place.
+    """
+    __slots__ = ('fields', 'blob', 'offset', 'length')
+
+    def __init__(self, fields, blob, offset, length):
+        self.fields = fields
+        self.blob = blob
+        self.offset = offset
+        self.length = length
+
+    def lazy_fields(self):
+        if self.blob is None:
+            return {}
+        return self.blob.read(self.offset, self.length)
+
+    def materialize(self):
+        """Move the lazy fields into memory, e.g. before modifying them"""
+        if self.blob is not None:
+            # Not the cached record, which other readers share
+            self.fields = {**self.blob.decode(self.offset, self.length), **self.fields}
+            self.blob = None
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        if self.blob is not None and key in LAZY_FIELDS:
+            lazy_fields = self.lazy_fields()
+            if key in lazy_fields:
+                return lazy_fields[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in LAZY_FIELDS:
+            self.materialize()
+        self.fields[key] = value
+
+    def __delitem__(self, key):
+        if key in LAZY_FIELDS:
+            self.materialize()
+        del self.fields[key]
+
+    def __iter__(self):
+        yield from self.fields
+        yield from (k for k in self.lazy_fields() if k not in self.fields)
+
+    def __len__(self):
+        return len(self.fields) + sum(
+            k not in self.fields for k in self.lazy_fields()
+        )
+
+    def __contains__(self, key):
+        if key in self.fields:
+            return True
+        return key in LAZY_FIELDS and key in self.lazy_fields()
+
+    def __reduce__(self):
+        # Pickle as a plain dict so records can leave the process
+        return dict, (dict(self),)
+
+    def __repr__(self):
+        return f'LazyProduct({self.fields!r})'
+
+
+def compile_catalog(
+        input_path,
+        output_path,
+        human_goals=True,
+        lazy=False,
+        compress=False,
+    ):
+    """Normalize the raw items file at `input_path` and save it as a catalog"""
+    from web_agent_site.engine.engine import (
+        build_attribute_to_asins,
+        clean_product_keys,
+        generate_product_prices,
+        load_attributes,
+        normalize_products,
+    )
+    with open(input_path) as f:
+        products = json.load(f)
+    print('Products loaded.')
+    products = clean_product_keys(products)
+    attributes, human_attributes = load_attributes(human_goals)
+    all_products, positions = normalize_products(
+        products, attributes, human_attributes, human_goals
+    )
+    save_catalog(
+        output_path,
+        all_products,
+        generate_product_prices(all_products),
+        build_attribute_to_asins(all_products),
+        positions,
+        human_goals=human_goals,
+        lazy=lazy,
+        compress=compress,
+    )
+    print(f'Compiled {len(all_products)} products to {output_path}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the WebShop product catalog')
+    parser.add_argument('--input', required=True, help='Raw items file (e.g. items_shuffle.json)')
+    parser.add_argument('--output', required=True, help='Destination of the compiled catalog')
+    parser.add_argument('--synthetic_goals', action='store_true', help='Normalize for synthetic instead of human goals')
+    parser.add_argument('--lazy', action='store_true', help='Keep large text fields in a memory-mapped blob')
+    parser.add_argument('--compress', action='store_true', help='Compress the blob used by --lazy')
+    args = parser.parse_args()
+    compile_catalog(
+        args.input,
+        args.output,
+        human_goals=not args.synthetic_goals,
+        lazy=args.lazy,
+        compress=args.compress,
+    )
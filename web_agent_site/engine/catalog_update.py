@@ -0,0 +1,164 @@
+"""
+Incremental updates of a loaded catalog and its search index.
+
+A catalog delta is a JSON object with any of the keys
+
+    {
+        "upsert": [raw products, in the format of `DEFAULT_FILE_PATH`],
+        "remove": [asins],
+        "prices": {asin: price},
+        "attributes": {asin: attributes entry for upserted products},
+        "human_attributes": {asin: human instructions for upserted products}
+    }
+
+`apply_catalog_delta` applies a delta in place to the structures returned by
+`load_products`, and the `update` method of the search backends applies it to
+their index, so neither the catalog nor the index has to be rebuilt from
+scratch. Replaced products are updated in place, so the lists and dicts
+holding them need not be searched. Apart from a single pass over
+`all_products` to find removed products, the cost of an update scales with
+the size of the delta.
+
+Updates last for the lifetime of the process: the products file and the
+search indexes on disk are left unchanged (see `LuceneBackend.update`).
+"""
+import json
+from collections import ChainMap
+
+from rich import print
+
+from web_agent_site.engine.engine import (
+    clean_product_keys,
+    generate_product_prices,
+    load_attributes,
+    normalize_products,
+    update_keyword_index,
+)
+
+DELTA_KEYS = {'upsert', 'remove', 'prices', 'attributes', 'human_attributes'}
+
+
+def load_catalog_delta(filepath):
+    with open(filepath) as f:
+        delta = json.load(f)
+    validate_catalog_delta(delta)
+    return delta
+
+
+def validate_catalog_delta(delta):
+    if not isinstance(delta, dict):
+        raise ValueError('A catalog delta must be a JSON object.')
+    unknown = set(delta) - DELTA_KEYS
+    if unknown:
+        raise ValueError(f'Unknown catalog delta keys: {sorted(unknown)}.')
+
+
+def format_price_tag(pricing):
+    if len(pricing) == 1:
+        return f'${pricing[0]}'
+    return f'${pricing[0]} to ${pricing[1]}'
+
+
+def apply_catalog_delta(
+        delta,
+        all_products,
+        product_item_dict,
+        product_prices,
+        attribute_to_asins,
+        human_goals=True,
+        attributes=None,
+        human_attributes=None,
+        keyword_index=None,
+    ):
+    """
+    Apply `delta` in place to a catalog loaded with `load_products`. Returns
+    the asins of the products that were added or changed, and of those removed.
+
+    Arguments:
+    human_goals (`bool`) -- Whether the catalog was loaded for human goals
+    attributes (`Mapping`) -- Attributes to normalize upserted products with,
+        by default those at `DEFAULT_ATTR_PATH`
+    human_attributes (`Mapping`) -- Human instructions to normalize upserted
+        products with, by default those at `HUMAN_ATTR_PATH`
+    keyword_index (`dict`) -- Index built with `build_keyword_index` to update
+    """
+    validate_catalog_delta(delta)
+    if attributes is None or (human_goals and human_attributes is None):
+        default_attributes, default_human_attributes = load_attributes(human_goals)
+        attributes = default_attributes if attributes is None else attributes
+        if human_attributes is None:
+            human_attributes = default_human_attributes
+    attributes = ChainMap(delta.get('attributes', {}), attributes)
+    human_attributes = ChainMap(delta.get('human_attributes', {}), human_attributes)
+
+    products = clean_product_keys(list(delta.get('upsert', [])))
+    new_products, _ = normalize_products(
+        products, attributes, human_attributes, human_goals
+    )
+    new_asins = {p['asin'] for p in new_products}
+    removed = [
+        asin for asin in dict.fromkeys(delta.get('remove', []))
+        if asin in product_item_dict and asin not in new_asins
+    ]
+
+    # Products are dropped from the attribute and keyword indexes before being
+    # replaced or removed, then the new versions are added back
+    removed_ids = set()
+    for asin in removed:
+        old = product_item_dict.pop(asin)
+        removed_ids.add(id(old))
+        product_prices.pop(asin, None)
+        discard_attributes(attribute_to_asins, asin, old['Attributes'])
+        if keyword_index is not None:
+            update_keyword_index(keyword_index, old_product=old)
+    for p in new_products:
+        asin = p['asin']
+        old = product_item_dict.get(asin)
+        if keyword_index is not None:
+            update_keyword_index(keyword_index, old_product=old, new_product=p)
+        if old is None:
+            all_products.append(p)
+            product_item_dict[asin] = p
+        else:
+            discard_attributes(attribute_to_asins, asin, old['Attributes'])
+            replace_product(old, p)
+        for a in p['Attributes']:
+            attribute_to_asins[a].add(asin)
+
+    if removed_ids:
+        positions = [i for i, p in enumerate(all_products) if id(p) in removed_ids]
+        for i in reversed(positions):
+            del all_products[i]
+    product_prices.update(generate_product_prices(new_products))
+
+    # In delta order, so the goals of the changed products are too
+    changed = list(dict.fromkeys(p['asin'] for p in new_products))
+    for asin, price in delta.get('prices', {}).items():
+        if asin not in product_item_dict:
+            print(f'Skipping price of unknown product {asin}.')
+            continue
+        p = product_item_dict[asin]
+        p['pricing'] = [float(price)]
+        p['Price'] = format_price_tag(p['pricing'])
+        product_prices[asin] = float(price)
+        if asin not in new_asins:
+            changed.append(asin)
+
+    print(f'Catalog updated: {len(changed)} changed, {len(removed)} removed.')
+    return changed, removed
+
+
+def replace_product(old, new):
+    """Replace the fields of `old` with those of `new` in place"""
+    old.clear()
+    old.update(new)
+
+
+def discard_attributes(attribute_to_asins, asin, attributes):
+    for a in attributes:
+        asins = attribute_to_asins.get(a)
+        if asins is None:
+            continue
+        asins.discard(asin)
+        if not asins:
+            del attribute_to_asins[a]
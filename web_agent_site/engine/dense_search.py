@@ -0,0 +1,399 @@
+"""
+Dense and hybrid retrieval for free-text searches.
+
+Long natural-language queries, such as whole instructions, share few terms
+with product documents and retrieve poorly with BM25 alone. `DenseBackend`
+embeds documents and queries with a sentence encoder and searches a faiss
+index of the document embeddings, and `HybridBackend` fuses its ranking with
+the ranking of a lexical backend.
+
+Document embeddings are computed offline, once:
+
+    python -m web_agent_site.engine.dense_search \
+        --input search_engine/resources \
+        --output search_engine/indexes_dense \
+        --index_type hnsw
+
+`--index_type` trades memory and latency against recall on CPU: `flat` is
+exact, `hnsw` is the fastest to query but keeps full vectors and a graph, and
+`ivfpq` compresses each vector to `--pq_m` bytes. At query time, `nprobe`
+(IVF) and `ef_search` (HNSW) of `DenseBackend` set the same trade-off, and
+`threads` the number of faiss threads. Searches restricted to a catalog
+subset of up to `SUBSET_INDEX_SIZE` documents run exactly over a flat index
+of the subset; larger subsets, and searches skipping deleted documents, pass
+the searchable rows to faiss as an `IDSelectorBitmap`. Either way a search
+takes one pass. faiss and transformers are only imported when a dense index
+is built or opened.
+"""
+import argparse
+import json
+import math
+import os
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+from rich import print
+from tqdm import tqdm
+
+from web_agent_site.engine.search_backends import (
+    Hit,
+    SearchBackend,
+    build_search_document,
+    iter_documents,
+)
+
+DENSE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+DENSE_INDEX_TYPES = ('flat', 'hnsw', 'ivf', 'ivfpq')
+ENCODE_BATCH_SIZE = 64
+ENCODE_CHUNK_SIZE = 10000
+MAX_TOKENS = 256
+HNSW_M = 32
+IVF_NLIST = 4096
+PQ_M = 16
+NPROBE = 16
+EF_SEARCH = 64
+QUERY_CACHE_SIZE = 4096
+# Subsets up to this size get an exact flat index of their own (4 bytes per
+# dimension per document), larger ones are filtered inside the full index
+SUBSET_INDEX_SIZE = 100000
+# Every document is similar to a query to some degree, so the results of a
+# dense ranking are counted up to this depth rather than across the catalog
+DENSE_COUNT_DEPTH = 50
+HYBRID_CANDIDATES = 100
+RRF_K = 60
+
+
+class TextEncoder:
+    """Mean-pooled, normalized embeddings of a transformers sentence encoder"""
+    def __init__(self, model_name=DENSE_MODEL, batch_size=ENCODE_BATCH_SIZE, max_length=MAX_TOKENS, device='cpu'):
+        from transformers import AutoModel, AutoTokenizer
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to(device).eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts):
+        import torch
+        embeddings = [np.zeros((0, self.dim), dtype=np.float32)]
+        with torch.no_grad():
+            for i in range(0, len(texts), self.batch_size):
+                batch = self.tokenizer(
+                    texts[i:i + self.batch_size],
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_length,
+                    return_tensors='pt',
+                ).to(self.device)
+                hidden = self.model(**batch).last_hidden_state
+                mask = batch['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+                pooled = torch.nn.functional.normalize(pooled, dim=-1)
+                embeddings.append(pooled.cpu().numpy().astype(np.float32))
+        return np.concatenate(embeddings)
+
+
+def build_faiss_index(embeddings, index_type='hnsw', hnsw_m=HNSW_M, nlist=IVF_NLIST, pq_m=PQ_M):
+    """
+    Build an inner-product faiss index of normalized `embeddings`
+
+    Arguments:
+    index_type (`str`) -- One of `DENSE_INDEX_TYPES`
+    nlist (`int`) -- Number of IVF lists, capped for small catalogs
+    pq_m (`int`) -- Bytes per vector of `ivfpq` indexes; must divide the dimension
+    """
+    import faiss
+    dim = embeddings.shape[1]
+    if index_type == 'flat':
+        index = faiss.IndexFlatIP(dim)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    elif index_type in ('ivf', 'ivfpq'):
+        nlist = max(1, min(nlist, int(4 * math.sqrt(len(embeddings)))))
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == 'ivf':
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+    else:
+        raise ValueError(f'Unknown dense index type {index_type}, expected one of {DENSE_INDEX_TYPES}.')
+    index.add(embeddings)
+    return index
+
+
+class DenseBackend(SearchBackend):
+    """
+    Nearest-neighbor search over document embeddings. Every document has a
+    similarity to the query, so `count` caps matches at `DENSE_COUNT_DEPTH`.
+
+    Arguments:
+    asins (`list`) -- If given, only these documents are searched
+    nprobe (`int`) -- IVF lists visited per query; more is slower and more exact
+    ef_search (`int`) -- HNSW candidate list size; more is slower and more exact
+    threads (`int`) -- Number of faiss threads, or None for all cores
+    """
+    def __init__(
+            self,
+            index,
+            doc_asins,
+            encoder,
+            asins=None,
+            nprobe=NPROBE,
+            ef_search=EF_SEARCH,
+            threads=None,
+            live=None,
+        ):
+        import faiss
+        self.index = index
+        self.doc_asins = np.asarray(doc_asins, dtype=str)
+        self.encoder = encoder
+        # Rows of documents that were not deleted by updates
+        self.live = np.ones(len(self.doc_asins), dtype=bool) if live is None else live
+        self.rows = None
+        self.query_cache = OrderedDict()
+        self.query_cache_lock = threading.Lock()
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        if hasattr(index, 'hnsw'):
+            index.hnsw.efSearch = ef_search
+        try:
+            index_ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            self.is_ivf = False
+        else:
+            self.is_ivf = True
+            index_ivf.nprobe = nprobe
+            # Lets the vectors of subset indexes be reconstructed
+            index_ivf.make_direct_map()
+        if threads is not None:
+            faiss.omp_set_num_threads(threads)
+        self.set_filter(asins)
+
+    @classmethod
+    def from_documents(cls, documents, encoder=None, index_type='hnsw', index_params=None, **kwargs):
+        """
+        Embed `documents` with `id` and `contents` fields and index them
+
+        Arguments:
+        index_params (`dict`) -- Keyword arguments of `build_faiss_index`
+        """
+        encoder = TextEncoder() if encoder is None else encoder
+        doc_asins, embeddings, contents = [], [], []
+        for doc in tqdm(documents):
+            doc_asins.append(doc['id'])
+            contents.append(doc['contents'])
+            if len(contents) == ENCODE_CHUNK_SIZE:
+                embeddings.append(encoder.encode(contents))
+                contents = []
+        embeddings.append(encoder.encode(contents))
+        index = build_faiss_index(np.concatenate(embeddings), index_type, **(index_params or {}))
+        return cls(index, doc_asins, encoder, **kwargs)
+
+    @classmethod
+    def from_products(cls, all_products, encoder=None, index_type='hnsw', index_params=None, **kwargs):
+        return cls.from_documents(
+            (build_search_document(p, lean=True) for p in all_products),
+            encoder,
+            index_type,
+            index_params,
+            **kwargs,
+        )
+
+    @classmethod
+    def load(cls, index_dir, encoder=None, **kwargs):
+        import faiss
+        with open(os.path.join(index_dir, 'config.json')) as f:
+            config = json.load(f)
+        encoder = TextEncoder(config['model']) if encoder is None else encoder
+        index = faiss.read_index(os.path.join(index_dir, 'index.faiss'))
+        doc_asins = np.load(os.path.join(index_dir, 'asins.npy'))
+        live = np.load(os.path.join(index_dir, 'live.npy'))
+        backend = cls(index, doc_asins, encoder, live=live, **kwargs)
+        print(f'Dense index loaded from {index_dir} ({int(backend.live.sum())} documents).')
+        return backend
+
+    def save(self, index_dir):
+        import faiss
+        os.makedirs(index_dir, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(index_dir, 'index.faiss'))
+        np.save(os.path.join(index_dir, 'asins.npy'), self.doc_asins)
+        np.save(os.path.join(index_dir, 'live.npy'), self.live)
+        with open(os.path.join(index_dir, 'config.json'), 'w') as f:
+            json.dump({'model': getattr(self.encoder, 'model_name', DENSE_MODEL)}, f)
+
+    def set_filter(self, asins):
+        """Restrict hits to `asins`, or search all documents if None"""
+        import faiss
+        self.asins = set(asins) if asins is not None else None
+        searchable = self.live.copy()
+        if self.asins is not None:
+            searchable &= np.isin(self.doc_asins, np.array(sorted(self.asins), dtype=str))
+        rows = np.flatnonzero(searchable)
+        # (index, rows of its ids or None, selector and its bitmap or None),
+        # swapped in as one reference so concurrent searches see one state
+        if len(rows) == len(searchable):
+            self.search_state = (self.index, None, None)
+        elif len(rows) <= SUBSET_INDEX_SIZE:
+            subset_index = faiss.IndexFlatIP(self.index.d)
+            if len(rows):
+                subset_index.add(self.index.reconstruct_batch(rows))
+            self.search_state = (subset_index, rows, None)
+        else:
+            # faiss only keeps a pointer to the bitmap, so it is kept with the selector
+            bitmap = np.packbits(searchable, bitorder='little')
+            selector = faiss.IDSelectorBitmap(len(searchable), faiss.swig_ptr(bitmap))
+            self.search_state = (self.index, None, (selector, bitmap))
+        self.num_searchable = len(rows)
+
+    def get_search_params(self, selector, k, num_searchable):
+        """faiss search parameters restricting a search for `k` neighbors to `selector`"""
+        import faiss
+        if hasattr(self.index, 'hnsw'):
+            # The graph search visits filtered out documents too, so it keeps
+            # as many more candidates as there are documents per searchable one
+            ef_search = self.ef_search * self.index.ntotal // num_searchable
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=max(ef_search, k))
+        if self.is_ivf:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+        return faiss.SearchParameters(sel=selector)
+
+    def encode_query(self, query):
+        with self.query_cache_lock:
+            vector = self.query_cache.get(query)
+        if vector is None:
+            vector = self.encoder.encode([query])
+            with self.query_cache_lock:
+                self.query_cache[query] = vector
+                if len(self.query_cache) > QUERY_CACHE_SIZE:
+                    self.query_cache.popitem(last=False)
+        return vector
+
+    def clear_cache(self):
+        with self.query_cache_lock:
+            self.query_cache.clear()
+
+    def search(self, query, k):
+        (index, index_rows, selector), num_searchable = self.search_state, self.num_searchable
+        if k <= 0 or num_searchable == 0:
+            return []
+        vector = self.encode_query(query)
+        k = min(k, num_searchable)
+        if selector is None:
+            scores, rows = index.search(vector, k)
+        else:
+            selector, _ = selector
+            scores, rows = index.search(vector, k, params=self.get_search_params(selector, k, num_searchable))
+        scores, rows = scores[0], rows[0]
+        # Approximate indexes can find fewer than `k` neighbors
+        keep = rows >= 0
+        scores, rows = scores[keep], rows[keep]
+        if index_rows is not None:
+            rows = index_rows[rows]
+        return [Hit(str(self.doc_asins[row]), float(score)) for row, score in zip(rows, scores)]
+
+    def count(self, query):
+        return min(self.num_searchable, DENSE_COUNT_DEPTH)
+
+    def update(self, products, removed_asins):
+        if self.rows is None:
+            self.rows = {asin: row for row, asin in enumerate(self.doc_asins.tolist())}
+        documents = [build_search_document(p, lean=True) for p in products]
+        for asin in [doc['id'] for doc in documents] + list(removed_asins):
+            row = self.rows.pop(asin, None)
+            if row is not None:
+                self.live[row] = False
+        if documents:
+            self.index.add(self.encoder.encode([doc['contents'] for doc in documents]))
+            for row, doc in enumerate(documents, start=len(self.doc_asins)):
+                self.rows[doc['id']] = row
+            self.doc_asins = np.concatenate([
+                self.doc_asins, np.array([doc['id'] for doc in documents], dtype=str),
+            ])
+            self.live = np.concatenate([self.live, np.ones(len(documents), dtype=bool)])
+        if self.asins is not None:
+            self.asins = (self.asins - set(removed_asins)) | {doc['id'] for doc in documents}
+        self.set_filter(self.asins)
+
+
+class HybridBackend(SearchBackend):
+    """
+    Reciprocal rank fusion of a lexical and a dense backend: each document
+    scores `weight / (rrf_k + rank)` in each ranking it appears in, among the
+    top `candidates` of either backend.
+
+    Arguments:
+    dense_weight (`float`) -- Weight of the dense ranking, between 0 and 1
+    """
+    def __init__(self, lexical, dense, dense_weight=0.5, candidates=HYBRID_CANDIDATES, rrf_k=RRF_K):
+        self.lexical = lexical
+        self.dense = dense
+        self.dense_weight = dense_weight
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+
+    def search(self, query, k):
+        if k <= 0:
+            return []
+        depth = max(k, self.candidates)
+        rankings = [
+            (1 - self.dense_weight, self.lexical.search(query, depth)),
+            (self.dense_weight, self.dense.search(query, depth)),
+        ]
+        scores = defaultdict(float)
+        for weight, hits in rankings:
+            for rank, hit in enumerate(hits, start=1):
+                scores[hit.asin] += weight / (self.rrf_k + rank)
+        # Sorting is stable, so ties keep the lexical order
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return [Hit(asin, score) for asin, score in ranked]
+
+    def count(self, query):
+        # The documents ranked are those among the candidates of either backend
+        return len({
+            hit.asin
+            for backend in (self.lexical, self.dense)
+            for hit in backend.search(query, self.candidates)
+        })
+
+    def update(self, products, removed_asins):
+        self.lexical.update(products, removed_asins)
+        self.dense.update(products, removed_asins)
+
+    def reopen(self):
+        self.lexical.reopen()
+        self.dense.reopen()
+
+    def clear_cache(self):
+        self.lexical.clear_cache()
+        self.dense.clear_cache()
+
+    def warm_up(self, queries, k, threads=1):
+        self.lexical.warm_up(queries, k, threads=threads)
+        self.dense.warm_up(queries, k, threads=threads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Embed product documents and build a dense index')
+    parser.add_argument('--input', required=True, help='Documents file or directory (e.g. search_engine/resources)')
+    parser.add_argument('--output', required=True, help='Index directory to write (e.g. search_engine/indexes_dense)')
+    parser.add_argument('--model', default=DENSE_MODEL, help='transformers sentence encoder')
+    parser.add_argument('--index_type', default='hnsw', choices=DENSE_INDEX_TYPES)
+    parser.add_argument('--hnsw_m', type=int, default=HNSW_M, help='Neighbors per node of hnsw indexes')
+    parser.add_argument('--nlist', type=int, default=IVF_NLIST, help='Number of lists of ivf indexes')
+    parser.add_argument('--pq_m', type=int, default=PQ_M, help='Bytes per vector of ivfpq indexes')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    encoder = TextEncoder(args.model, device=args.device)
+    backend = DenseBackend.from_documents(
+        iter_documents(args.input),
+        encoder,
+        args.index_type,
+        dict(hnsw_m=args.hnsw_m, nlist=args.nlist, pq_m=args.pq_m),
+    )
+    backend.save(args.output)
+    print(f'Saved dense index to {args.output}.')
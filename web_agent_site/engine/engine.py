@@ -2,19 +2,39 @@
 """
 import os
 import re
+import sys
 import json
 import random
 from collections import defaultdict
+from itertools import islice
 from ast import literal_eval
 from decimal import Decimal
 
 import cleantext
 from tqdm import tqdm
-from rank_bm25 import BM25Okapi
-from flask import render_template_string
+from flask import current_app
 from rich import print
-from pyserini.search.lucene import LuceneSearcher
 
+from web_agent_site.engine.attribute_store import open_attribute_store
+from web_agent_site.engine.catalog import (
+    is_compiled_catalog,
+    iter_catalog,
+    iter_json_array,
+    load_catalog,
+)
+from web_agent_site.engine.price_table import PRICE_SEED, PriceTable
+from web_agent_site.engine.renderer import get_renderer
+from web_agent_site.engine.search_backends import (
+    BM25Backend,
+    LuceneBackend,
+    SearchBackend,
+    SearcherPool,
+    build_search_document,
+)
+from web_agent_site.engine.dense_search import DenseBackend, HybridBackend
+from web_agent_site.engine.search_service import RemoteSearchBackend
+from web_agent_site.engine.sharded_search import start_shard_workers
+from web_agent_site.engine.search_cache import normalize_keywords
 from web_agent_site.utils import (
     BASE_DIR,
     DEFAULT_FILE_PATH,
@@ -23,11 +43,14 @@ from web_agent_site.utils import (
     HUMAN_ATTR_PATH
 )
 
-TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
+SEARCH_INDEX_DIR = os.path.join(BASE_DIR, '../search_engine/indexes')
 
 SEARCH_RETURN_N = 50
 PRODUCT_WINDOW = 10
 TOP_K_ATTR = 10
+KEYWORD_MODES = ('<c>', '<q>', '<a>')
+SEARCH_BACKENDS = ('lucene', 'bm25', 'dense', 'hybrid', 'sharded', 'remote')
+WARM_UP_QUERIES = 100
 
 END_BUTTON = 'Buy Now'
 NEXT_PAGE = 'Next >'
@@ -41,19 +64,26 @@ ACTION_TO_TEMPLATE = {
     'Attributes': 'attributes_page.html',
 }
 
-def map_action_to_html(action, **kwargs):
+def map_action_to_html(action, renderer=None, **kwargs):
+    """
+    Render the page reached by `action`
+
+    Arguments:
+    renderer (`TemplateRenderer`) -- Renderer of the app serving the page. Defaults
+        to the renderer of the current Flask app.
+    """
+    if renderer is None:
+        renderer = get_renderer(current_app)
     action_name, action_arg = parse_action(action)
     if action_name == 'start':
-        path = os.path.join(TEMPLATE_DIR, 'search_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = renderer.render(
+            'search_page.html',
             session_id=kwargs['session_id'],
             instruction_text=kwargs['instruction_text'],
         )
     elif action_name == 'search':
-        path = os.path.join(TEMPLATE_DIR, 'results_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = renderer.render(
+            'results_page.html',
             session_id=kwargs['session_id'],
             products=kwargs['products'],
             keywords=kwargs['keywords'],
@@ -62,9 +92,8 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs['instruction_text'],
         )
     elif action_name == 'click' and action_arg == END_BUTTON:
-        path = os.path.join(TEMPLATE_DIR, 'done_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = renderer.render(
+            'done_page.html',
             session_id=kwargs['session_id'],
             reward=kwargs['reward'],
             asin=kwargs['asin'],
@@ -79,9 +108,8 @@ def map_action_to_html(action, **kwargs):
             product_category=kwargs.get('product_category'),
         )
     elif action_name == 'click' and action_arg in ACTION_TO_TEMPLATE:
-        path = os.path.join(TEMPLATE_DIR, ACTION_TO_TEMPLATE[action_arg])
-        html = render_template_string(
-            read_html_template(path),
+        html = renderer.render(
+            ACTION_TO_TEMPLATE[action_arg],
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -91,9 +119,8 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs.get('instruction_text')
         )
     elif action_name == 'click':
-        path = os.path.join(TEMPLATE_DIR, 'item_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = renderer.render(
+            'item_page.html',
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -108,12 +135,6 @@ def map_action_to_html(action, **kwargs):
     return html
 
 
-def read_html_template(path):
-    with open(path) as f:
-        template = f.read()
-    return template
-
-
 def parse_action(action):
     """
     Parse action string to action name and its arguments.
@@ -145,95 +166,434 @@ def convert_web_app_string_to_var(name, string):
     return var
 
 
-def get_top_n_product_from_keywords(
+class SearchResults:
+    """
+    Ranked asins of one search. Free-text results are retrieved lazily: only
+    the hits of the pages viewed so far are fetched, and the window grows as
+    later pages are requested, up to the retrieval depth. `total` counts every
+    hit up to that depth.
+    """
+    def __init__(self, asins, total=None, query=None, search_engine=None):
+        self.asins = list(asins)
+        self.total = len(self.asins) if total is None else total
+        self.query = query
+        self.search_engine = search_engine
+
+    @classmethod
+    def search(cls, search_engine, query, depth, search_depth=SEARCH_RETURN_N):
+        """
+        Fetch the first `depth` hits of free-text `query`, or all of the first
+        `search_depth` if there are fewer
+
+        Arguments:
+        search_depth (`int`) -- Maximum number of results of a search, or None
+            for no limit
+        """
+        if search_depth is not None:
+            depth = min(depth, search_depth)
+        hits = search_engine.search(query, k=depth)
+        return cls.from_hits(search_engine, query, hits, depth, search_depth)
+
+    @classmethod
+    def from_hits(cls, search_engine, query, hits, depth, search_depth=SEARCH_RETURN_N):
+        """Return the results of the hits of a search for `depth` hits, at most `search_depth`"""
+        if len(hits) < depth or len(hits) == search_depth:
+            total = len(hits)
+        else:
+            # The hits fill the window, so the rest are only counted
+            total = search_engine.count(query)
+            if search_depth is not None:
+                total = min(total, search_depth)
+        return cls([hit.asin for hit in hits], total, query, search_engine)
+
+    @classmethod
+    def from_store(cls, query_store, query, search_engine=None):
+        """Return the results of normalized `query` in `query_store`, or None if it is not stored"""
+        stored = query_store.get(query)
+        if stored is None:
+            return None
+        asins, total = stored
+        return cls(asins, total, query, search_engine)
+
+    def fetch(self, depth):
+        """Return the first `depth` asins, retrieving more hits if needed"""
+        depth = min(depth, self.total)
+        asins = self.asins
+        if len(asins) < depth:
+            hits = self.search_engine.search(self.query, k=depth)
+            # Replaced as a whole, since cached results are shared by threads
+            self.asins = asins = [hit.asin for hit in hits]
+        return asins[:depth]
+
+    def get_page(self, page, product_item_dict):
+        """Return the products shown on results page `page`"""
+        asins = self.fetch(page * PRODUCT_WINDOW)[(page - 1) * PRODUCT_WINDOW:]
+        return [product_item_dict[asin] for asin in asins if asin in product_item_dict]
+
+    def get_products(self, product_item_dict):
+        """Return the products of all results"""
+        asins = self.fetch(self.total)
+        return [product_item_dict[asin] for asin in asins if asin in product_item_dict]
+
+
+def get_search_results(
         keywords,
         search_engine,
         all_products,
         product_item_dict,
         attribute_to_asins=None,
+        keyword_index=None,
+        search_cache=None,
+        page=1,
+        search_depth=SEARCH_RETURN_N,
+        query_store=None,
     ):
+    """
+    Search for `keywords`, returning `SearchResults` that hold at least the
+    results of page `page`
+
+    Arguments:
+    keyword_index (`dict`) -- Index built with `build_keyword_index`. If given, the
+        `<c>`, `<q>` and `<a>` modes look products up in it instead of scanning
+        `all_products`.
+    search_cache (`SearchResultCache`) -- Cache to serve repeated searches from
+    search_depth (`int`) -- Maximum number of results of a free-text search, or
+        None for no limit
+    query_store (`QueryResultStore`) -- Precomputed results of free-text queries,
+        looked up before the search engine (see `query_store`)
+    """
+    cache_key = normalize_keywords(keywords) if search_cache is not None else None
+    if cache_key is not None:
+        results = search_cache.get(cache_key)
+        if results is not None:
+            return results
+
+    if keywords[0] == '<r>' or keywords[0] in KEYWORD_MODES:
+        results = SearchResults(get_keyword_search_asins(
+            keywords, all_products, attribute_to_asins, keyword_index
+        ))
+    else:
+        results = None
+        if query_store is not None:
+            results = SearchResults.from_store(
+                query_store, normalize_keywords(keywords)[1], search_engine
+            )
+        if results is None:
+            results = SearchResults.search(
+                search_engine,
+                ' '.join(keywords),
+                page * PRODUCT_WINDOW,
+                search_depth,
+            )
+    if cache_key is not None:
+        search_cache.put(cache_key, results)
+    return results
+
+
+def get_keyword_search_asins(keywords, all_products, attribute_to_asins=None, keyword_index=None):
+    """Return the asins found by a search in the `<r>`, `<c>`, `<q>` or `<a>` mode"""
     if keywords[0] == '<r>':
-        top_n_products = random.sample(all_products, k=SEARCH_RETURN_N)
+        return [p['asin'] for p in random.sample(all_products, k=SEARCH_RETURN_N)]
+    elif keyword_index is not None:
+        if keywords[0] == '<c>':
+            key = keywords[1].strip()
+        else:
+            key = ' '.join(keywords[1:]).strip()
+        return keyword_index[keywords[0]].get(key, ())
     elif keywords[0] == '<a>':
         attribute = ' '.join(keywords[1:]).strip()
         asins = attribute_to_asins[attribute]
-        top_n_products = [p for p in all_products if p['asin'] in asins]
+        return [p['asin'] for p in all_products if p['asin'] in asins]
     elif keywords[0] == '<c>':
         category = keywords[1].strip()
-        top_n_products = [p for p in all_products if p['category'] == category]
-    elif keywords[0] == '<q>':
-        query = ' '.join(keywords[1:]).strip()
-        top_n_products = [p for p in all_products if p['query'] == query]
+        return [p['asin'] for p in all_products if p['category'] == category]
     else:
-        keywords = ' '.join(keywords)
-        hits = search_engine.search(keywords, k=SEARCH_RETURN_N)
-        docs = [search_engine.doc(hit.docid) for hit in hits]
-        top_n_asins = [json.loads(doc.raw())['id'] for doc in docs]
-        top_n_products = [product_item_dict[asin] for asin in top_n_asins if asin in product_item_dict]
-    return top_n_products
+        query = ' '.join(keywords[1:]).strip()
+        return [p['asin'] for p in all_products if p['query'] == query]
+
+
+def get_top_n_product_from_keywords(
+        keywords,
+        search_engine,
+        all_products,
+        product_item_dict,
+        attribute_to_asins=None,
+        keyword_index=None,
+        search_cache=None,
+        search_depth=SEARCH_RETURN_N,
+    ):
+    """Return the products of all results of a search (see `get_search_results`)"""
+    results = get_search_results(
+        keywords,
+        search_engine,
+        all_products,
+        product_item_dict,
+        attribute_to_asins,
+        keyword_index,
+        search_cache,
+        # All results are needed, so they are retrieved in one search
+        page=1 if search_depth is None else max(1, -(-search_depth // PRODUCT_WINDOW)),
+        search_depth=search_depth,
+    )
+    return results.get_products(product_item_dict)
+
+
+def batch_get_search_results(
+        keywords_batch,
+        search_engine,
+        all_products,
+        product_item_dict,
+        attribute_to_asins=None,
+        keyword_index=None,
+        search_cache=None,
+        threads=1,
+        search_depth=SEARCH_RETURN_N,
+        query_store=None,
+    ):
+    """
+    Run many searches at once, returning the `SearchResults` of each list of
+    keywords in `keywords_batch`, fetched as by `get_search_results`.
+    Free-text queries that miss the cache and the query store are deduplicated
+    and sent to the search engine as one batch.
+
+    Arguments:
+    threads (`int`) -- Number of threads the search engine runs the batch with
+    """
+    results = [None] * len(keywords_batch)
+    pending = defaultdict(list)
+    for i, keywords in enumerate(keywords_batch):
+        if keywords[0] == '<r>' or keywords[0] in KEYWORD_MODES:
+            results[i] = get_search_results(
+                keywords,
+                search_engine,
+                all_products,
+                product_item_dict,
+                attribute_to_asins,
+                keyword_index,
+                search_cache,
+            )
+            continue
+        cache_key = normalize_keywords(keywords)
+        cached = search_cache.get(cache_key) if search_cache is not None else None
+        if cached is None and query_store is not None:
+            cached = SearchResults.from_store(query_store, cache_key[1], search_engine)
+            if cached is not None and search_cache is not None:
+                search_cache.put(cache_key, cached)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending[cache_key].append(i)
+
+    cache_keys = list(pending)
+    depth = PRODUCT_WINDOW if search_depth is None else min(PRODUCT_WINDOW, search_depth)
+    hits_batch = search_engine.batch_search(
+        [query for _, query in cache_keys], k=depth, threads=threads
+    ) if cache_keys else []
+    for cache_key, hits in zip(cache_keys, hits_batch):
+        search_results = SearchResults.from_hits(
+            search_engine, cache_key[1], hits, depth, search_depth
+        )
+        if search_cache is not None:
+            search_cache.put(cache_key, search_results)
+        for i in pending[cache_key]:
+            results[i] = search_results
+    return results
+
+
+def get_keyword_index_keys(p):
+    """Return the keys product `p` is indexed under for each keyword mode"""
+    return {
+        '<c>': [p['category']],
+        '<q>': [p['query']],
+        '<a>': p['Attributes'],
+    }
+
+
+def build_keyword_index(all_products):
+    """
+    Index products by category (`<c>`), query (`<q>`) and attribute (`<a>`).
+    Each key maps to the asins of its products, in catalog order, stored as
+    the keys of a dict so they can be updated in place.
+    """
+    keyword_index = {mode: defaultdict(dict) for mode in KEYWORD_MODES}
+    for p in all_products:
+        for mode, keys in get_keyword_index_keys(p).items():
+            for key in keys:
+                keyword_index[mode][key][p['asin']] = None
+    return keyword_index
+
+
+def update_keyword_index(keyword_index, old_product=None, new_product=None):
+    """
+    Move a product from the keys of `old_product` to those of `new_product`,
+    either of which may be None. Keys both versions share keep their position.
+    """
+    old_keys = get_keyword_index_keys(old_product) if old_product is not None else {}
+    new_keys = get_keyword_index_keys(new_product) if new_product is not None else {}
+    for mode in KEYWORD_MODES:
+        old = set(old_keys.get(mode, ()))
+        new = set(new_keys.get(mode, ()))
+        for key in old - new:
+            asins = keyword_index[mode].get(key)
+            if asins is None:
+                continue
+            asins.pop(old_product['asin'], None)
+            if not asins:
+                del keyword_index[mode][key]
+        for key in new - old:
+            keyword_index[mode][key][new_product['asin']] = None
 
 
 def get_product_per_page(top_n_products, page):
     return top_n_products[(page - 1) * PRODUCT_WINDOW:page * PRODUCT_WINDOW]
 
 
-def generate_product_prices(all_products):
-    product_prices = dict()
-    for product in all_products:
-        asin = product['asin']
-        pricing = product['pricing']
-        if not pricing:
-            price = 100.0
-        elif len(pricing) == 1:
-            price = pricing[0]
+def generate_product_prices(all_products, seed=PRICE_SEED):
+    """
+    Build the price table of `all_products` from a generator seeded with
+    `seed`, so prices are identical in every process for the same seed
+    """
+    return PriceTable.from_products(all_products, seed)
+
+
+def init_search_engine(
+        num_products=None,
+        backend='lucene',
+        all_products=None,
+        num_warm_up_queries=WARM_UP_QUERIES,
+        warm_up_threads=1,
+        asins=None,
+    ):
+    """
+    Create the search backend serving free-text searches. Every catalog size is
+    served from the index of the full catalog: when `num_products` is set, hits
+    are restricted to the asins of `all_products` inside retrieval.
+
+    Lucene searchers are pooled so the backend can be shared by threads, and
+    the backend is warmed up with the queries of the first products.
+
+    Arguments:
+    backend (`str`) -- One of `SEARCH_BACKENDS`: 'lucene' for the pyserini index,
+        'bm25' for the in-process BM25 engine, which is loaded from
+        `{SEARCH_INDEX_DIR}_bm25.npz` if it was saved there, and otherwise built
+        from `all_products`, 'dense' for embedding search over the faiss index
+        built offline in `{SEARCH_INDEX_DIR}_dense` (see `dense_search`), 'hybrid' for the
+        fusion of the Lucene and dense rankings, 'sharded' for scatter-gather
+        search over the Lucene shard indexes in `{SEARCH_INDEX_DIR}_shards`,
+        one worker process per shard (see `sharded_search`), or 'remote' for
+        the search service at the default address (see `search_service`). A
+        `SearchBackend` is used as is.
+    num_warm_up_queries (`int`) -- Number of warm-up queries, 0 to skip warm-up
+    warm_up_threads (`int`) -- Number of threads to warm up searchers for
+    asins (`list`) -- Asins of `all_products`, if already at hand, e.g. from a
+        `SharedCatalog`
+    """
+    if isinstance(backend, SearchBackend):
+        return backend
+    elif backend == 'remote':
+        # The service is warmed up and filtered to its catalog on its side
+        return RemoteSearchBackend()
+
+    if num_products is None:
+        asins = None
+    elif asins is None:
+        if all_products is None:
+            raise ValueError('all_products is required to search a subset of the catalog.')
+        asins = [p['asin'] for p in all_products]
+
+    if backend == 'lucene':
+        search_engine = SearcherPool(
+            lambda asins: LuceneBackend(SEARCH_INDEX_DIR, asins=asins), asins
+        )
+    elif backend == 'sharded':
+        search_engine = start_shard_workers(f'{SEARCH_INDEX_DIR}_shards', asins=asins)
+    elif backend in ('dense', 'hybrid'):
+        index_dir = f'{SEARCH_INDEX_DIR}_dense'
+        if not os.path.exists(index_dir):
+            # Embedding the catalog takes far too long to repeat on every start
+            raise FileNotFoundError(
+                f'No dense index in {index_dir}. Build it once with '
+                f'`python -m web_agent_site.engine.dense_search` (see its docstring).'
+            )
+        search_engine = DenseBackend.load(index_dir, asins=asins)
+        if backend == 'hybrid':
+            search_engine = HybridBackend(
+                SearcherPool(lambda asins: LuceneBackend(SEARCH_INDEX_DIR, asins=asins), asins),
+                search_engine,
+            )
+    elif backend == 'bm25':
+        # Searches only read the BM25 index, so one instance serves all threads
+        index_path = f'{SEARCH_INDEX_DIR}_bm25.npz'
+        if os.path.exists(index_path):
+            search_engine = BM25Backend.load(index_path, asins=asins)
+        elif all_products is None:
+            raise ValueError('all_products is required to build the BM25 index.')
         else:
-            price = random.uniform(*pricing[:2])
-        product_prices[asin] = price
-    return product_prices
-
-
-def init_search_engine(num_products=None):
-    if num_products == 100:
-        indexes = 'indexes_100'
-    elif num_products == 1000:
-        indexes = 'indexes_1k'
-    elif num_products == 100000:
-        indexes = 'indexes_100k'
-    elif num_products is None:
-        indexes = 'indexes'
+            search_engine = BM25Backend.from_products(all_products)
+            print('BM25 index built.')
     else:
-        raise NotImplementedError(f'num_products being {num_products} is not supported yet.')
-    search_engine = LuceneSearcher(os.path.join(BASE_DIR, f'../search_engine/{indexes}'))
+        raise ValueError(f'Unknown search backend {backend}, expected one of {SEARCH_BACKENDS}.')
+
+    if all_products is not None and num_warm_up_queries > 0:
+        queries = get_warm_up_queries(all_products, num_warm_up_queries)
+        search_engine.warm_up(queries, k=SEARCH_RETURN_N, threads=warm_up_threads)
+        print(f'Search engine warmed up with {len(queries)} queries.')
     return search_engine
 
 
+def get_warm_up_queries(all_products, num_queries=WARM_UP_QUERIES):
+    """
+    Representative queries for warm-up: the distinct search queries that the
+    first products of the catalog were collected with
+    """
+    queries = dict()
+    for p in all_products:
+        if len(queries) >= num_queries:
+            break
+        queries[p['query']] = None
+    return list(queries)
+
+
 def clean_product_keys(products):
     for product in products:
-        product.pop('product_information', None)
-        product.pop('brand', None)
-        product.pop('brand_url', None)
-        product.pop('list_price', None)
-        product.pop('availability_quantity', None)
-        product.pop('availability_status', None)
-        product.pop('total_reviews', None)
-        product.pop('total_answered_questions', None)
-        product.pop('seller_id', None)
-        product.pop('seller_name', None)
-        product.pop('fulfilled_by_amazon', None)
-        product.pop('fast_track_message', None)
-        product.pop('aplus_present', None)
-        product.pop('small_description_old', None)
+        clean_product(product)
     print('Keys cleaned.')
     return products
 
 
-def load_products(filepath, num_products=None, human_goals=True):
-    # TODO: move to preprocessing step -> enforce single source of truth
-    with open(filepath) as f:
-        products = json.load(f)
-    print('Products loaded.')
-    products = clean_product_keys(products)
-    
+def clean_product(product):
+    product.pop('product_information', None)
+    product.pop('brand', None)
+    product.pop('brand_url', None)
+    product.pop('list_price', None)
+    product.pop('availability_quantity', None)
+    product.pop('availability_status', None)
+    product.pop('total_reviews', None)
+    product.pop('total_answered_questions', None)
+    product.pop('seller_id', None)
+    product.pop('seller_name', None)
+    product.pop('fulfilled_by_amazon', None)
+    product.pop('fast_track_message', None)
+    product.pop('aplus_present', None)
+    product.pop('small_description_old', None)
+    return product
+
+
+def load_attributes(human_goals=True):
+    # Attributes are only read per asin, so they are served from indexed
+    # sidecars instead of parsing the full files
+    attributes = open_attribute_store(DEFAULT_ATTR_PATH)
+    human_attributes = open_attribute_store(HUMAN_ATTR_PATH) \
+        if human_goals else dict()
+    print('Attributes loaded.')
+    return attributes, human_attributes
+
+
+def normalize_product(p, attributes, human_attributes, human_goals=True):
+    """
+    Normalize a raw product (in place) into the format served by the site.
+    """
+    asin = p['asin']
     # with open(DEFAULT_REVIEW_PATH) as f:
     #     reviews = json.load(f)
     all_reviews = dict()
@@ -242,22 +602,138 @@ def load_products(filepath, num_products=None, human_goals=True):
     #     all_reviews[r['asin']] = r['reviews']
     #     all_ratings[r['asin']] = r['average_rating']
 
+    p['Title'] = p['name']
+    p['Description'] = p['full_description']
+    p['Reviews'] = all_reviews.get(asin, [])
+    p['Rating'] = all_ratings.get(asin, 'N.A.')
+    for r in p['Reviews']:
+        if 'score' not in r:
+            r['score'] = r.pop('stars')
+        if 'review' not in r:
+            r['body'] = ''
+        else:
+            r['body'] = r.pop('review')
+    p['BulletPoints'] = p['small_description'] \
+        if isinstance(p['small_description'], list) else [p['small_description']]
+
+    pricing = p.get('pricing')
+    if pricing is None or not pricing:
+        pricing = [100.0]
+        price_tag = '$100.0'
+    else:
+        pricing = [
+            float(Decimal(re.sub(r'[^\d.]', '', price)))
+            for price in pricing.split('$')[1:]
+        ]
+        if len(pricing) == 1:
+            price_tag = f"${pricing[0]}"
+        else:
+            price_tag = f"${pricing[0]} to ${pricing[1]}"
+            pricing = pricing[:2]
+    p['pricing'] = pricing
+    p['Price'] = price_tag
+
+    options = dict()
+    customization_options = p['customization_options']
+    option_to_image = dict()
+    if customization_options:
+        for option_name, option_contents in customization_options.items():
+            if option_contents is None:
+                continue
+            option_name = option_name.lower()
+
+            option_values = []
+            for option_content in option_contents:
+                option_value = option_content['value'].strip().replace('/', ' | ').lower()
+                option_image = option_content.get('image', None)
+
+                option_values.append(option_value)
+                option_to_image[option_value] = option_image
+            options[option_name] = option_values
+    p['options'] = options
+    p['option_to_image'] = option_to_image
+
+    # without color, size, price, availability
+    # if asin in attributes and 'attributes' in attributes[asin]:
+    #     p['Attributes'] = attributes[asin]['attributes']
+    # else:
+    #     p['Attributes'] = ['DUMMY_ATTR']
+    # p['instruction_text'] = \
+    #     attributes[asin].get('instruction', None)
+    # p['instruction_attributes'] = \
+    #     attributes[asin].get('instruction_attributes', None)
+
+    # without color, size, price, availability
+    # Each lookup of an attribute store decodes the entry, so it is read once
+    product_attributes = attributes.get(asin)
+    if product_attributes is not None and 'attributes' in product_attributes:
+        p['Attributes'] = product_attributes['attributes']
+    else:
+        p['Attributes'] = ['DUMMY_ATTR']
+
     if human_goals:
-        with open(HUMAN_ATTR_PATH) as f:
-            human_attributes = json.load(f)
-    with open(DEFAULT_ATTR_PATH) as f:
-        attributes = json.load(f)
-    with open(HUMAN_ATTR_PATH) as f:
-        human_attributes = json.load(f)
-    print('Attributes loaded.')
+        instructions = human_attributes.get(asin)
+        if instructions is not None:
+            p['instructions'] = instructions
+    else:
+        if product_attributes is None:
+            raise KeyError(asin)
+        p['instruction_text'] = \
+            product_attributes.get('instruction', None)
+
+        p['instruction_attributes'] = \
+            product_attributes.get('instruction_attributes', None)
+
+    p['MainImage'] = p['images'][0]
+    p['query'] = p['query'].lower().strip()
+    return p
+
 
+def intern_product_strings(p):
+    """
+    Replace the strings of a normalized product that repeat across the catalog
+    (categories, queries, option names and values, attributes) with interned
+    copies, so each distinct value is stored once.
+    """
+    for key in ('category', 'query', 'product_category'):
+        if isinstance(p.get(key), str):
+            p[key] = sys.intern(p[key])
+    p['options'] = {
+        sys.intern(option_name): [sys.intern(v) for v in option_values]
+        for option_name, option_values in p['options'].items()
+    }
+    p['option_to_image'] = {
+        sys.intern(k): v for k, v in p['option_to_image'].items()
+    }
+    p['Attributes'] = [sys.intern(a) for a in p['Attributes']]
+    if p.get('instruction_attributes') is not None:
+        p['instruction_attributes'] = [
+            sys.intern(a) for a in p['instruction_attributes']
+        ]
+    for instruction in p.get('instructions', []):
+        instruction['instruction_attributes'] = [
+            sys.intern(a) for a in instruction['instruction_attributes']
+        ]
+        instruction['instruction_options'] = [
+            sys.intern(o) if isinstance(o, str) else o
+            for o in instruction['instruction_options']
+        ]
+    return p
+
+
+def normalize_products(
+        products,
+        attributes,
+        human_attributes,
+        human_goals=True,
+    ):
+    """
+    Normalize raw products, skipping invalid and duplicate asins. Returns the
+    kept products along with their positions in `products`.
+    """
     asins = set()
-    all_products = []
-    attribute_to_asins = defaultdict(set)
-    if num_products is not None:
-        # using item_shuffle.json, we assume products already shuffled
-        products = products[:num_products]
-    for i, p in tqdm(enumerate(products), total=len(products)):
+    positions = []
+    for i, p in enumerate(products):
         asin = p['asin']
         if asin == 'nan' or len(asin) > 10:
             continue
@@ -266,97 +742,84 @@ def load_products(filepath, num_products=None, human_goals=True):
             continue
         else:
             asins.add(asin)
+        positions.append(i)
 
-        products[i]['category'] = p['category']
-        products[i]['query'] = p['query']
-        products[i]['product_category'] = p['product_category']
-
-        products[i]['Title'] = p['name']
-        products[i]['Description'] = p['full_description']
-        products[i]['Reviews'] = all_reviews.get(asin, [])
-        products[i]['Rating'] = all_ratings.get(asin, 'N.A.')
-        for r in products[i]['Reviews']:
-            if 'score' not in r:
-                r['score'] = r.pop('stars')
-            if 'review' not in r:
-                r['body'] = ''
-            else:
-                r['body'] = r.pop('review')
-        products[i]['BulletPoints'] = p['small_description'] \
-            if isinstance(p['small_description'], list) else [p['small_description']]
-
-        pricing = p.get('pricing')
-        if pricing is None or not pricing:
-            pricing = [100.0]
-            price_tag = '$100.0'
-        else:
-            pricing = [
-                float(Decimal(re.sub(r'[^\d.]', '', price)))
-                for price in pricing.split('$')[1:]
-            ]
-            if len(pricing) == 1:
-                price_tag = f"${pricing[0]}"
-            else:
-                price_tag = f"${pricing[0]} to ${pricing[1]}"
-                pricing = pricing[:2]
-        products[i]['pricing'] = pricing
-        products[i]['Price'] = price_tag
-
-        options = dict()
-        customization_options = p['customization_options']
-        option_to_image = dict()
-        if customization_options:
-            for option_name, option_contents in customization_options.items():
-                if option_contents is None:
-                    continue
-                option_name = option_name.lower()
-
-                option_values = []
-                for option_content in option_contents:
-                    option_value = option_content['value'].strip().replace('/', ' | ').lower()
-                    option_image = option_content.get('image', None)
-
-                    option_values.append(option_value)
-                    option_to_image[option_value] = option_image
-                options[option_name] = option_values
-        products[i]['options'] = options
-        products[i]['option_to_image'] = option_to_image
-
-        # without color, size, price, availability
-        # if asin in attributes and 'attributes' in attributes[asin]:
-        #     products[i]['Attributes'] = attributes[asin]['attributes']
-        # else:
-        #     products[i]['Attributes'] = ['DUMMY_ATTR']
-        # products[i]['instruction_text'] = \
-        #     attributes[asin].get('instruction', None)
-        # products[i]['instruction_attributes'] = \
-        #     attributes[asin].get('instruction_attributes', None)
-
-        # without color, size, price, availability
-        if asin in attributes and 'attributes' in attributes[asin]:
-            products[i]['Attributes'] = attributes[asin]['attributes']
-        else:
-            products[i]['Attributes'] = ['DUMMY_ATTR']
-            
-        if human_goals:
-            if asin in human_attributes:
-                products[i]['instructions'] = human_attributes[asin]
-        else:
-            products[i]['instruction_text'] = \
-                attributes[asin].get('instruction', None)
+    all_products = [
+        intern_product_strings(normalize_product(
+            products[i], attributes, human_attributes, human_goals
+        ))
+        for i in tqdm(positions)
+    ]
+    return all_products, positions
 
-            products[i]['instruction_attributes'] = \
-                attributes[asin].get('instruction_attributes', None)
 
-        products[i]['MainImage'] = p['images'][0]
-        products[i]['query'] = p['query'].lower().strip()
+def iter_products(filepath, attributes=None, human_attributes=None, human_goals=True):
+    """
+    Stream the normalized products of a raw products file one at a time, along
+    with their positions in the file. Invalid and duplicate asins are skipped
+    as in `normalize_products`, so a prefix of the file yields the same products
+    as `load_products` with `num_products` set to its length.
 
-        all_products.append(products[i])
+    A compiled catalog (see `catalog`) yields its already normalized products
+    instead, so `attributes` and `human_attributes` are then unused.
 
+    Arguments:
+    attributes (`dict`) -- Attributes by asin. Products without attributes get
+        the dummy attribute, which is enough when only their text is needed.
+    """
+    if is_compiled_catalog(filepath):
+        yield from iter_catalog(filepath)
+        return
+    attributes = attributes if attributes is not None else dict()
+    human_attributes = human_attributes if human_attributes is not None else dict()
+    asins = set()
+    for i, p in enumerate(iter_json_array(filepath)):
+        asin = p['asin']
+        if asin == 'nan' or len(asin) > 10 or asin in asins:
+            continue
+        asins.add(asin)
+        p = clean_product(p)
+        yield i, normalize_product(p, attributes, human_attributes, human_goals)
+
+
+def build_attribute_to_asins(all_products):
+    attribute_to_asins = defaultdict(set)
     for p in all_products:
         for a in p['Attributes']:
             attribute_to_asins[a].add(p['asin'])
+    return attribute_to_asins
+
+
+def load_products(
+        filepath,
+        num_products=None,
+        human_goals=True,
+        price_seed=PRICE_SEED,
+    ):
+    if is_compiled_catalog(filepath):
+        return load_catalog(
+            filepath,
+            num_products=num_products,
+            human_goals=human_goals,
+        )
+
+    # TODO: move to preprocessing step -> enforce single source of truth
+    if num_products is None:
+        with open(filepath) as f:
+            products = json.load(f)
+    else:
+        # using item_shuffle.json, we assume products already shuffled, so
+        # only the first `num_products` entries of the file need parsing
+        products = list(islice(iter_json_array(filepath), num_products))
+    print('Products loaded.')
+    products = clean_product_keys(products)
+    attributes, human_attributes = load_attributes(human_goals)
+
+    all_products, _ = normalize_products(
+        products, attributes, human_attributes, human_goals
+    )
+    attribute_to_asins = build_attribute_to_asins(all_products)
 
     product_item_dict = {p['asin']: p for p in all_products}
-    product_prices = generate_product_prices(all_products)
+    product_prices = generate_product_prices(all_products, price_seed)
     return all_products, product_item_dict, product_prices, attribute_to_asins
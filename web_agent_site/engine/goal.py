@@ -4,7 +4,9 @@ Functions for specifying goals and reward calculations.
 import itertools
 import random
 import spacy
+import sys
 from collections import defaultdict
+from functools import lru_cache
 from rich import print
 from thefuzz import fuzz
 from web_agent_site.engine.normalize import normalize_color
@@ -12,6 +14,25 @@ from web_agent_site.engine.normalize import normalize_color
 nlp = spacy.load("en_core_web_lg")
 
 PRICE_RANGE = [10.0 * i for i in range(1, 100)]
+ATTR_MATCH_CACHE_SIZE = 1 << 18
+
+def intern_goal(goal):
+    """
+    Intern the fields of `goal` taken from its product, so that goals share
+    one copy of each category, attribute and option with the products
+    however the catalog was loaded
+    """
+    for key in ('category', 'query', 'name', 'product_category'):
+        if isinstance(goal[key], str):
+            goal[key] = sys.intern(goal[key])
+    goal['attributes'] = [sys.intern(a) for a in goal['attributes']]
+    goal_options = goal['goal_options']
+    if isinstance(goal_options, dict):
+        goal['goal_options'] = {sys.intern(k): sys.intern(v) for k, v in goal_options.items()}
+    else:
+        goal['goal_options'] = [sys.intern(o) if isinstance(o, str) else o for o in goal_options]
+    return goal
+
 
 def get_goals(all_products, product_prices, human_goals=True):
     if human_goals:
@@ -45,7 +66,7 @@ def get_human_goals(all_products, product_prices):
             else:
                 price_upper = 1000000
 
-            goals.append({
+            goals.append(intern_goal({
                 'asin': asin,
                 'category': item['category'],
                 'query': item['query'],
@@ -55,7 +76,7 @@ def get_human_goals(all_products, product_prices):
                 'attributes': attributes,
                 'price_upper': price_upper,
                 'goal_options': product['instruction_options'],
-            })
+            }))
             for att in attributes:
                 cnt_atts[att] += 1
             # goals += product_goals
@@ -107,7 +128,7 @@ def get_synthetic_goals(all_products, product_prices):
                 f'{k}: {v}' for k, v in goal_options.items()
             ])
             option_text = ' with ' + option_text if option_text else ''
-            product_goals.append({
+            product_goals.append(intern_goal({
                 'asin': asin,
                 'category': product['category'],
                 'query': product['query'],
@@ -118,13 +139,23 @@ def get_synthetic_goals(all_products, product_prices):
                 'price_upper': price_upper,
                 'goal_options': goal_options,
                 'name': product['Title'],
-            })
+            }))
             for att in attributes:
                 cnt_atts[att] += 1
         goals += product_goals
+    set_synthetic_goal_weights(goals, cnt_atts)
+    return goals
+
+
+def set_synthetic_goal_weights(goals, cnt_atts=None):
+    """Weight synthetic goals by the inverse frequency of their attributes"""
+    if cnt_atts is None:
+        cnt_atts = defaultdict(int)
+        for goal in goals:
+            for att in goal['attributes']:
+                cnt_atts[att] += 1
     for goal in goals:
         goal['weight'] = sum(1. / cnt_atts[att] for att in goal['attributes']) / len(goal['attributes'])
-    return goals
 
 
 def get_type_reward(purchased_product, goal):
@@ -175,6 +206,13 @@ def get_type_reward(purchased_product, goal):
     )
 
 
+@lru_cache(maxsize=ATTR_MATCH_CACHE_SIZE)
+def get_attribute_match_score(p_attr, g_attr):
+    """Fuzzy match score between a product and goal attribute, memoized since
+    the same attribute pairs recur across episodes"""
+    return fuzz.token_set_ratio(p_attr, g_attr)
+
+
 def get_attribute_reward(purchased_product, goal):
     """Determines whether purchased products shares same attributes as goal"""
     purchased_attrs = purchased_product['Attributes']
@@ -185,7 +223,7 @@ def get_attribute_reward(purchased_product, goal):
         matched = False
         # Check whether goal attribute found in purchased product attribute list
         for p_attr in purchased_attrs:
-            score = fuzz.token_set_ratio(p_attr, g_attr)
+            score = get_attribute_match_score(p_attr, g_attr)
             if score > 85:
                 num_attr_matches += 1
                 matched = True
@@ -0,0 +1,90 @@
+"""
+NumPy-backed table of product prices.
+
+Prices are kept in a float array aligned with a sorted array of asins, so a
+lookup is a binary search over the asins, and the whole table pickles and
+copies as two arrays. Prices of products added after the table is built (e.g.
+by a catalog delta) are kept in a small overflow dict.
+"""
+from collections.abc import MutableMapping
+
+import numpy as np
+
+PRICE_SEED = 233
+
+
+def sample_prices(all_products, seed=PRICE_SEED):
+    """
+    Sample a price for each product in one vectorized pass: the single price
+    of a product, uniformly within its price range, or 100.0 if it has none.
+    The i-th product always consumes the i-th draw of the generator, so the
+    prices of a catalog and of any prefix of it agree for the same seed.
+    """
+    bounds = np.array([
+        (pricing[0], pricing[1] if len(pricing) > 1 else pricing[0])
+        if pricing else (100.0, 100.0)
+        for pricing in (p['pricing'] for p in all_products)
+    ], dtype=np.float64).reshape(-1, 2)
+    rng = np.random.default_rng(seed)
+    return rng.uniform(bounds[:, 0], bounds[:, 1])
+
+
+class PriceTable(MutableMapping):
+    """Mapping from asin to price"""
+    def __init__(self, asins, prices):
+        asins = np.asarray(asins, dtype=bytes)
+        prices = np.asarray(prices, dtype=np.float64)
+        order = np.argsort(asins, kind='stable')
+        self.asins = asins[order]
+        # Removed entries are marked NaN rather than compacted
+        self.prices = prices[order].copy()
+        self.added = dict()
+
+    @classmethod
+    def from_products(cls, all_products, seed=PRICE_SEED):
+        asins = [p['asin'].encode() for p in all_products]
+        return cls(asins, sample_prices(all_products, seed))
+
+    def position(self, asin):
+        try:
+            asin_bytes = asin.encode()
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        if len(asin_bytes) > self.asins.itemsize:
+            return None
+        pos = int(np.searchsorted(self.asins, asin_bytes))
+        if pos < len(self.asins) and self.asins[pos] == asin_bytes:
+            return pos
+        return None
+
+    def subset(self, asins):
+        """Return a new table with the prices of `asins` only"""
+        return PriceTable([asin.encode() for asin in asins], [self[asin] for asin in asins])
+
+    def __getitem__(self, asin):
+        pos = self.position(asin)
+        if pos is not None and not np.isnan(self.prices[pos]):
+            return float(self.prices[pos])
+        return self.added[asin]
+
+    def __setitem__(self, asin, price):
+        pos = self.position(asin)
+        if pos is None:
+            self.added[asin] = float(price)
+        else:
+            self.prices[pos] = price
+
+    def __delitem__(self, asin):
+        pos = self.position(asin)
+        if pos is not None and not np.isnan(self.prices[pos]):
+            self.prices[pos] = np.nan
+        else:
+            del self.added[asin]
+
+    def __iter__(self):
+        for asin in self.asins[~np.isnan(self.prices)]:
+            yield asin.decode()
+        yield from list(self.added)
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.prices))) + len(self.added)
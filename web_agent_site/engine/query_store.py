@@ -0,0 +1,232 @@
+"""
+On-disk store of the results of the queries agents are known to issue.
+
+The RL and IL baselines only search for a fixed set of texts per goal (see
+`get_search_texts`): the goal query, each attribute with the query, the
+instruction text and the predicted queries of `goal_query_predict.json`. The
+results of all of them are computed once, for every goal, and saved in a
+SQLite file:
+
+    python -m web_agent_site.engine.query_store --output query_store.db \\
+        --num_products 1000 --extra_search_path baseline_models/data/goal_query_predict.json
+
+Environments created with `query_store=...` serve these queries from the store
+and only send other queries to the search engine. A store holds the results of
+one catalog and search backend: open it with the same `num_products`,
+`search_depth` and `search_backend` it was built with. Rebuilding a store
+writes a new file that replaces the old one once complete.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+from rich import print
+from tqdm import tqdm
+
+from web_agent_site.engine.engine import SEARCH_RETURN_N
+from web_agent_site.engine.search_cache import normalize_keywords
+
+QUERY_STORE_BATCH_SIZE = 1000
+
+
+def load_extra_search(filepath):
+    """Load the predicted queries of each instruction, e.g. `goal_query_predict.json`"""
+    with open(filepath) as f:
+        extra_search = json.load(f)
+    return {k.strip('.'): v for k, v in extra_search.items()}
+
+
+def get_search_texts(atts, query, inst, extra_search=None):
+    """
+    Return the texts an agent may search for a goal with attributes `atts`,
+    query `query` and instruction text `inst`
+
+    Arguments:
+    extra_search (`dict`) -- Predicted queries of each instruction (see
+        `load_extra_search`), used instead of the query and attributes
+    """
+    if extra_search is not None:
+        if ', and price lower than' in inst:
+            inst_ = inst[:inst.find(', and price lower than')]
+        else:
+            inst_ = inst
+        return extra_search.get(inst_, []) + [inst.lower()]
+    return [query] + [f'{att} {query}' for att in atts] + [inst.lower()]
+
+
+def get_goal_queries(goals, extra_search=None):
+    """Return the distinct normalized queries of all search texts of `goals`"""
+    queries = dict()
+    for goal in goals:
+        args = (goal['attributes'], goal['query'], goal['instruction_text'])
+        texts = get_search_texts(*args)
+        if extra_search is not None:
+            texts += get_search_texts(*args, extra_search=extra_search)
+        for text in texts:
+            mode, query = normalize_keywords(text.lower().split(' '))
+            if mode == '' and query:
+                queries[query] = None
+    return list(queries)
+
+
+def get_backend_name(backend):
+    """Name of search `backend`: one of `SEARCH_BACKENDS`, or the class of a `SearchBackend`"""
+    return backend if isinstance(backend, str) else type(backend).__name__
+
+
+class QueryResultStore:
+    """Thread-safe store from normalized free-text queries to their ranked asins"""
+    def __init__(self, path, readonly=True):
+        self.path = path
+        if readonly:
+            self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(query TEXT PRIMARY KEY, total INTEGER, asins TEXT)'
+            )
+        self.lock = threading.Lock()
+        with self.lock:
+            self.meta = {
+                key: json.loads(value)
+                for key, value in self.conn.execute('SELECT key, value FROM meta')
+            }
+
+    def get(self, query):
+        """Return the (asins, total) stored for normalized `query`, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT asins, total FROM results WHERE query = ?', (query,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put_many(self, results):
+        """Store `results`, a list of (query, asins, total) triples"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                [(query, total, json.dumps(asins)) for query, asins, total in results],
+            )
+
+    def set_meta(self, **meta):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                [(key, json.dumps(value)) for key, value in meta.items()],
+            )
+        self.meta.update(meta)
+
+    def check(self, num_products, search_depth, backend):
+        """Raise a `ValueError` if the store was built for another catalog, depth or backend"""
+        expected = dict(
+            num_products=num_products,
+            search_depth=search_depth,
+            backend=get_backend_name(backend),
+        )
+        for key, value in expected.items():
+            if self.meta.get(key) != value:
+                raise ValueError(
+                    f'Query store {self.path} was built with {key}={self.meta.get(key)}, '
+                    f'but is used with {key}={value}.'
+                )
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def build_query_store(
+        path,
+        queries,
+        search_engine,
+        backend,
+        num_products=None,
+        search_depth=SEARCH_RETURN_N,
+        batch_size=QUERY_STORE_BATCH_SIZE,
+        threads=1,
+    ):
+    """
+    Search `queries` in batches and save their top `search_depth` asins to a
+    new store that replaces any store at `path`
+
+    Arguments:
+    backend (`str`) -- Name of the backend of `search_engine` (see
+        `get_backend_name`), recorded so the store is not used with another
+    num_products (`int`) -- Catalog size the search engine serves, recorded so
+        the store is not used with another catalog
+    threads (`int`) -- Number of threads the search engine runs each batch with
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.db')
+    os.close(fd)
+    try:
+        store = QueryResultStore(tmp_path, readonly=False)
+        for start in tqdm(range(0, len(queries), batch_size)):
+            batch = queries[start:start + batch_size]
+            hits_batch = search_engine.batch_search(batch, k=search_depth, threads=threads)
+            store.put_many([
+                (query, [hit.asin for hit in hits], len(hits))
+                for query, hits in zip(batch, hits_batch)
+            ])
+        store.set_meta(
+            num_products=num_products,
+            search_depth=search_depth,
+            backend=get_backend_name(backend),
+        )
+        store.close()
+        # Readers of the old store keep reading it until they reopen
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    store = QueryResultStore(path)
+    print(f'Stored the results of {len(store)} queries in {path}.')
+    return store
+
+
+if __name__ == '__main__':
+    from web_agent_site.engine.engine import SEARCH_BACKENDS, init_search_engine, load_products
+    from web_agent_site.engine.goal import get_goals
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Precompute the results of the search texts of every goal')
+    parser.add_argument('--output', required=True, help='Path of the SQLite store')
+    parser.add_argument('--num_products', type=int, default=None, help='Number of products to search across')
+    parser.add_argument('--human_goals', type=int, default=1, help='Use the texts of human goals')
+    parser.add_argument('--extra_search_path', default='', help='Predicted queries of each instruction')
+    parser.add_argument('--backend', default='lucene', choices=SEARCH_BACKENDS)
+    parser.add_argument('--search_depth', type=int, default=SEARCH_RETURN_N)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    all_products, _, product_prices, _ = load_products(
+        DEFAULT_FILE_PATH, num_products=args.num_products, human_goals=args.human_goals
+    )
+    goals = get_goals(all_products, product_prices, args.human_goals)
+    extra_search = load_extra_search(args.extra_search_path) if args.extra_search_path else None
+    queries = get_goal_queries(goals, extra_search)
+    print(f'Found {len(queries)} distinct queries for {len(goals)} goals.')
+    search_engine = init_search_engine(
+        num_products=args.num_products,
+        backend=args.backend,
+        all_products=all_products,
+        num_warm_up_queries=0,
+    )
+    build_query_store(
+        args.output,
+        queries,
+        search_engine,
+        args.backend,
+        num_products=args.num_products,
+        search_depth=args.search_depth,
+        threads=args.threads,
+    )
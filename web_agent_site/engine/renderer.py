@@ -0,0 +1,47 @@
+"""
+Standalone rendering of the WebShop page templates.
+
+`render_template_string` re-reads and recompiles a template on every call and
+needs a Flask app and request context. A `TemplateRenderer` compiles each
+template once into its own Jinja environment and builds the URLs of
+`url_for` from the routes of an app directly, so pages render without any
+Flask context, from any thread.
+"""
+import os
+
+from jinja2 import Environment, FileSystemLoader
+
+from web_agent_site.utils import BASE_DIR
+
+TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
+
+
+class TemplateRenderer:
+    """
+    Renderer of the templates in `template_dir` with the URLs of the routes in
+    `url_map`, e.g. `app.url_map` of the Flask app that serves the pages
+    """
+    def __init__(self, url_map, template_dir=TEMPLATE_DIR):
+        # Templates are compiled on first use and never reloaded from disk
+        self.env = Environment(
+            loader=FileSystemLoader(template_dir),
+            autoescape=True,
+            auto_reload=False,
+            cache_size=-1,
+        )
+        self.env.globals['url_for'] = self.url_for
+        self.adapter = url_map.bind('localhost', '/')
+
+    def url_for(self, endpoint, **values):
+        return self.adapter.build(endpoint, values)
+
+    def render(self, template_name, **context):
+        return self.env.get_template(template_name).render(**context)
+
+
+def get_renderer(app):
+    """Return the renderer of Flask `app`, created on first use"""
+    renderer = app.extensions.get('webshop_renderer')
+    if renderer is None:
+        renderer = app.extensions['webshop_renderer'] = TemplateRenderer(app.url_map)
+    return renderer
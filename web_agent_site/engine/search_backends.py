@@ -0,0 +1,673 @@
+"""
+Search backends behind `get_top_n_product_from_keywords`.
+
+A backend answers free-text queries with ranked `Hit`s and can apply catalog
+updates to its index. Two backends are provided:
+
+* `LuceneBackend` -- the pyserini Lucene indexes built by `build_index.py`.
+  Requires a JVM, which is only started when the backend is created. Hits
+  carry the asin as their docid, so no stored document is read per hit, and
+  indexes can be built with the lean profile that stores nothing else. A
+  searcher must not be shared by threads, so concurrent users go through a
+  `SearcherPool`.
+* `BM25Backend` -- an in-process BM25 engine over a SciPy sparse matrix of term
+  frequencies, with no JVM. It indexes the same `contents` text as the
+  Lucene indexes, and can be built from the loaded products or saved once with
+
+    python -m web_agent_site.engine.search_backends \
+        --input search_engine/resources \
+        --output search_engine/indexes_bm25.npz
+"""
+import argparse
+import atexit
+import glob
+import json
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+from array import array
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+from rich import print
+from scipy import sparse
+from tqdm import tqdm
+
+Hit = namedtuple('Hit', ['asin', 'score'])
+
+# The copies of Lucene indexes made for the catalog updates of this process,
+# as (pid, copy dir) by index dir, so forked children do not write to them
+process_index_dirs = dict()
+
+# BM25 parameters used by pyserini's `LuceneSearcher`
+BM25_K1 = 0.9
+BM25_B = 0.4
+
+# Lucene's default English stop words
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the',
+    'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will',
+    'with',
+])
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STEM_CACHE_SIZE = 1 << 20
+MAX_TERM_FREQUENCY = np.iinfo(np.uint16).max
+
+
+def build_search_document(p, lean=False):
+    """
+    Build the JSON document indexed for normalized product `p`. Lean documents
+    leave out the product itself, which is only kept in the full index profile.
+    """
+    option_texts = []
+    options = p.get('options', {})
+    for option_name, option_contents in options.items():
+        option_contents_text = ', '.join(option_contents)
+        option_texts.append(f'{option_name}: {option_contents_text}')
+    option_text = ', and '.join(option_texts)
+
+    doc = dict()
+    doc['id'] = p['asin']
+    doc['contents'] = ' '.join([
+        p['Title'],
+        p['Description'],
+        p['BulletPoints'][0],
+        option_text,
+    ]).lower()
+    if not lean:
+        doc['product'] = p
+    return doc
+
+
+class SearchBackend:
+    """Interface of the search engines used by the site"""
+    def search(self, query, k):
+        """Return up to `k` hits for the free-text `query`, best first"""
+        raise NotImplementedError
+
+    def count(self, query):
+        """Return the number of documents matching the free-text `query`"""
+        raise NotImplementedError
+
+    def batch_search(self, queries, k, threads=1):
+        """Return the hits of each of `queries`, searching `threads` at a time"""
+        if threads <= 1 or len(queries) <= 1:
+            return [self.search(query, k) for query in queries]
+        with ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(lambda query: self.search(query, k), queries))
+
+    def update(self, products, removed_asins):
+        """Index (or re-index) `products` and drop the documents of `removed_asins`"""
+        raise NotImplementedError
+
+    def reopen(self):
+        """Pick up changes made to a shared index by another process"""
+
+    def clear_cache(self):
+        """Forget what was cached across searches, e.g. between benchmark runs"""
+
+    def warm_up(self, queries, k, threads=1):
+        """
+        Run `queries` once at startup, so that the first searches of users do not
+        pay for loading the index and compiling the search code. A pool keeps
+        the searchers of the `threads` warm-up threads.
+        """
+        SearchBackend.batch_search(self, queries, k, threads=threads)
+
+
+class LuceneBackend(SearchBackend):
+    """
+    Arguments:
+    asins (`list`) -- If given, only these documents are searched. The filter
+        is a clause of the Lucene query, so it is applied during retrieval and
+        does not change scores, which use the term statistics of the whole index.
+    """
+    def __init__(self, index_dir, asins=None):
+        from pyserini.pyclass import autoclass
+        self.JBooleanQueryBuilder = autoclass('org.apache.lucene.search.BooleanQuery$Builder')
+        self.JOccur = autoclass('org.apache.lucene.search.BooleanClause$Occur')
+        self.query_generator = autoclass('io.anserini.search.query.BagOfWordsQueryGenerator')()
+        self.index_dir = index_dir
+        self.reopen()
+        self.set_filter(asins)
+
+    def set_filter(self, asins):
+        """Restrict hits to `asins`, or search all documents if None"""
+        from pyserini.pyclass import autoclass
+        self.asins = set(asins) if asins is not None else None
+        self.filter_clause = None
+        if self.asins is None:
+            return
+        JTermInSetQuery = autoclass('org.apache.lucene.search.TermInSetQuery')
+        JBooleanClause = autoclass('org.apache.lucene.search.BooleanClause')
+        JArrayList = autoclass('java.util.ArrayList')
+        JBytesRef = autoclass('org.apache.lucene.util.BytesRef')
+        terms = JArrayList()
+        for asin in self.asins:
+            terms.add(JBytesRef(asin))
+        # Built once and shared by every query, so that Lucene's query cache
+        # keeps the matching documents of the filter across searches
+        self.filter_clause = JBooleanClause(JTermInSetQuery('id', terms), self.JOccur.FILTER)
+
+    def build_query(self, query):
+        """Build the Lucene query the searcher runs for `query`, with the filter if set"""
+        builder = self.JBooleanQueryBuilder()
+        builder.add(self.query_generator.buildQuery('contents', self.analyzer, query), self.JOccur.MUST)
+        if self.filter_clause is not None:
+            builder.add(self.filter_clause)
+        return builder.build()
+
+    def search(self, query, k):
+        if self.filter_clause is not None:
+            query = self.build_query(query)
+        # The docid of a hit is the `id` of the indexed document, i.e. the asin
+        hits = self.searcher.search(query, k=k)
+        return [Hit(hit.docid, hit.score) for hit in hits]
+
+    def count(self, query):
+        # Counting skips scoring and does not collect hits
+        if self.index_searcher is None:
+            from pyserini.pyclass import autoclass
+            JIndexSearcher = autoclass('org.apache.lucene.search.IndexSearcher')
+            self.index_searcher = JIndexSearcher(self.searcher.object.getIndexReader())
+        return self.index_searcher.count(self.build_query(query))
+
+    def batch_search(self, queries, k, threads=1):
+        if self.filter_clause is not None:
+            # pyserini only batches query strings, and the searcher must not be
+            # shared by threads, so filtered queries are searched one by one
+            # (a `SearcherPool` searches them in parallel)
+            return [self.search(query, k) for query in queries]
+        qids = [str(i) for i in range(len(queries))]
+        results = self.searcher.batch_search(queries, qids, k=k, threads=threads)
+        return [
+            [Hit(hit.docid, hit.score) for hit in results[qid]]
+            for qid in qids
+        ]
+
+    def is_lean(self):
+        """Whether the index was built with the lean profile, i.e. without raw documents"""
+        doc = self.searcher.doc(0)
+        return doc is not None and doc.raw() is None
+
+    def update(self, products, removed_asins):
+        """
+        Apply a catalog update to this process's copy of the index (see
+        `get_process_index_dir`). The index on disk is left unchanged, like the
+        in-memory indexes of the other backends, since the products file is.
+        """
+        update_lucene_index(
+            get_process_index_dir(self.index_dir, copy=True),
+            products,
+            removed_asins,
+            lean=self.is_lean(),
+        )
+        self.reopen()
+        if self.asins is not None:
+            self.set_filter(
+                (self.asins - set(removed_asins)) | {p['asin'] for p in products}
+            )
+
+    def reopen(self):
+        from pyserini.search.lucene import LuceneSearcher
+        self.searcher = LuceneSearcher(get_process_index_dir(self.index_dir))
+        self.analyzer = self.searcher.object.getAnalyzer()
+        self.index_searcher = None
+
+
+class SearcherPool(SearchBackend):
+    """
+    Pool of searchers over one index, so that concurrent threads each search
+    with a searcher of their own and never wait on each other. A searcher is
+    checked out for the length of a search, so the pool grows to the number of
+    concurrent searches and searchers are reused by later threads (e.g. the
+    request threads of the app).
+
+    Arguments:
+    factory (`callable`) -- Creates a searcher given the asins to filter hits
+        to, e.g. `lambda asins: LuceneBackend(index_dir, asins=asins)`
+    """
+    def __init__(self, factory, asins=None):
+        self.factory = factory
+        self.asins = asins
+        self.idle = queue.LifoQueue()
+        self.generation = 0
+        # Only held to change the index, never during searches
+        self.lock = threading.Lock()
+        # Open one searcher right away, so a missing index fails at startup
+        self.checkin(*self.checkout())
+
+    def checkout(self):
+        while True:
+            try:
+                searcher, generation = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    generation, asins = self.generation, self.asins
+                return self.factory(asins), generation
+            # Searchers opened before the last update are dropped
+            if generation == self.generation:
+                return searcher, generation
+
+    def checkin(self, searcher, generation):
+        if generation == self.generation:
+            self.idle.put((searcher, generation))
+
+    @contextmanager
+    def searcher(self):
+        searcher, generation = self.checkout()
+        try:
+            yield searcher
+        finally:
+            self.checkin(searcher, generation)
+
+    def search(self, query, k):
+        with self.searcher() as searcher:
+            return searcher.search(query, k)
+
+    def count(self, query):
+        with self.searcher() as searcher:
+            return searcher.count(query)
+
+    def batch_search(self, queries, k, threads=1):
+        # Each thread of the batch checks out a searcher of its own
+        return SearchBackend.batch_search(self, queries, k, threads=threads)
+
+    def update(self, products, removed_asins):
+        searcher, _ = self.checkout()
+        with self.lock:
+            searcher.update(products, removed_asins)
+            self.asins = searcher.asins
+            self.generation += 1
+            generation = self.generation
+        self.checkin(searcher, generation)
+
+    def reopen(self):
+        with self.lock:
+            self.generation += 1
+
+
+def get_process_index_dir(index_dir, copy=False):
+    """
+    Directory of this process's copy of the Lucene index at `index_dir`, or
+    `index_dir` itself if the process has not updated it. With `copy`, the copy
+    is made if it does not exist yet, so that catalog updates never reach the
+    index other processes and later runs open. It is removed on exit.
+
+    Lucene never rewrites the files of an index, so the copy hard links them
+    (except the write lock) where it can instead of copying them.
+    """
+    pid, process_dir = process_index_dirs.get(os.path.abspath(index_dir), (None, None))
+    if pid == os.getpid():
+        return process_dir
+    if not copy:
+        return index_dir
+    index_dir = os.path.abspath(index_dir)
+    process_dir = tempfile.mkdtemp(
+        prefix=f'{os.path.basename(index_dir)}-{os.getpid()}-',
+        dir=os.path.dirname(index_dir),
+    )
+    for name in os.listdir(index_dir):
+        if name == 'write.lock':
+            continue
+        path = os.path.join(index_dir, name)
+        try:
+            os.link(path, os.path.join(process_dir, name))
+        except OSError:
+            shutil.copy2(path, process_dir)
+    atexit.register(remove_process_index_dir, os.getpid(), process_dir)
+    process_index_dirs[index_dir] = (os.getpid(), process_dir)
+    return process_dir
+
+
+def remove_process_index_dir(pid, process_dir):
+    if pid == os.getpid():
+        shutil.rmtree(process_dir, ignore_errors=True)
+
+
+def update_lucene_index(index_dir, products, removed_asins, lean=False):
+    """
+    Add or replace the documents of `products` and delete those of
+    `removed_asins` in the Lucene index at `index_dir`, which must not be open
+    for writing elsewhere. Open searchers keep their view of the index until
+    they are reopened.
+
+    Documents are built the same way as by `build_index.py`, i.e. the
+    `JsonCollection` and `DefaultLuceneDocumentGenerator`, with positions,
+    document vectors and raw documents stored unless the index is `lean`.
+    """
+    from pyserini.analysis import get_lucene_analyzer
+    from pyserini.pyclass import autoclass
+
+    JFile = autoclass('java.io.File')
+    JFSDirectory = autoclass('org.apache.lucene.store.FSDirectory')
+    JIndexWriter = autoclass('org.apache.lucene.index.IndexWriter')
+    JIndexWriterConfig = autoclass('org.apache.lucene.index.IndexWriterConfig')
+    JOpenMode = autoclass('org.apache.lucene.index.IndexWriterConfig$OpenMode')
+    JTerm = autoclass('org.apache.lucene.index.Term')
+    JDocument = autoclass('org.apache.lucene.document.Document')
+    JFieldType = autoclass('org.apache.lucene.document.FieldType')
+    JField = autoclass('org.apache.lucene.document.Field')
+    JStore = autoclass('org.apache.lucene.document.Field$Store')
+    JStringField = autoclass('org.apache.lucene.document.StringField')
+    JStoredField = autoclass('org.apache.lucene.document.StoredField')
+    JSortedDocValuesField = autoclass('org.apache.lucene.document.SortedDocValuesField')
+    JIndexOptions = autoclass('org.apache.lucene.index.IndexOptions')
+    JBytesRef = autoclass('org.apache.lucene.util.BytesRef')
+
+    contents_type = JFieldType()
+    contents_type.setStored(False)
+    contents_type.setTokenized(True)
+    if lean:
+        contents_type.setIndexOptions(JIndexOptions.DOCS_AND_FREQS)
+    else:
+        contents_type.setIndexOptions(JIndexOptions.DOCS_AND_FREQS_AND_POSITIONS)
+        contents_type.setStoreTermVectors(True)
+    contents_type.freeze()
+
+    config = JIndexWriterConfig(get_lucene_analyzer())
+    config.setOpenMode(JOpenMode.APPEND)
+    writer = JIndexWriter(JFSDirectory.open(JFile(index_dir).toPath()), config)
+    try:
+        for asin in removed_asins:
+            writer.deleteDocuments([JTerm('id', asin)])
+        for p in products:
+            doc = build_search_document(p, lean=lean)
+            lucene_doc = JDocument()
+            lucene_doc.add(JStringField('id', doc['id'], JStore.YES))
+            lucene_doc.add(JSortedDocValuesField('id', JBytesRef(doc['id'])))
+            lucene_doc.add(JField('contents', doc['contents'], contents_type))
+            if not lean:
+                lucene_doc.add(JStoredField('raw', json.dumps(doc)))
+            writer.updateDocument(JTerm('id', doc['id']), lucene_doc)
+        writer.commit()
+    finally:
+        writer.close()
+    print(f'Search index {index_dir} updated.')
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(token):
+    """
+    Minimal English stemmer, reducing plurals to their singular form (the
+    rules of Lucene's `EnglishMinimalStemFilter`)
+    """
+    if len(token) < 3 or token[-1] != 's' or token[-2] in 'us':
+        return token
+    if token[-2] == 'e':
+        if len(token) > 3 and token[-3] == 'i' and token[-4] not in 'ae':
+            return token[:-3] + 'y'
+        if token[-3] in 'iaoe':
+            return token
+    return token[:-1]
+
+
+def analyze(text):
+    """
+    Split `text` into index terms: lowercased alphanumeric tokens without
+    possessives, stop words and plural endings. This approximates the default
+    analyzer of the Lucene indexes, with a lighter stemmer.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token.endswith("'s"):
+            token = token[:-2]
+        else:
+            token = token.split("'")[0]
+        if token not in STOP_WORDS:
+            terms.append(stem(token))
+    return terms
+
+
+class BM25Segment:
+    """Term frequencies of a batch of documents, with a mask of live documents"""
+    def __init__(self, asins, postings, doc_len):
+        self.asins = np.asarray(asins, dtype=str)
+        # Documents x terms, in column format so a query reads whole postings lists
+        self.postings = postings.tocsc()
+        self.doc_len = np.asarray(doc_len, dtype=np.float32)
+        self.live = np.ones(len(self.asins), dtype=bool)
+        # Documents matching the search filter, or None to search all of them
+        self.allowed = None
+
+    def __len__(self):
+        return len(self.asins)
+
+
+class BM25Backend(SearchBackend):
+    """
+    Okapi BM25 with the parameters and scoring of Lucene's `BM25Similarity`.
+
+    Documents are kept in segments: the initial build is one segment, and each
+    update adds a segment of the new documents and marks replaced or removed
+    ones as deleted. Term statistics are computed from live documents at query
+    time, so they always reflect the current catalog. If `asins` is given, the
+    postings of other documents are dropped before scoring, while the term
+    statistics still cover every document as with the Lucene filter.
+    """
+    def __init__(self, segments, vocab, k1=BM25_K1, b=BM25_B, asins=None):
+        self.segments = segments
+        self.vocab = vocab
+        self.k1 = k1
+        self.b = b
+        self.rows = None
+        self.set_filter(asins)
+
+    def set_filter(self, asins):
+        """Restrict hits to `asins`, or search all documents if None"""
+        self.asins = set(asins) if asins is not None else None
+        allowed = None if self.asins is None else np.array(sorted(self.asins), dtype=str)
+        for segment in self.segments:
+            segment.allowed = None if allowed is None else np.isin(segment.asins, allowed)
+
+    @classmethod
+    def from_documents(cls, documents, vocab=None, **kwargs):
+        """Build a backend from `documents` with `id` and `contents` fields"""
+        vocab = dict() if vocab is None else vocab
+        return cls([build_bm25_segment(documents, vocab)], vocab, **kwargs)
+
+    @classmethod
+    def from_products(cls, all_products, **kwargs):
+        return cls.from_documents(
+            (build_search_document(p, lean=True) for p in tqdm(all_products)), **kwargs
+        )
+
+    @classmethod
+    def load(cls, filepath, **kwargs):
+        with np.load(filepath) as index:
+            postings = sparse.csc_matrix(
+                (index['data'], index['indices'], index['indptr']),
+                shape=tuple(index['shape']),
+            )
+            segment = BM25Segment(index['asins'], postings, index['doc_len'])
+            vocab = {term: i for i, term in enumerate(index['terms'].tolist())}
+        print(f'BM25 index loaded from {filepath} ({len(segment)} documents).')
+        return cls([segment], vocab, **kwargs)
+
+    def save(self, filepath):
+        """Save the live documents of all segments as a single segment"""
+        num_terms = len(self.vocab)
+        postings = sparse.vstack([
+            resize_columns(segment.postings, num_terms)[segment.live]
+            for segment in self.segments
+        ]).tocsc()
+        terms = np.empty(num_terms, dtype=object)
+        for term, i in self.vocab.items():
+            terms[i] = term
+        with open(filepath, 'wb') as f:
+            np.savez(
+                f,
+                asins=np.concatenate([s.asins[s.live] for s in self.segments]),
+                doc_len=np.concatenate([s.doc_len[s.live] for s in self.segments]),
+                data=postings.data,
+                indices=postings.indices,
+                indptr=postings.indptr,
+                shape=np.array(postings.shape),
+                terms=terms.astype(str),
+            )
+
+    def get_query_terms(self, query):
+        """Count the indexed terms of `query` by term id"""
+        return Counter(
+            self.vocab[term] for term in analyze(query) if term in self.vocab
+        )
+
+    def count(self, query):
+        term_ids = np.array(list(self.get_query_terms(query)), dtype=np.int64)
+        total = 0
+        for segment in self.segments:
+            columns = segment.postings[:, term_ids[term_ids < segment.postings.shape[1]]]
+            rows = np.unique(columns.indices)
+            matches = segment.live[rows]
+            if segment.allowed is not None:
+                matches &= segment.allowed[rows]
+            total += int(np.count_nonzero(matches))
+        return total
+
+    def search(self, query, k):
+        query_terms = self.get_query_terms(query)
+        if not query_terms or k <= 0:
+            return []
+        term_ids = np.array(list(query_terms), dtype=np.int64)
+        boosts = np.array(list(query_terms.values()), dtype=np.float32)
+
+        # Gather the live postings of the query terms in every segment
+        postings = []
+        df = np.zeros(len(term_ids), dtype=np.float64)
+        num_docs = 0
+        total_len = 0.
+        for segment in self.segments:
+            num_docs += int(np.count_nonzero(segment.live))
+            total_len += float(segment.doc_len[segment.live].sum())
+            in_segment = term_ids < segment.postings.shape[1]
+            columns = segment.postings[:, term_ids[in_segment]]
+            rows = columns.indices
+            terms = np.repeat(
+                np.flatnonzero(in_segment), np.diff(columns.indptr)
+            )
+            tf = columns.data.astype(np.float32)
+            live = segment.live[rows]
+            rows, terms, tf = rows[live], terms[live], tf[live]
+            df += np.bincount(terms, minlength=len(term_ids))
+            if segment.allowed is not None:
+                allowed = segment.allowed[rows]
+                rows, terms, tf = rows[allowed], terms[allowed], tf[allowed]
+            postings.append((segment, rows, terms, tf))
+        if num_docs == 0:
+            return []
+        avg_len = total_len / num_docs
+        idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        asins, scores, order = [], [], []
+        offset = 0
+        for segment, rows, terms, tf in postings:
+            norm = self.k1 * (1 - self.b + self.b * segment.doc_len[rows] / avg_len)
+            weights = boosts[terms] * idf[terms] * tf / (tf + norm)
+            docs, inverse = np.unique(rows, return_inverse=True)
+            asins.append(segment.asins[docs])
+            scores.append(np.bincount(inverse, weights=weights))
+            order.append(docs + offset)
+            offset += len(segment)
+        asins = np.concatenate(asins)
+        scores = np.concatenate(scores)
+        order = np.concatenate(order)
+        if len(scores) > k:
+            # Keep every document tied with the k-th score so ties can be
+            # broken by index order, as in Lucene
+            threshold = -np.partition(-scores, k - 1)[k - 1]
+            top = np.flatnonzero(scores >= threshold)
+            asins, scores, order = asins[top], scores[top], order[top]
+        ranked = np.lexsort((order, -scores))[:k]
+        return [Hit(str(asins[i]), float(scores[i])) for i in ranked]
+
+    def update(self, products, removed_asins):
+        if self.rows is None:
+            self.rows = {
+                asin: (i, row)
+                for i, segment in enumerate(self.segments)
+                for row, asin in enumerate(segment.asins.tolist())
+            }
+        documents = [build_search_document(p, lean=True) for p in products]
+        for asin in [doc['id'] for doc in documents] + list(removed_asins):
+            location = self.rows.pop(asin, None)
+            if location is not None:
+                i, row = location
+                self.segments[i].live[row] = False
+        if documents:
+            segment = build_bm25_segment(documents, self.vocab)
+            for row, asin in enumerate(segment.asins.tolist()):
+                self.rows[asin] = (len(self.segments), row)
+            self.segments.append(segment)
+        if self.asins is not None:
+            self.set_filter(
+                (self.asins - set(removed_asins)) | {doc['id'] for doc in documents}
+            )
+
+
+def build_bm25_segment(documents, vocab):
+    """Build a segment of `documents`, adding their new terms to `vocab`"""
+    asins = []
+    doc_len = []
+    indptr = [0]
+    # Compact arrays rather than lists, since the full catalog has hundreds
+    # of millions of postings
+    indices = array('i')
+    data = array('H')
+    for doc in documents:
+        counts = Counter(analyze(doc['contents']))
+        for term, count in counts.items():
+            indices.append(vocab.setdefault(term, len(vocab)))
+            data.append(min(count, MAX_TERM_FREQUENCY))
+        indptr.append(len(indices))
+        doc_len.append(sum(counts.values()))
+        asins.append(doc['id'])
+    postings = sparse.csr_matrix(
+        (
+            np.frombuffer(data, dtype=np.uint16),
+            np.frombuffer(indices, dtype=np.intc),
+            np.array(indptr, dtype=np.int64),
+        ),
+        shape=(len(asins), len(vocab)),
+    )
+    return BM25Segment(asins, postings, doc_len)
+
+
+def resize_columns(matrix, num_columns):
+    matrix = matrix.tocsr()
+    return sparse.csr_matrix(
+        (matrix.data, matrix.indices, matrix.indptr),
+        shape=(matrix.shape[0], num_columns),
+    )
+
+
+def iter_documents(path):
+    """
+    Read the documents of a `documents.jsonl` file, or of all such files in
+    directory `path` in the order of their names
+    """
+    if os.path.isdir(path):
+        filepaths = sorted(glob.glob(os.path.join(path, '*.jsonl')))
+    else:
+        filepaths = [path]
+    for filepath in filepaths:
+        with open(filepath) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a BM25 index for the in-process search backend')
+    parser.add_argument('--input', required=True, help='Documents file or directory (e.g. search_engine/resources)')
+    parser.add_argument('--output', required=True, help='Index file to write (e.g. search_engine/indexes_bm25.npz)')
+    args = parser.parse_args()
+
+    backend = BM25Backend.from_documents(tqdm(iter_documents(args.input)))
+    backend.save(args.output)
+    print(f'Saved BM25 index to {args.output}.')
@@ -0,0 +1,67 @@
+"""
+LRU cache of search results in front of `get_top_n_product_from_keywords`.
+
+Pagination and returning to the results from an item page re-run the same
+search, and agents repeat a small set of queries many times, so results are
+cached (as `SearchResults`, which fetch later pages on demand) under a key
+that normalizes keywords the same way the search itself does.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+SEARCH_CACHE_SIZE = 10000
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def normalize_keywords(keywords):
+    """
+    Return the cache key of a search, or None for searches that must not be
+    cached (`<r>` returns random products)
+    """
+    mode = keywords[0] if keywords else ''
+    if mode == '<r>':
+        return None
+    elif mode == '<c>':
+        return mode, keywords[1].strip()
+    elif mode in ('<q>', '<a>'):
+        return mode, ' '.join(keywords[1:]).strip()
+    # Free-text queries are lowercased and tokenized by the search engine
+    return '', ' '.join(' '.join(keywords).lower().split())
+
+
+class SearchResultCache:
+    """Bounded, thread-safe LRU cache from search keys to search results"""
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            results = self.results.get(key)
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.results.move_to_end(key)
+            return results
+
+    def put(self, key, results):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.results[key] = results
+            self.results.move_to_end(key)
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        """Drop all results, e.g. after the catalog or search index changes"""
+        with self.lock:
+            self.results.clear()
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.results))
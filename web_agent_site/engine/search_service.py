@@ -0,0 +1,216 @@
+"""
+Local search service shared by many environment processes.
+
+Every `SimServer` or app otherwise opens its own search engine (and, for the
+Lucene backend, its own JVM). The service loads the search engine once and
+answers the queries of any number of local processes over a socket:
+
+    python -m web_agent_site.engine.search_service --backend lucene
+
+Processes then search through it with `search_backend='remote'`, or with a
+`RemoteSearchBackend` for a different address. Requests are pickled
+`(method, args)` pairs and calls of `batch_search` are answered in one round
+trip. The service should search the same catalog as its clients: start it
+with the same `--num_products`.
+
+The service listens on a Unix socket of the current user by default, and
+only clients holding its authkey are answered, since requests are unpickled.
+The authkey is read from `$WEBSHOP_SEARCH_AUTHKEY`, or else from a key file
+readable by its owner only, generated on first use. Clients can only search
+unless the service is started with `--allow_updates`.
+"""
+import argparse
+import getpass
+import os
+import queue
+import secrets
+import socket
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from rich import print
+
+from web_agent_site.engine.search_backends import SearchBackend
+
+SEARCH_SERVICE_ADDRESS = os.path.join(tempfile.gettempdir(), f'webshop-search-{getpass.getuser()}.sock')
+SEARCH_SERVICE_AUTHKEY_ENV = 'WEBSHOP_SEARCH_AUTHKEY'
+SEARCH_SERVICE_KEY_PATH = os.path.join(os.path.expanduser('~'), '.webshop', 'search_service.key')
+SERVICE_METHODS = ('search', 'batch_search', 'count')
+UPDATE_METHODS = ('update', 'reopen')
+
+
+def get_authkey(key_path=SEARCH_SERVICE_KEY_PATH):
+    """
+    Authkey shared by the search service and its clients: the value of
+    `$WEBSHOP_SEARCH_AUTHKEY` if set, else the key in `key_path`, generated
+    with mode 0600 if it does not exist yet
+    """
+    authkey = os.environ.get(SEARCH_SERVICE_AUTHKEY_ENV)
+    if authkey:
+        return authkey.encode()
+    if not os.path.exists(key_path):
+        os.makedirs(os.path.dirname(key_path), mode=0o700, exist_ok=True)
+        # mkstemp creates the file with mode 0600; linking it into place fails
+        # instead of overwriting the key of a process that got there first
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(key_path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+            os.link(tmp_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    if os.stat(key_path).st_mode & 0o077:
+        raise PermissionError(
+            f'Search service key file {key_path} must only be accessible by its owner (chmod 600).'
+        )
+    with open(key_path) as f:
+        return f.read().strip().encode()
+
+
+def parse_address(address):
+    """Parse `host:port` into a TCP address; anything else is a Unix socket path"""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def remove_stale_socket(address):
+    """Remove the Unix socket at `address` if no service is listening on it"""
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(address)
+    except ConnectionRefusedError:
+        # Left behind by a service that did not shut down cleanly
+        os.remove(address)
+    except FileNotFoundError:
+        pass
+    finally:
+        sock.close()
+
+
+def serve(search_engine, address=SEARCH_SERVICE_ADDRESS, authkey=None, ready=None, allow_updates=False):
+    """
+    Answer the requests of clients with `search_engine`, one thread per client
+
+    Arguments:
+    authkey (`bytes`) -- Key clients must hold, `get_authkey()` by default
+    ready (`Event`) -- Set once the service accepts connections
+    allow_updates (`bool`) -- Let clients update and reopen the search engine
+    """
+    if authkey is None:
+        authkey = get_authkey()
+    methods = SERVICE_METHODS + UPDATE_METHODS if allow_updates else SERVICE_METHODS
+    if isinstance(address, str):
+        remove_stale_socket(address)
+    with Listener(address, authkey=authkey) as listener:
+        if isinstance(address, str):
+            os.chmod(address, 0o600)
+        print(f'Search service listening on {listener.address}.')
+        if ready is not None:
+            ready.set()
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError) as e:
+                # e.g. a client with the wrong authkey
+                print(f'Rejected search client: {e}')
+                continue
+            threading.Thread(
+                target=handle_client, args=(search_engine, conn, methods), daemon=True
+            ).start()
+
+
+def handle_client(search_engine, conn, methods=SERVICE_METHODS):
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            if method in UPDATE_METHODS and method not in methods:
+                conn.send(('error', f'{method} is disabled; start the search service with --allow_updates.'))
+                continue
+            if method not in methods:
+                conn.send(('error', f'Unknown search service method {method}.'))
+                continue
+            try:
+                result = getattr(search_engine, method)(*args)
+            except Exception as e:
+                conn.send(('error', f'{type(e).__name__}: {e}'))
+            else:
+                conn.send(('ok', result))
+
+
+class RemoteSearchBackend(SearchBackend):
+    """
+    Client of a search service. Connections are opened on first use and
+    reused, one per concurrent thread, so the backend can be shared by threads.
+    """
+    def __init__(self, address=SEARCH_SERVICE_ADDRESS, authkey=None):
+        self.address = address
+        self.authkey = get_authkey() if authkey is None else authkey
+        self.connections = queue.LifoQueue()
+
+    def call(self, method, *args):
+        try:
+            conn = self.connections.get_nowait()
+        except queue.Empty:
+            conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send((method, args))
+            status, result = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+        self.connections.put(conn)
+        if status == 'error':
+            raise RuntimeError(f'Search service error: {result}')
+        return result
+
+    def search(self, query, k):
+        return self.call('search', query, k)
+
+    def batch_search(self, queries, k, threads=1):
+        return self.call('batch_search', queries, k, threads)
+
+    def count(self, query):
+        return self.call('count', query)
+
+    def update(self, products, removed_asins):
+        self.call('update', products, removed_asins)
+
+    def reopen(self):
+        self.call('reopen')
+
+    def warm_up(self, queries, k, threads=1):
+        # The service warms up its own search engine when it starts
+        pass
+
+
+if __name__ == '__main__':
+    from web_agent_site.engine.engine import SEARCH_BACKENDS, init_search_engine, load_products
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Serve a search engine to local WebShop processes')
+    parser.add_argument('--backend', default='lucene', choices=[b for b in SEARCH_BACKENDS if b != 'remote'])
+    parser.add_argument('--num_products', type=int, default=None, help='Number of products to search across')
+    parser.add_argument('--address', default=SEARCH_SERVICE_ADDRESS,
+                        help='Path of the Unix socket to listen on, or host:port')
+    parser.add_argument('--allow_updates', action='store_true',
+                        help='Let clients update the search engine, e.g. the site applying catalog deltas')
+    args = parser.parse_args()
+
+    all_products = None
+    if args.num_products is not None or args.backend == 'bm25':
+        all_products, *_ = load_products(DEFAULT_FILE_PATH, num_products=args.num_products)
+    search_engine = init_search_engine(
+        num_products=args.num_products,
+        backend=args.backend,
+        all_products=all_products,
+    )
+    serve(search_engine, parse_address(args.address), allow_updates=args.allow_updates)
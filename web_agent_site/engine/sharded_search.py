@@ -0,0 +1,165 @@
+"""
+Scatter-gather search over an index split into shards by asin hash.
+
+Each shard is searched by its own worker process, so the shards of a query
+are searched in parallel and latency drops as cores are added. Shard hits
+are merged by score; with BM25, each shard scores with its own term
+statistics, which approximate those of the whole catalog for large shards.
+Shard indexes are built with
+
+    cd search_engine
+    python build_index.py --shards N
+"""
+import os
+import secrets
+import shutil
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+
+from web_agent_site.engine.search_backends import SearchBackend
+from web_agent_site.engine.search_service import RemoteSearchBackend, serve
+
+SHARD_WORKER_TIMEOUT = 600
+# Seconds between checks that the shard workers being waited for are alive
+SHARD_WORKER_POLL_INTERVAL = 0.5
+
+
+def get_shard(asin, num_shards):
+    """Shard of `asin`, stable across processes and runs"""
+    return zlib.crc32(asin.encode()) % num_shards
+
+
+def merge_hits(shard_hits, k):
+    """Merge the ranked hits of each shard into the top `k`, best first"""
+    hits = [hit for hits in shard_hits for hit in hits]
+    # Sorting is stable, so ties are ordered by shard and then by rank
+    hits.sort(key=lambda hit: -hit.score)
+    return hits[:k]
+
+
+class ShardedBackend(SearchBackend):
+    """
+    Search backend that sends each query to every shard at once and merges
+    their hits. Shards are any backends holding disjoint documents, e.g. the
+    `RemoteSearchBackend`s of the workers of `start_shard_workers`.
+
+    Arguments:
+    workers (`list`) -- Processes serving the shards, stopped by `close`
+    socket_dir (`str`) -- Directory of the sockets of the workers, removed by `close`
+    """
+    def __init__(self, shards, workers=None, socket_dir=None):
+        self.shards = shards
+        self.workers = workers or []
+        self.socket_dir = socket_dir
+        self.executor = ThreadPoolExecutor(len(shards))
+
+    def scatter(self, method, *args):
+        return list(self.executor.map(lambda shard: getattr(shard, method)(*args), self.shards))
+
+    def search(self, query, k):
+        return merge_hits(self.scatter('search', query, k), k)
+
+    def batch_search(self, queries, k, threads=1):
+        shard_results = self.scatter('batch_search', queries, k, threads)
+        return [merge_hits(shard_hits, k) for shard_hits in zip(*shard_results)]
+
+    def count(self, query):
+        return sum(self.scatter('count', query))
+
+    def update(self, products, removed_asins):
+        shard_products = [[] for _ in self.shards]
+        shard_removed = [[] for _ in self.shards]
+        for p in products:
+            shard_products[get_shard(p['asin'], len(self.shards))].append(p)
+        for asin in removed_asins:
+            shard_removed[get_shard(asin, len(self.shards))].append(asin)
+        for shard, products, removed in zip(self.shards, shard_products, shard_removed):
+            if products or removed:
+                shard.update(products, removed)
+
+    def reopen(self):
+        self.scatter('reopen')
+
+    def close(self):
+        """Stop the shard workers and remove their sockets"""
+        self.executor.shutdown()
+        stop_workers(self.workers, self.socket_dir)
+
+
+def stop_workers(workers, socket_dir=None):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+    if socket_dir is not None:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def get_shard_dirs(shards_dir):
+    """Index directories of the shards in `shards_dir`, in shard order"""
+    return [
+        os.path.join(shards_dir, name)
+        for name in sorted(os.listdir(shards_dir))
+        if os.path.isdir(os.path.join(shards_dir, name))
+    ]
+
+
+def run_shard_worker(index_dir, address, authkey, asins, ready):
+    from web_agent_site.engine.search_backends import LuceneBackend, SearcherPool
+    search_engine = SearcherPool(
+        lambda asins: LuceneBackend(index_dir, asins=asins), asins
+    )
+    # The workers are private to the backend, which routes catalog updates to them
+    serve(search_engine, address, authkey=authkey, ready=ready, allow_updates=True)
+
+
+def start_shard_workers(shards_dir, asins=None):
+    """
+    Start a worker process serving each Lucene shard index in `shards_dir`
+    over a Unix socket, and return a `ShardedBackend` searching through them
+
+    Arguments:
+    asins (`list`) -- If given, only these documents are searched
+    """
+    shard_dirs = get_shard_dirs(shards_dir)
+    if not shard_dirs:
+        raise FileNotFoundError(f'No shard indexes found in {shards_dir}.')
+    shard_asins = [None] * len(shard_dirs)
+    if asins is not None:
+        shard_asins = [[] for _ in shard_dirs]
+        for asin in asins:
+            shard_asins[get_shard(asin, len(shard_dirs))].append(asin)
+
+    socket_dir = tempfile.mkdtemp(prefix='webshop-shards-')
+    authkey = secrets.token_bytes(32)
+    context = get_context('spawn')
+    workers, shards, events = [], [], []
+    for i, (index_dir, asins) in enumerate(zip(shard_dirs, shard_asins)):
+        address = os.path.join(socket_dir, f'{i:02d}.sock')
+        ready = context.Event()
+        worker = context.Process(
+            target=run_shard_worker,
+            args=(index_dir, address, authkey, asins, ready),
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+        events.append(ready)
+        shards.append(RemoteSearchBackend(address, authkey))
+    deadline = time.monotonic() + SHARD_WORKER_TIMEOUT
+    for index_dir, worker, ready in zip(shard_dirs, workers, events):
+        # Waits in steps, so a worker that dies while loading fails the start at once
+        while not ready.wait(SHARD_WORKER_POLL_INTERVAL):
+            if not worker.is_alive():
+                stop_workers(workers, socket_dir)
+                raise RuntimeError(
+                    f'Shard worker of {index_dir} exited with code {worker.exitcode} before it was ready.'
+                )
+            if time.monotonic() > deadline:
+                stop_workers(workers, socket_dir)
+                raise RuntimeError(f'Shard workers did not start within {SHARD_WORKER_TIMEOUT}s.')
+    print(f'Started {len(workers)} shard workers.')
+    return ShardedBackend(shards, workers, socket_dir)
@@ -0,0 +1,431 @@
+"""
+Read-only product catalog shared between processes through shared memory.
+
+One process loads the catalog and goals and publishes them into a single
+shared memory segment. Any number of `SimServer`/`WebAgentTextEnv` processes
+can then attach to the segment by name. Products and goals are decoded on
+access, so each process only keeps recently used ones in memory. The asins,
+the attribute index and the keyword index are published as sorted arrays
+that are searched in place, so attaching decodes nothing but the layout of
+the segment. Decoded products and goals are read-only:
+
+    python -m web_agent_site.engine.shared_catalog --name webshop --num_products 1000
+"""
+import argparse
+import pickle
+import signal
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from rich import print
+
+SHARED_CACHE_SIZE = 4096
+ASIN_DTYPE = 'S10'
+HEADER_FORMAT = '<Q'
+
+
+class ReadOnlyDict(dict):
+    """
+    Product, or nested dict of a product, decoded from a shared catalog.
+    Decoded products are cached per process and decoded again after being
+    evicted, so changes to them would be silently lost: they raise instead.
+    """
+    def read_only(self, *args, **kwargs):
+        raise TypeError('Products of a shared catalog are read-only.')
+
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        # Pickle and copy as a plain dict
+        return dict, (dict(self),)
+
+
+def freeze(value):
+    """Return `value` with its dicts made read-only and its lists turned into tuples"""
+    if isinstance(value, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class SharedGoal(ReadOnlyDict):
+    """Goal decoded from a shared catalog, which knows its published position"""
+
+
+def build_index_sections(name, index, asin_rank):
+    """
+    Sections of `index`, a mapping of strings to asins: the keys sorted by
+    their UTF-8 encoding, and the ranks of the asins of each key in the sorted
+    asins of the catalog, in the order of `index`, each with their offsets
+    """
+    keys = sorted(key.encode() for key in index)
+    values = [[asin_rank[asin] for asin in index[key.decode()]] for key in keys]
+    key_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum([len(key) for key in keys], out=key_offsets[1:])
+    value_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in values], out=value_offsets[1:])
+    return {
+        f'{name}_keys': b''.join(keys),
+        f'{name}_key_offsets': key_offsets,
+        f'{name}_values': np.array([r for v in values for r in v], dtype=np.int32),
+        f'{name}_value_offsets': value_offsets,
+    }
+
+
+def publish_catalog(name, all_products, product_prices, attribute_to_asins, goals, keyword_index=None):
+    """
+    Publish the catalog and goals into a new shared memory segment called
+    `name`. Returns the `SharedMemory` handle; the caller owns the segment and
+    should `close()` and `unlink()` it once no process needs it anymore.
+
+    Arguments:
+    keyword_index (`dict`) -- Index of `build_keyword_index`, built if not given
+    """
+    from web_agent_site.engine.engine import KEYWORD_MODES
+    if keyword_index is None:
+        from web_agent_site.engine.engine import build_keyword_index
+        keyword_index = build_keyword_index(all_products)
+    records = [pickle.dumps(p, protocol=pickle.HIGHEST_PROTOCOL) for p in all_products]
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in records], out=offsets[1:])
+    asins = np.array([p['asin'].encode() for p in all_products], dtype=ASIN_DTYPE)
+    asin_order = np.argsort(asins, kind='stable')
+    asin_rank = {asins[i].decode(): rank for rank, i in enumerate(asin_order)}
+    prices = np.array(
+        [product_prices[p['asin']] for p in all_products], dtype=np.float64
+    )
+    goal_records = [pickle.dumps(goal, protocol=pickle.HIGHEST_PROTOCOL) for goal in goals]
+    goal_offsets = np.zeros(len(goal_records) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in goal_records], out=goal_offsets[1:])
+    sections = {
+        'products': b''.join(records),
+        'offsets': offsets,
+        'asins': asins[asin_order],
+        'asin_order': asin_order.astype(np.int64),
+        'prices': prices,
+        'goals': b''.join(goal_records),
+        'goal_offsets': goal_offsets,
+        'goal_weights': np.array([goal['weight'] for goal in goals], dtype=np.float64),
+    }
+    sections.update(build_index_sections(
+        'attribute_to_asins',
+        {a: sorted(a_asins, key=asin_rank.get) for a, a_asins in attribute_to_asins.items()},
+        asin_rank,
+    ))
+    for mode in KEYWORD_MODES:
+        sections.update(build_index_sections(f'keyword_index{mode}', keyword_index[mode], asin_rank))
+
+    # Layout: [header size][header][sections], sections aligned to 8 bytes
+    layout = {}
+    size = 0
+    for key, section in sections.items():
+        data = section.tobytes() if isinstance(section, np.ndarray) else section
+        dtype = section.dtype.str if isinstance(section, np.ndarray) else None
+        layout[key] = (size, len(data), dtype)
+        sections[key] = data
+        size += (len(data) + 7) // 8 * 8
+    header = pickle.dumps(layout, protocol=pickle.HIGHEST_PROTOCOL)
+    start = struct.calcsize(HEADER_FORMAT) + (len(header) + 7) // 8 * 8
+
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(start + size, 1))
+    struct.pack_into(HEADER_FORMAT, shm.buf, 0, len(header))
+    shm.buf[struct.calcsize(HEADER_FORMAT):struct.calcsize(HEADER_FORMAT) + len(header)] = header
+    for key, (offset, length, _) in layout.items():
+        shm.buf[start + offset:start + offset + length] = sections[key]
+    print(f'Published {len(all_products)} products and {len(goals)} goals to {name}.')
+    return shm
+
+
+def attach_catalog(name):
+    """Attach to the catalog published under `name` as a `SharedCatalog`"""
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment with this
+        # process' resource tracker, which would unlink it on exit
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return SharedCatalog(shm)
+
+
+class SharedCatalog:
+    """
+    Process-local view over a published catalog. Exposes `all_products`,
+    `product_item_dict`, `product_prices` and `attribute_to_asins` with the
+    same interfaces as the outputs of `load_products`, plus the `goals` and
+    the `keyword_index`. Products are `ReadOnlyDict`s.
+    """
+    def __init__(self, shm, cache_size=SHARED_CACHE_SIZE):
+        self.shm = shm
+        buf = shm.buf
+        header_size, = struct.unpack_from(HEADER_FORMAT, buf, 0)
+        header_start = struct.calcsize(HEADER_FORMAT)
+        layout = pickle.loads(buf[header_start:header_start + header_size])
+        start = header_start + (header_size + 7) // 8 * 8
+        self.sections = {}
+        for key, (offset, length, dtype) in layout.items():
+            view = buf[start + offset:start + offset + length]
+            if dtype is not None:
+                view = np.frombuffer(view, dtype=dtype)
+                view.flags.writeable = False
+            self.sections[key] = view
+        self.offsets = self.sections['offsets']
+        self.asins = self.sections['asins']
+        self.asin_order = self.sections['asin_order']
+        self.prices = self.sections['prices']
+        self.goal_offsets = self.sections['goal_offsets']
+        self.goal_weights = self.sections['goal_weights']
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+        self.goals = SharedGoalList(self)
+        self.all_products = SharedProductList(self)
+        self.product_item_dict = SharedProductDict(self)
+        self.product_prices = SharedPriceDict(self)
+        self.attribute_to_asins = SharedAttributeIndex(self, 'attribute_to_asins')
+        self.keyword_index = {
+            mode: SharedIndex(self, f'keyword_index{mode}')
+            for mode in layout_keyword_modes(layout)
+        }
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def decode(self, section, offsets, idx, wrap):
+        """Decode record `idx` of `section`, keeping recent records cached"""
+        key = (section, idx)
+        with self.lock:
+            record = self.cache.get(key)
+            if record is not None:
+                self.cache.move_to_end(key)
+                return record
+        start, end = offsets[idx], offsets[idx + 1]
+        record = wrap(pickle.loads(self.sections[section][start:end]))
+        with self.lock:
+            self.cache[key] = record
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return record
+
+    def product(self, idx):
+        """Decode the product at position `idx`"""
+        return self.decode('products', self.offsets, idx, freeze)
+
+    def goal(self, idx):
+        """Decode the goal at published position `idx`"""
+        def wrap(goal):
+            goal = SharedGoal((k, freeze(v)) for k, v in goal.items())
+            goal.position = idx
+            return goal
+        return self.decode('goals', self.goal_offsets, idx, wrap)
+
+    def index(self, asin):
+        """Position of `asin` in `all_products`, or None if not in the catalog"""
+        try:
+            key = asin.encode()
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        if len(key) > self.asins.itemsize:
+            return None
+        pos = int(np.searchsorted(self.asins, key))
+        if pos < len(self.asins) and self.asins[pos] == key:
+            return int(self.asin_order[pos])
+        return None
+
+    def get_asins(self):
+        """Asins of `all_products`, in catalog order"""
+        asins = np.empty_like(self.asins)
+        asins[self.asin_order] = self.asins
+        return [asin.decode() for asin in asins]
+
+    def close(self):
+        self.cache.clear()
+        self.sections = {}
+        self.offsets = self.asins = self.asin_order = self.prices = None
+        self.goal_offsets = self.goal_weights = None
+        self.attribute_to_asins = self.keyword_index = None
+        self.shm.close()
+
+
+def layout_keyword_modes(layout):
+    """Keyword modes published with a catalog, in the order of their sections"""
+    prefix, suffix = 'keyword_index', '_keys'
+    return [
+        key[len(prefix):-len(suffix)] for key in layout
+        if key.startswith(prefix) and key.endswith(suffix)
+    ]
+
+
+class SharedIndex(Mapping):
+    """
+    Index of a shared catalog, from strings to the asins of their products,
+    searched in place with a binary search over its sorted keys
+    """
+    def __init__(self, catalog, name):
+        self.catalog = catalog
+        self.keys = catalog.sections[f'{name}_keys']
+        self.key_offsets = catalog.sections[f'{name}_key_offsets']
+        self.values = catalog.sections[f'{name}_values']
+        self.value_offsets = catalog.sections[f'{name}_value_offsets']
+
+    def key(self, i):
+        return bytes(self.keys[self.key_offsets[i]:self.key_offsets[i + 1]])
+
+    def find(self, key):
+        """Position of `key` in the sorted keys, or None if not in the index"""
+        try:
+            key = key.encode()
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.key(lo) == key:
+            return lo
+        return None
+
+    def get_asins(self, i):
+        ranks = self.values[self.value_offsets[i]:self.value_offsets[i + 1]]
+        return tuple(self.catalog.asins[rank].decode() for rank in ranks)
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.get_asins(i)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.key(i).decode()
+
+    def __len__(self):
+        return len(self.key_offsets) - 1
+
+
+class SharedAttributeIndex(SharedIndex):
+    """`attribute_to_asins` of a shared catalog: sets of asins, empty for unknown attributes"""
+    def __getitem__(self, attribute):
+        i = self.find(attribute)
+        return frozenset() if i is None else frozenset(self.get_asins(i))
+
+
+class SharedGoalList(Sequence):
+    """
+    Goals of a shared catalog, decoded on access. They can be reordered in
+    place, e.g. by `random.shuffle`, which only moves their positions.
+    """
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.order = np.arange(len(catalog.goal_offsets) - 1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.catalog.goal(i) for i in self.order[idx]]
+        return self.catalog.goal(int(self.order[idx]))
+
+    def __setitem__(self, idx, goal):
+        self.order[idx] = goal.position
+
+    def weights(self):
+        """Weights of the goals, in their current order, without decoding them"""
+        return self.catalog.goal_weights[self.order].tolist()
+
+
+def get_goal_weights(goals):
+    """Sampling weights of `goals`, read in place for the goals of a shared catalog"""
+    if isinstance(goals, SharedGoalList):
+        return goals.weights()
+    return [goal['weight'] for goal in goals]
+
+
+class SharedProductList(Sequence):
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __len__(self):
+        return len(self.catalog)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.catalog.product(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self.catalog.product(idx)
+
+
+class SharedProductDict(Mapping):
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __getitem__(self, asin):
+        idx = self.catalog.index(asin)
+        if idx is None:
+            raise KeyError(asin)
+        return self.catalog.product(idx)
+
+    def __contains__(self, asin):
+        return self.catalog.index(asin) is not None
+
+    def __iter__(self):
+        for i in range(len(self.catalog)):
+            yield self.catalog.asins[i].decode()
+
+    def __len__(self):
+        return len(self.catalog)
+
+
+class SharedPriceDict(SharedProductDict):
+    def __getitem__(self, asin):
+        idx = self.catalog.index(asin)
+        if idx is None:
+            raise KeyError(asin)
+        return float(self.catalog.prices[idx])
+
+
+if __name__ == '__main__':
+    from web_agent_site.engine.engine import load_products
+    from web_agent_site.engine.goal import get_goals
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Publish the WebShop catalog to shared memory')
+    parser.add_argument('--name', required=True, help='Name of the shared memory segment')
+    parser.add_argument('--file_path', default=DEFAULT_FILE_PATH, help='Items file or compiled catalog')
+    parser.add_argument('--num_products', type=int, default=None, help='Number of products to load')
+    parser.add_argument('--synthetic_goals', action='store_true', help='Publish synthetic instead of human goals')
+    args = parser.parse_args()
+
+    human_goals = not args.synthetic_goals
+    all_products, _, product_prices, attribute_to_asins = load_products(
+        filepath=args.file_path,
+        num_products=args.num_products,
+        human_goals=human_goals,
+    )
+    goals = get_goals(all_products, product_prices, human_goals)
+    shm = publish_catalog(args.name, all_products, product_prices, attribute_to_asins, goals)
+    try:
+        print('Serving catalog, press Ctrl+C to unpublish.')
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,161 @@
+"""
+Snapshot cache for the catalog and goals built by `SimServer`.
+
+Snapshots are keyed on the content hashes of the input files together with
+the settings that shape the goal list, so a snapshot is only reused when it
+would be rebuilt identically, and is invalidated as soon as a source changes.
+The products of a lazy catalog are saved as their records and a reference to
+their blob, so their lazy fields stay in the blob once a snapshot is loaded.
+"""
+import gc
+import hashlib
+import os
+import pickle
+import tempfile
+import types
+
+from rich import print
+
+from web_agent_site.engine.catalog import LazyProduct
+
+HASH_CHUNK_SIZE = 1 << 22
+# Bump when the contents of snapshots change
+SNAPSHOT_FORMAT = 2
+
+
+def file_digest(filepath):
+    sha = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def stable_repr(value):
+    """
+    Repr of `value` that is identical across runs, or None if there is none,
+    e.g. for objects whose repr holds their address
+    """
+    if callable(value) and hasattr(value, '__code__'):
+        # Functions referenced by a function are keyed on their code only,
+        # which also keeps recursive functions from recursing here
+        return callable_fingerprint(value, captured=False)
+    if isinstance(value, types.ModuleType):
+        return repr(('module', value.__name__))
+    if isinstance(value, (set, frozenset)):
+        items = [stable_repr(item) for item in value]
+        return None if None in items else repr((type(value).__name__, sorted(items)))
+    if isinstance(value, (list, tuple)):
+        items = [stable_repr(item) for item in value]
+        return None if None in items else repr((type(value).__name__, items))
+    if isinstance(value, dict):
+        items = [(stable_repr(k), stable_repr(v)) for k, v in value.items()]
+        if any(None in item for item in items):
+            return None
+        return repr(('dict', sorted(items)))
+    value = repr(value)
+    return None if ' at 0x' in value else value
+
+
+def callable_fingerprint(func, captured=True):
+    """
+    Identify a function (e.g. `filter_goals`) by its name, compiled code and,
+    if `captured`, the values it closes over: closure cells, defaults and
+    referenced globals. Returns None if any of these has no stable repr.
+    """
+    if func is None:
+        return None
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return stable_repr(func)
+    values = None
+    if captured:
+        func_globals = getattr(func, '__globals__', {})
+        values = [
+            [cell.cell_contents for cell in func.__closure__ or ()],
+            func.__defaults__,
+            func.__kwdefaults__,
+            {name: func_globals[name] for name in code.co_names if name in func_globals},
+        ]
+        values = [stable_repr(value) for value in values]
+        if None in values:
+            return None
+    return repr((
+        getattr(func, '__module__', None),
+        getattr(func, '__qualname__', None),
+        code.co_code.hex(),
+        repr(code.co_consts),
+        repr(code.co_names),
+        values,
+    ))
+
+
+def get_snapshot_key(filepaths, **settings):
+    """
+    Key a snapshot on the contents of `filepaths` and the given settings.
+    Callable settings are keyed on their compiled code and the values they
+    close over. Returns None if a setting cannot be keyed reliably, in which
+    case no snapshot should be used.
+    """
+    sha = hashlib.sha1()
+    sha.update(repr(('format', SNAPSHOT_FORMAT)).encode())
+    for filepath in filepaths:
+        digest = file_digest(filepath) if os.path.exists(filepath) else None
+        sha.update(repr((os.path.basename(filepath), digest)).encode())
+    for name in sorted(settings):
+        value = settings[name]
+        if callable(value):
+            value = callable_fingerprint(value)
+            if value is None:
+                print(f'Not using snapshots: {name} captures values without a stable repr.')
+                return None
+        sha.update(repr((name, value)).encode())
+    return sha.hexdigest()
+
+
+def snapshot_path(snapshot_dir, key):
+    return os.path.join(snapshot_dir, f'{key}.pkl')
+
+
+def load_snapshot(snapshot_dir, key):
+    """Return the snapshot saved under `key`, or None if there is none"""
+    path = snapshot_path(snapshot_dir, key)
+    if not os.path.exists(path):
+        return None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):
+        print(f'Ignoring unreadable snapshot {path}.')
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+    print(f'Snapshot loaded from {path}.')
+    return snapshot
+
+
+class SnapshotPickler(pickle.Pickler):
+    """
+    Pickles `LazyProduct`s as their records, which reference their blob,
+    instead of as the plain dicts they are sent to other processes as
+    """
+    def reducer_override(self, obj):
+        if isinstance(obj, LazyProduct) and obj.blob is not None:
+            return LazyProduct, (obj.fields, obj.blob, obj.offset, obj.length)
+        return NotImplemented
+
+
+def save_snapshot(snapshot_dir, key, snapshot):
+    """Atomically save `snapshot` under `key`"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            SnapshotPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(snapshot)
+        os.replace(tmp_path, snapshot_path(snapshot_dir, key))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
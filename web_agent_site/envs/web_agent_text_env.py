@@ -7,26 +7,44 @@ import torch
 
 from bs4 import BeautifulSoup
 from bs4.element import Comment
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from flask import Flask
+from web_agent_site.engine.catalog import blob_path
+from web_agent_site.engine.catalog_update import (
+    apply_catalog_delta,
+    load_catalog_delta,
+)
 from web_agent_site.engine.engine import (
     load_products,
+    batch_get_search_results,
+    build_attribute_to_asins,
+    build_keyword_index,
     init_search_engine,
-    get_top_n_product_from_keywords,
+    get_search_results,
     map_action_to_html,
     parse_action,
-    get_product_per_page,
     ACTION_TO_TEMPLATE,
     END_BUTTON, NEXT_PAGE, PREV_PAGE, BACK_TO_SEARCH,
+    SEARCH_RETURN_N,
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.goal import get_reward, get_goals, set_synthetic_goal_weights
+from web_agent_site.engine.query_store import QueryResultStore
+from web_agent_site.engine.renderer import get_renderer
+from web_agent_site.engine.search_cache import SEARCH_CACHE_SIZE, SearchResultCache
+from web_agent_site.engine.shared_catalog import attach_catalog, get_goal_weights
+from web_agent_site.engine.snapshot import get_snapshot_key, load_snapshot, save_snapshot
 from web_agent_site.utils import (
+    DEFAULT_ATTR_PATH,
     DEFAULT_FILE_PATH,
+    HUMAN_ATTR_PATH,
     FEAT_CONV,
     FEAT_IDS,
     random_idx
 )
 
+# Sessions whose results `batch_search` keeps for their next search, oldest dropped first
+MAX_PREFETCHED_RESULTS = 4096
+
 app = Flask(__name__)
 class WebAgentTextEnv(gym.Env):
     """Gym environment for Text mode of WebShop environment"""
@@ -50,6 +68,12 @@ class WebAgentTextEnv(gym.Env):
         session
         session_prefix
         show_attrs
+        shared_catalog
+        snapshot_dir
+        search_backend
+        search_cache_size
+        search_depth
+        query_store
         """
         super(WebAgentTextEnv, self).__init__()
         self.observation_mode = observation_mode
@@ -66,6 +90,12 @@ class WebAgentTextEnv(gym.Env):
             self.kwargs.get('num_products'),
             self.kwargs.get('human_goals'),
             self.kwargs.get('show_attrs', False),
+            self.kwargs.get('shared_catalog'),
+            self.kwargs.get('snapshot_dir'),
+            self.kwargs.get('search_backend', 'lucene'),
+            self.kwargs.get('search_cache_size', SEARCH_CACHE_SIZE),
+            self.kwargs.get('search_depth', SEARCH_RETURN_N),
+            self.kwargs.get('query_store'),
         ) if server is None else server
         self.browser = SimBrowser(self.server)
 
@@ -282,6 +312,12 @@ class SimServer:
         num_products=None,
         human_goals=0,
         show_attrs=False,
+        shared_catalog=None,
+        snapshot_dir=None,
+        search_backend='lucene',
+        search_cache_size=SEARCH_CACHE_SIZE,
+        search_depth=SEARCH_RETURN_N,
+        query_store=None,
     ):
         """
         Constructor for simulated server serving WebShop application
@@ -291,15 +327,119 @@ class SimServer:
         limit_goals (`int`) -- Limit to number of goals available
         num_products (`int`) -- Number of products to search across
         human_goals (`bool`) -- If true, load human goals; otherwise, load synthetic goals
+        shared_catalog (`str`) -- Name of a catalog published with `publish_catalog` to
+            attach to instead of loading products and goals in this process
+        snapshot_dir (`str`) -- Directory of snapshots of the loaded products and selected goals,
+            reused whenever the input files and goal settings are unchanged
+        search_backend (`str`) -- Search backend for free-text searches, one of `SEARCH_BACKENDS`,
+            or a `SearchBackend` such as a `RemoteSearchBackend` shared with other processes
+        search_cache_size (`int`) -- Number of search results kept in an LRU cache (0 to disable)
+        search_depth (`int`) -- Maximum number of results of a free-text search (None for no
+            limit). Hits are only retrieved for the result pages that are viewed.
+        query_store (`str`) -- Path of a store of precomputed query results (see `query_store`)
+            built for the same `num_products`, `search_depth` and `search_backend`, or an open
+            `QueryResultStore`.
+            Stored queries are served from it without searching.
         """
         # Load all products, goals, and search engine
         self.base_url = base_url
-        self.all_products, self.product_item_dict, self.product_prices, _ = \
-            load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
-        self.search_engine = init_search_engine(num_products=num_products)
-        self.goals = get_goals(self.all_products, self.product_prices, human_goals)
         self.show_attrs = show_attrs
+        self.num_products = num_products
+        self.human_goals = human_goals
+        self.filter_goals = filter_goals
+        self.limit_goals = limit_goals
+        self.shared_catalog = shared_catalog
+        self.search_depth = search_depth
+        snapshot_key = None
+        snapshot = None
+        catalog_asins = None
+        if snapshot_dir is not None and shared_catalog is None:
+            snapshot_key = get_snapshot_key(
+                # The blob of a lazy compiled catalog, if any, holds part of its products
+                [file_path, blob_path(file_path), DEFAULT_ATTR_PATH, HUMAN_ATTR_PATH],
+                num_products=num_products,
+                human_goals=bool(human_goals),
+                filter_goals=filter_goals,
+                limit_goals=limit_goals,
+            )
+            if snapshot_key is not None:
+                snapshot = load_snapshot(snapshot_dir, snapshot_key)
+
+        if snapshot is not None:
+            self.all_products = snapshot['all_products']
+            self.product_item_dict = snapshot['product_item_dict']
+            self.product_prices = snapshot['product_prices']
+            self.attribute_to_asins = snapshot.get('attribute_to_asins')
+            if self.attribute_to_asins is None:
+                self.attribute_to_asins = build_attribute_to_asins(self.all_products)
+            self.keyword_index = snapshot.get('keyword_index')
+            if self.keyword_index is None:
+                self.keyword_index = build_keyword_index(self.all_products)
+            self.goals = snapshot['goals']
+            self.weights = snapshot['weights']
+            self.cum_weights = snapshot['cum_weights']
+            random.setstate(snapshot['random_state'])
+            print(f'Loaded {len(self.goals)} goals.')
+        else:
+            if shared_catalog is not None:
+                catalog = attach_catalog(shared_catalog)
+                self.all_products = catalog.all_products
+                self.product_item_dict = catalog.product_item_dict
+                self.product_prices = catalog.product_prices
+                self.attribute_to_asins = catalog.attribute_to_asins
+                self.keyword_index = catalog.keyword_index
+                self.goals = catalog.goals
+                catalog_asins = catalog.get_asins()
+            else:
+                self.all_products, self.product_item_dict, self.product_prices, \
+                    self.attribute_to_asins = \
+                    load_products(
+                        filepath=file_path,
+                        num_products=num_products,
+                        human_goals=human_goals,
+                    )
+                self.goals = get_goals(self.all_products, self.product_prices, human_goals)
+                self.keyword_index = build_keyword_index(self.all_products)
+            self.select_goals(filter_goals, limit_goals)
+            if snapshot_key is not None:
+                save_snapshot(snapshot_dir, snapshot_key, dict(
+                    all_products=self.all_products,
+                    product_item_dict=self.product_item_dict,
+                    product_prices=self.product_prices,
+                    attribute_to_asins=self.attribute_to_asins,
+                    keyword_index=self.keyword_index,
+                    goals=self.goals,
+                    weights=self.weights,
+                    cum_weights=self.cum_weights,
+                    # Sessions keep sampling goals from the global random state
+                    random_state=random.getstate(),
+                ))
+        self.search_engine = init_search_engine(
+            num_products=num_products,
+            backend=search_backend,
+            all_products=self.all_products,
+            asins=catalog_asins,
+        )
+        self.search_cache = SearchResultCache(search_cache_size)
+        if isinstance(query_store, str):
+            query_store = QueryResultStore(query_store)
+        if query_store is not None:
+            query_store.check(num_products, search_depth, search_backend)
+        self.query_store = query_store
+        self.prefetched_results = OrderedDict()
 
+        # Pages are rendered with the URLs of the routes below, without a Flask context
+        self.renderer = get_renderer(app)
+
+        # Set extraneous housekeeping variables
+        self.user_sessions = dict()
+        self.search_time = 0
+        self.render_time = 0
+        self.sample_time = 0
+        self.assigned_instruction_text = None  # TODO: very hacky, should remove
+
+    def select_goals(self, filter_goals=None, limit_goals=-1):
+        """Shuffle, filter and limit the loaded goals, then set their sampling weights"""
         # Fix outcome for random shuffling of goals
         random.seed(233)
         random.shuffle(self.goals)
@@ -313,7 +453,7 @@ class SimServer:
         
         # Imposes `limit` on goals via random selection
         if limit_goals != -1 and limit_goals < len(self.goals):
-            self.weights = [goal['weight'] for goal in self.goals]
+            self.weights = get_goal_weights(self.goals)
             self.cum_weights = [0]
             for w in self.weights:
                 self.cum_weights.append(self.cum_weights[-1] + w)
@@ -324,23 +464,80 @@ class SimServer:
                     idxs.append(idx)
             self.goals = [self.goals[i] for i in idxs]
         print(f'Loaded {len(self.goals)} goals.')
+        self.set_goal_weights()
 
-        # Set extraneous housekeeping variables
-        self.weights = [goal['weight'] for goal in self.goals]
+    def set_goal_weights(self):
+        self.weights = get_goal_weights(self.goals)
         self.cum_weights = [0]
         for w in self.weights:
             self.cum_weights.append(self.cum_weights[-1] + w)
-        self.user_sessions = dict()
-        self.search_time = 0
-        self.render_time = 0
-        self.sample_time = 0
-        self.assigned_instruction_text = None  # TODO: very hacky, should remove
-        
+
+    def apply_catalog_delta(self, delta, update_index=True):
+        """
+        Apply a catalog delta (see `catalog_update`) to the served products,
+        their goals and the search index without restarting the server
+
+        Arguments:
+        delta (`str` | `dict`) -- Path of a delta file, or the loaded delta
+        update_index (`bool`) -- If false, only reopen the search engine, e.g. a
+            search service another of its clients has already applied the delta to
+        """
+        if self.shared_catalog is not None:
+            raise ValueError('A shared catalog is read-only and cannot be updated in place.')
+        if isinstance(delta, str):
+            delta = load_catalog_delta(delta)
+        changed, removed = apply_catalog_delta(
+            delta,
+            self.all_products,
+            self.product_item_dict,
+            self.product_prices,
+            self.attribute_to_asins,
+            human_goals=self.human_goals,
+            keyword_index=self.keyword_index,
+        )
+
+        # Regenerate the goals of updated products. A limited goal set is kept
+        # to the products it already covers.
+        stale = set(changed) | set(removed)
+        goal_asins = {goal['asin'] for goal in self.goals}
+        self.goals = [goal for goal in self.goals if goal['asin'] not in stale]
+        goal_products = [
+            self.product_item_dict[asin] for asin in changed
+            if self.limit_goals == -1 or asin in goal_asins
+        ]
+        new_goals = get_goals(
+            goal_products,
+            self.product_prices,
+            self.human_goals,
+        )
+        if self.filter_goals is not None:
+            new_goals = [
+                goal for (i, goal) in enumerate(new_goals, len(self.goals))
+                if self.filter_goals(i, goal)
+            ]
+        self.goals.extend(new_goals)
+        if not self.human_goals:
+            set_synthetic_goal_weights(self.goals)
+        self.set_goal_weights()
+
+        if update_index:
+            self.search_engine.update(
+                [self.product_item_dict[asin] for asin in changed],
+                removed,
+            )
+        else:
+            self.search_engine.reopen()
+        self.search_cache.clear()
+        # Stored results predate the delta
+        self.query_store = None
+        self.prefetched_results.clear()
+
     @app.route('/', methods=['GET', 'POST'])
     def index(self, session_id, **kwargs):
         """Redirect to the search page with the given session ID"""
         html = map_action_to_html(
             'start',
+            renderer=self.renderer,
             session_id=session_id,
             instruction_text=kwargs['instruction_text'],
         )
@@ -360,18 +557,30 @@ class SimServer:
         session["asin"] = None
         session["options"] = {}
 
-        # Perform search on keywords from items and record amount of time it takes
+        # Perform search on keywords from items and record amount of time it takes,
+        # unless the results were already fetched by `batch_search`
         old_time = time.time()
-        top_n_products = get_top_n_product_from_keywords(
-            keywords,
-            self.search_engine,
-            self.all_products,
-            self.product_item_dict,
-        )
+        prefetched = self.prefetched_results.pop(session_id, None)
+        if prefetched is not None and prefetched[0] == keywords:
+            results = prefetched[1]
+        else:
+            results = get_search_results(
+                keywords,
+                self.search_engine,
+                self.all_products,
+                self.product_item_dict,
+                self.attribute_to_asins,
+                self.keyword_index,
+                self.search_cache,
+                page=page,
+                search_depth=self.search_depth,
+                query_store=self.query_store,
+            )
+
+        # Get product list of the page, fetching more hits if it was not
+        # retrieved yet, and get list of corresponding URLs
+        products = results.get_page(page, self.product_item_dict)
         self.search_time += time.time() - old_time
-        
-        # Get product list from search result asins and get list of corresponding URLs
-        products = get_product_per_page(top_n_products, page)
 
         keywords_url_string = '+'.join(keywords)
         url = (
@@ -383,16 +592,54 @@ class SimServer:
         old_time = time.time()
         html = map_action_to_html(
             'search',
+            renderer=self.renderer,
             session_id=session_id,
             products=products,
             keywords=session["keywords"],
             page=page,
-            total=len(top_n_products),
+            total=results.total,
             instruction_text=session["goal"]["instruction_text"],
         )
         self.render_time += time.time() - old_time
         return html, url
     
+    def batch_search(self, requests, threads=1):
+        """
+        Run the searches of many sessions concurrently and return the
+        `SearchResults` of each, with their first page fetched. The next `search[...]` of each session with the same
+        keywords is served from these results, so a multi-env loop can submit
+        the searches of a step as one batch before stepping the environments.
+
+        Arguments:
+        requests (`list`) -- (session ID, keywords) pairs, with keywords as a list or
+            as the argument of a `search[...]` action
+        threads (`int`) -- Number of threads to search with
+        """
+        requests = [
+            (session_id, keywords.split(' ') if isinstance(keywords, str) else keywords)
+            for session_id, keywords in requests
+        ]
+        old_time = time.time()
+        results = batch_get_search_results(
+            [keywords for _, keywords in requests],
+            self.search_engine,
+            self.all_products,
+            self.product_item_dict,
+            self.attribute_to_asins,
+            self.keyword_index,
+            self.search_cache,
+            threads=threads,
+            search_depth=self.search_depth,
+            query_store=self.query_store,
+        )
+        self.search_time += time.time() - old_time
+        for (session_id, keywords), search_results in zip(requests, results):
+            self.prefetched_results.pop(session_id, None)
+            self.prefetched_results[session_id] = (keywords, search_results)
+            if len(self.prefetched_results) > MAX_PREFETCHED_RESULTS:
+                self.prefetched_results.popitem(last=False)
+        return results
+
     @app.route('/', methods=['GET', 'POST'])
     def item_page(self, session_id, **kwargs):
         """Render and return the HTML for a product item page"""
@@ -425,6 +672,7 @@ class SimServer:
 
         html = map_action_to_html(
             'click',
+            renderer=self.renderer,
             session_id=session_id,
             product_info=product_info,
             keywords=session["keywords"],
@@ -457,6 +705,7 @@ class SimServer:
         )
         html = map_action_to_html(
             f'click[{clickable_name}]',
+            renderer=self.renderer,
             session_id=session_id,
             product_info=product_info,
             keywords=session["keywords"],
@@ -495,6 +744,7 @@ class SimServer:
         )
         html = map_action_to_html(
             f'click[{END_BUTTON}]',
+            renderer=self.renderer,
             session_id=session_id,
             reward=reward,
             asin=session["asin"],
@@ -507,86 +757,88 @@ class SimServer:
         """Map action to the corresponding page"""
         status = dict(reward=0.0, done=False)
 
-        with app.app_context(), app.test_request_context():
-            # Create/determine goal, instruction_text from current session
-            if session_id not in self.user_sessions:
-                idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
-                goal = self.goals[idx]
-                instruction_text = goal['instruction_text']
-                self.user_sessions[session_id] = {'goal': goal, 'done': False}
-            else:
-                instruction_text = \
-                    self.user_sessions[session_id]['goal']['instruction_text']
-            if self.assigned_instruction_text is not None:
-                instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
-                self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
-            session = self.user_sessions[session_id]
-
-            if not kwargs:
-                # If no action, reset the session variables
-                kwargs['instruction_text'] = instruction_text
-                html, url = self.index(session_id, **kwargs)
-                self.user_sessions[session_id].update(
-                    {
-                        'keywords': None,
-                        'page': None,
-                        'asin': None,
-                        'asins': set(),
-                        'options': dict(),
-                        'actions': defaultdict(int)
-                    }
+        # Create/determine goal, instruction_text from current session
+        if session_id not in self.user_sessions:
+            idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
+            goal = self.goals[idx]
+            instruction_text = goal['instruction_text']
+            self.user_sessions[session_id] = {'goal': goal, 'done': False}
+        else:
+            instruction_text = \
+                self.user_sessions[session_id]['goal']['instruction_text']
+        if self.assigned_instruction_text is not None:
+            instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
+            self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
+        session = self.user_sessions[session_id]
+        if 'keywords' not in kwargs:
+            # Results prefetched by `batch_search` only serve the next action if it is a search
+            self.prefetched_results.pop(session_id, None)
+
+        if not kwargs:
+            # If no action, reset the session variables
+            kwargs['instruction_text'] = instruction_text
+            html, url = self.index(session_id, **kwargs)
+            self.user_sessions[session_id].update(
+                {
+                    'keywords': None,
+                    'page': None,
+                    'asin': None,
+                    'asins': set(),
+                    'options': dict(),
+                    'actions': defaultdict(int)
+                }
+            )
+        elif 'keywords' in kwargs:
+            # If search keywords are available, run a search
+            html, url = self.search_results(session_id, **kwargs)
+        elif 'clickable_name' in kwargs:
+            clickable_name = kwargs['clickable_name'].lower()
+            if clickable_name == END_BUTTON.lower():
+                # If "buy now" clicked, calculate reward and flag session as terminated
+                html, url, reward = self.done(session_id, **kwargs)
+                status['reward'] = reward
+                status['done'] = True
+            elif clickable_name == BACK_TO_SEARCH.lower():
+                # If "back to search" clicked, recursively reset the session back to search page
+                html, url, status = self.receive(session_id, current_url)
+            elif (clickable_name == NEXT_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'search_results'):
+                # If "next page" clicked from search results, re-render with `page` enumerated
+                html, url, status = self.receive(
+                    session_id,
+                    current_url,
+                    keywords=session["keywords"],
+                    page=session["page"] + 1,
                 )
-            elif 'keywords' in kwargs:
-                # If search keywords are available, run a search
-                html, url = self.search_results(session_id, **kwargs)
-            elif 'clickable_name' in kwargs:
-                clickable_name = kwargs['clickable_name'].lower()
-                if clickable_name == END_BUTTON.lower():
-                    # If "buy now" clicked, calculate reward and flag session as terminated
-                    html, url, reward = self.done(session_id, **kwargs)
-                    status['reward'] = reward
-                    status['done'] = True
-                elif clickable_name == BACK_TO_SEARCH.lower():
-                    # If "back to search" clicked, recursively reset the session back to search page
-                    html, url, status = self.receive(session_id, current_url)
-                elif (clickable_name == NEXT_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'search_results'):
-                    # If "next page" clicked from search results, re-render with `page` enumerated
-                    html, url, status = self.receive(
-                        session_id,
-                        current_url,
-                        keywords=session["keywords"],
-                        page=session["page"] + 1,
-                    )
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'search_results'):
-                    # If "prev page" clicked from search results, re-render with `page` denumerated
-                    html, url, status = self.receive(
-                        session_id,
-                        current_url,
-                        keywords=session["keywords"],
-                        page=session["page"] - 1,
-                    )
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'item_sub_page'):
-                    # If "prev page" clicked from sub page, return to corresponding item page
-                    html, url = self.item_page(session_id, **kwargs)
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'item_page'):
-                    # If "prev page" clicked from item page, return to search results page
-                    html, url = self.search_results(
-                        session_id,
-                        keywords=session["keywords"],
-                        page=session["page"],
-                        **kwargs
-                    )
-                elif clickable_name in [k.lower() for k in ACTION_TO_TEMPLATE]:
-                    # Render item_sub_page if clickable is description, features, or reviews
-                    html, url = self.item_sub_page(session_id, **kwargs)
-                else:
-                    # Otherwise, render current item page
-                    html, url = self.item_page(session_id, **kwargs)
-            return html, url, status
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'search_results'):
+                # If "prev page" clicked from search results, re-render with `page` denumerated
+                html, url, status = self.receive(
+                    session_id,
+                    current_url,
+                    keywords=session["keywords"],
+                    page=session["page"] - 1,
+                )
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'item_sub_page'):
+                # If "prev page" clicked from sub page, return to corresponding item page
+                html, url = self.item_page(session_id, **kwargs)
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'item_page'):
+                # If "prev page" clicked from item page, return to search results page
+                html, url = self.search_results(
+                    session_id,
+                    keywords=session["keywords"],
+                    page=session["page"],
+                    **kwargs
+                )
+            elif clickable_name in [k.lower() for k in ACTION_TO_TEMPLATE]:
+                # Render item_sub_page if clickable is description, features, or reviews
+                html, url = self.item_sub_page(session_id, **kwargs)
+            else:
+                # Otherwise, render current item page
+                html, url = self.item_page(session_id, **kwargs)
+        return html, url, status
     
     def get_page_name(self, url):
         """Determine which page (i.e. item_page, search_results) the given URL is pointing at"""